@@ -0,0 +1,381 @@
+#! /usr/bin/env python
+
+# Copyright 2014 Miguel Martinez de Aguirre
+# See LICENSE for details.
+
+"""
+Benchmarks for the hot paths of a game and for whole rounds played over a
+loopback PB connection.
+
+Results are written as JSON: for each benchmark its throughput in
+operations per second and the p50/p99 latency of one operation in ms.
+Given a baseline file, benchmarks which got slower by more than the
+tolerance are reported and the exit status is 1.
+"""
+
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+from twisted.cred import credentials, portal
+from twisted.internet import defer, task
+from twisted.python import log
+from twisted.spread import pb
+
+import grid
+import paths
+import server
+import util
+
+SIZES = [(64, 48), (256, 192), (1000, 1000)]
+PLAYERS = [2, 8, 32]
+LOOPBACK_SIZES = [(64, 48), (256, 192)]
+LOOPBACK_PLAYERS = [2, 8]
+GAMES = ['race', 'battle']
+SEED = 1
+
+
+def summarise(samples, operations=1):
+    """
+    samples: seconds taken by each repetition
+    operations: operations done per repetition
+    """
+    samples = np.asarray(samples, np.float64)
+    return {
+        'throughput': operations * len(samples) / samples.sum(),
+        'p50': np.percentile(samples, 50) * 1000.0 / operations,
+        'p99': np.percentile(samples, 99) * 1000.0 / operations,
+        'samples': len(samples),
+        }
+
+
+def repeat(f, times):
+    samples = []
+    for i in xrange(times):
+        started = time.time()
+        f()
+        samples.append(time.time() - started)
+    return samples
+
+
+def makeImage(size, directory):
+    """Write a reproducible noise image of size and return its filename."""
+    rng = np.random.RandomState(SEED)
+    data = rng.randint(0, 256, (size[1], size[0], 3)).astype(np.uint8)
+    filename = os.path.join(directory, '{0}x{1}.png'.format(*size))
+    Image.fromarray(data).save(filename)
+    return filename
+
+
+class NullMind(object):
+    """Stands in for a client connection and ignores every call."""
+    def callRemote(self, message, *args):
+        return defer.succeed(None)
+
+
+def startedServer(image, players, diagonals):
+    game = server.Server(image, players, clock=task.Clock(),
+                         diagonals=diagonals)
+    for i in xrange(players):
+        server.GameClient(game, 'p{0}'.format(i)).attached(NullMind())
+    return game
+
+
+def benchGrid(image, size, players):
+    results = {}
+    rng = np.random.RandomState(SEED)
+    costs = grid.CostGrid.fromImage(Image.open(image))
+    colours = [tuple(c) for c in rng.randint(0, 256, (players, 3)).tolist()]
+
+    def moves():
+        xs = rng.randint(0, size[0], players).tolist()
+        ys = rng.randint(0, size[1], players).tolist()
+        return zip(zip(xs, ys), colours)
+    turns = [moves() for i in xrange(200)]
+    it = iter(turns)
+    results['applyMoves'] = summarise(
+        repeat(lambda: costs.applyMoves(next(it)), len(turns)))
+
+    game = startedServer(image, players, True)
+    avatars = game.players
+    for a in avatars:
+        # random moves are not in the players' paths, so never score them
+        a.end = None
+    it = iter(turns)
+
+    def doMoves():
+        turn = [(a, n) for a, (n, c) in zip(avatars, next(it))]
+        game.doMoves(turn)
+    results['doMoves'] = summarise(repeat(doMoves, len(turns)))
+
+    length = min(size)
+    path = [(i, i) for i in xrange(length)]
+    results['pathCost'] = summarise(
+        repeat(lambda: costs.pathCost(path), 50), length - 1)
+    results['cost'] = summarise(repeat(lambda: [
+        util.cost(path[i + 1], path[i], costs)
+        for i in xrange(length - 1)], 5), length - 1)
+
+    avatar = avatars[0]
+    avatar.visited = paths.PathTree(size, path[0])
+    for parent, node in zip(path, path[1:]):
+        avatar.visited[node] = parent
+    avatar.end = path[-1]
+    results['calculateScore'] = summarise(
+        repeat(lambda: avatar.calculateScore(1), 50), length)
+    return results
+
+
+def benchTopology(size, diagonals):
+    childMaker = util.ChildMaker(size, diagonals)
+    rng = np.random.RandomState(SEED)
+    nodes = zip(rng.randint(0, size[0], 1000).tolist(),
+                rng.randint(0, size[1], 1000).tolist())
+    return {
+        'getChildren': summarise(repeat(
+            lambda: [childMaker.getChildren(n) for n in nodes], 5),
+            len(nodes)),
+        'isChild': summarise(repeat(
+            lambda: [childMaker.isChild(n, n) for n in nodes], 5),
+            len(nodes)),
+        }
+
+
+def benchRedraw(image, players):
+    """Time GameUI redrawing a round of changes, if there is a display."""
+    import Tkinter
+    import client
+    try:
+        root = Tkinter.Tk()
+    except Tkinter.TclError, e:
+        return {'skipped': str(e)}
+    costs = grid.CostGrid.fromImage(Image.open(image))
+
+    class Conduit(object):
+        def fetchView(self, region):
+            x0, y0, x1, y1 = region
+            return defer.succeed(costs.data[y0:y1, x0:x1])
+    ui = client.GameUI(Conduit(), root)
+    ui.start(costs.size)
+    ui.flush()
+    rng = np.random.RandomState(SEED)
+    pixels = costs.size[0] * costs.size[1]
+    deltas = [grid.CostDelta(rng.choice(pixels, players, replace=False),
+                             rng.randint(0, 256, (players, 3)))
+              for i in xrange(20)]
+    it = iter(deltas)
+
+    def redraw():
+        ui.applyCostDelta(next(it))
+        ui.flush()
+    result = summarise(repeat(redraw, len(deltas)))
+    root.destroy()
+    return result
+
+
+class TimedServer(server.Server):
+    """Server recording how long each round takes to collect its moves."""
+    def __init__(self, *args, **kwargs):
+        server.Server.__init__(self, *args, **kwargs)
+        self.rounds = []
+
+    def nextRound(self):
+        self.roundStarted = time.time()
+        server.Server.nextRound(self)
+
+    def doMoves(self, turn):
+        self.rounds.append(time.time() - self.roundStarted)
+        server.Server.doMoves(self, turn)
+
+
+class LoopbackPlayer(pb.Referenceable):
+    """Client which answers every turn at once with a step to its goal."""
+    perspective = None
+
+    def __init__(self, name):
+        self.name = name
+        self.done = defer.Deferred()
+        self.waiting = []
+
+    def remote_print(self, message, colour):
+        pass
+
+    def remote_startGame(self, start, end, players, costdelta):
+        self.head = start
+        self.end = end
+        self._move()
+
+    def remote_startNextTurn(self, costdelta, deadline=None):
+        self._move()
+
+    def remote_updateCosts(self, costdelta):
+        pass
+
+    def remote_win(self, scores):
+        self.done.callback(scores)
+
+    def remote_gameOver(self, scores):
+        self.done.callback(scores)
+
+    def _move(self):
+        x, y = self.head
+        node = (x + cmp(self.end[0], x), y + cmp(self.end[1], y))
+        if not self.diagonals and node[0] != x and node[1] != y:
+            node = (node[0], y)
+        args = (node, self.head)
+        self.head = node
+        if self.perspective is None:
+            # the game can start before the login has completed
+            self.waiting.append(args)
+        else:
+            self.perspective.callRemote("expandNode", *args)
+
+    def loggedIn(self, perspective):
+        self.perspective = perspective
+        for args in self.waiting:
+            perspective.callRemote("expandNode", *args)
+
+
+def playLoopback(reactor, image, players, diagonals, game):
+    """
+    Play one game over loopback PB connections.
+    returns: Deferred firing with the round durations
+    """
+    lobby = server.Lobby(image, players)
+    room = lobby.rooms['bench'] = TimedServer(image, players,
+                                              diagonals=diagonals, game=game)
+    factory = pb.PBServerFactory(portal.Portal(
+        server.Realm(lobby), [server.UsernameOnlyChecker(lobby)]))
+    port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+    clients = []
+    done = []
+    for i in xrange(players):
+        player = LoopbackPlayer('p{0}@bench'.format(i))
+        player.diagonals = diagonals
+        clientFactory = pb.PBClientFactory()
+        reactor.connectTCP('127.0.0.1', port.getHost().port, clientFactory)
+        d = clientFactory.login(
+            credentials.UsernamePassword(player.name, ''), client=player)
+        d.addCallback(player.loggedIn)
+        d.addErrback(log.err)
+        clients.append(clientFactory)
+        done.append(player.done)
+
+    def finished(result):
+        # let the last answers to win and gameOver reach the server first
+        return task.deferLater(reactor, 0.1, disconnect)
+
+    def disconnect():
+        for c in clients:
+            c.disconnect()
+        d = port.stopListening()
+        d.addCallback(lambda _: room.rounds)
+        return d
+    return defer.DeferredList(done).addCallback(finished)
+
+
+@defer.inlineCallbacks
+def benchLoopback(reactor, directory, sizes, players, results):
+    for size in sizes:
+        image = makeImage(size, directory)
+        for count in players:
+            for diagonals in (True, False):
+                for game in GAMES:
+                    name = 'loopback/{0}x{1}/players={2}/diagonals={3}/' \
+                        'game={4}'.format(size[0], size[1], count,
+                                          int(diagonals), game)
+                    log.msg(["Running", name])
+                    rounds = yield playLoopback(reactor, image, count,
+                                                diagonals, game)
+                    results[name] = summarise(rounds)
+
+
+def run(quick=False):
+    """Run every benchmark. returns: the results dictionary"""
+    directory = tempfile.mkdtemp()
+    sizes = SIZES[:2] if quick else SIZES
+    results = {}
+    try:
+        for size in sizes:
+            image = makeImage(size, directory)
+            for count in PLAYERS:
+                for name, result in benchGrid(image, size, count).items():
+                    key = '{0}/{1}x{2}/players={3}'.format(name, size[0],
+                                                           size[1], count)
+                    results[key] = result
+            for diagonals in (True, False):
+                for name, result in benchTopology(size, diagonals).items():
+                    key = '{0}/{1}x{2}/diagonals={3}'.format(
+                        name, size[0], size[1], int(diagonals))
+                    results[key] = result
+        results['redraw/64x48/players=8'] = benchRedraw(
+            makeImage((64, 48), directory), 8)
+
+        from twisted.internet import reactor
+        d = benchLoopback(reactor, directory,
+                          LOOPBACK_SIZES[:1] if quick else LOOPBACK_SIZES,
+                          LOOPBACK_PLAYERS, results)
+        d.addErrback(log.err)
+        d.addBoth(lambda _: reactor.stop())
+        reactor.run()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'benchmarks': results,
+        }
+
+
+def compare(baseline, current, tolerance):
+    """
+    returns: list of messages for benchmarks slower than the baseline by
+             more than tolerance, a fraction
+    """
+    regressions = []
+    for name, old in sorted(baseline['benchmarks'].items()):
+        new = current['benchmarks'].get(name)
+        if new is None or 'throughput' not in old or \
+                'throughput' not in new:
+            continue
+        if new['throughput'] < old['throughput'] * (1 - tolerance):
+            regressions.append("{0}: throughput {1:.1f}/s -> {2:.1f}/s"
+                               .format(name, old['throughput'],
+                                       new['throughput']))
+        if new['p99'] > old['p99'] * (1 + tolerance):
+            regressions.append("{0}: p99 {1:.3f}ms -> {2:.3f}ms"
+                               .format(name, old['p99'], new['p99']))
+    return regressions
+
+
+if __name__ == '__main__':
+    options = dict([tuple(a.split("=")) for a in sys.argv[1:]
+                    if '=' in a])
+    if '--help' in sys.argv:
+        print "usage: {0} [out=bench.json] [baseline=file.json] [current=file.json] [tolerance=0.2] [quick=0|1]".format(sys.argv[0])
+        exit(0)
+    if 'current' in options:
+        current = json.load(open(options['current']))
+    else:
+        current = run(bool(int(options.get('quick', 0))))
+        out = options.get('out', 'bench.json')
+        json.dump(current, open(out, 'w'), indent=1, sort_keys=True)
+        for name, result in sorted(current['benchmarks'].items()):
+            if 'throughput' in result:
+                print "{0:<60} {1:>12.1f}/s  p50 {2:.3f}ms  p99 {3:.3f}ms" \
+                    .format(name, result['throughput'], result['p50'],
+                            result['p99'])
+            else:
+                print "{0:<60} skipped: {1}".format(name, result['skipped'])
+    if 'baseline' in options:
+        regressions = compare(json.load(open(options['baseline'])), current,
+                              float(options.get('tolerance', 0.2)))
+        for r in regressions:
+            print "REGRESSION", r
+        exit(1 if regressions else 0)
@@ -0,0 +1,436 @@
+# Copyright 2014 Miguel Martinez de Aguirre
+# See LICENSE for details.
+
+"""
+A lightweight binary transport for players, alongside Perspective Broker.
+
+Players connected this way log in through the same portal and play the
+same server.GameClient avatars as PB players, in the same rooms; only the
+encoding differs. Every frame is a uint32 length then that many bytes,
+the first of which says what the frame is. All numbers are little endian.
+
+Requests carry a uint32 id, which the server's RESULT or ERROR echoes:
+
+LOGIN    id, then the login name as UTF-8
+MOVE     id, a uint8 which is 0 for a no-op, then int32 x, y of the node
+         and of its parent; the hot path, so no JSON
+CALL     id, then JSON [method, [args...]] for the other perspective
+         methods, e.g. getGameType or setInterest
+IMAGE    id, then a uint64 offset: the server sends the game's image from
+         offset as IMAGE frames of id and a chunk, then a RESULT
+ACK      no payload; answers a TURN as soon as it arrives, so the server
+         can time the round trip
+
+The server pushes the round's cost delta as TURN (startNextTurn) or COSTS
+(updateCosts) frames holding the encoded grid.CostDelta as it is, after a
+float64 of the seconds left to move in TURN's case, and the
+other calls to the mind as JSON [method, [args...]] in a PUSH frame,
+except startGame, whose STARTGAME frame is a uint32 length of JSON
+[start, end, players] followed by the CostDelta, and resumeGame, whose
+RESUMEGAME frame is the same with a uint32 length of the CostDelta
+before it and the encoded paths.PathTree after it.
+
+Each server connection is its transport's streaming producer, so it knows
+when the write buffer is full. Pushes and image chunks wait for it to
+drain, which holds a slow connection's broadcasts in its own bounded
+broadcast.Subscriber queue rather than in an ever growing buffer.
+
+On the client side BinaryClientFactory.login returns a perspective whose
+callRemote turns into these frames and whose pushes are passed to the
+client's remote_ methods, so a PB client class like bot.BotClient can use
+either transport.
+"""
+
+from collections import deque
+import json
+import struct
+
+from twisted.cred import credentials, error
+from twisted.internet import defer, protocol
+from twisted.protocols import basic
+from twisted.python import log
+from twisted.spread import pb
+
+import imagecache
+import logs
+
+# client to server
+LOGIN, MOVE, CALL, IMAGE, ACK = 1, 2, 3, 4, 5
+# server to client
+RESULT, RAW, ERROR, TURN, COSTS, PUSH, STARTGAME = 64, 65, 66, 67, 68, 69, 70
+RESUMEGAME = 71
+
+_id = struct.Struct('<I')
+_move = struct.Struct('<Biiii')
+_offset = struct.Struct('<IQ')
+_deadline = struct.Struct('<d')
+# perspective methods CALL may use
+CALLS = frozenset(['canPlay', 'getGameType', 'getColour', 'getTile',
+                   'message', 'setInterest', 'expandNode', 'watch'])
+CHUNK = 1 << 16
+# (kind, method, args) and frame of the last push encoded
+_lastPush = [None, None]
+
+
+def _push(kind, message, args):
+    """
+    returns: the frame pushing a call to the client
+    A broadcast makes the same call to every connection in turn, so the
+    last frame is kept and reused rather than encoded again.
+    """
+    key = (kind, message, args)
+    if _lastPush[0] != key:
+        if kind == PUSH:
+            frame = chr(PUSH) + json.dumps([message, args])
+        else:
+            frame = chr(kind) + args[0]
+        _lastPush[:] = [key, frame]
+    return _lastPush[1]
+
+
+def _tuples(value):
+    """JSON has no tuples, but nodes and colours are compared as tuples."""
+    if isinstance(value, list):
+        return tuple(_tuples(v) for v in value)
+    return value
+
+
+class BinaryMind(object):
+    """Stands in for a PB client's remote reference on the server."""
+    def __init__(self, protocol):
+        self.protocol = protocol
+        # startNextTurn calls waiting for their ACK, oldest first
+        self.turns = deque()
+
+    def callRemote(self, message, *args):
+        send = self.protocol.sendString
+        if message == 'startNextTurn':
+            costdelta, deadline = args
+            send(chr(TURN) + _deadline.pack(deadline) + costdelta)
+            d = defer.Deferred()
+            self.turns.append(d)
+            return d
+        elif message == 'updateCosts':
+            send(_push(COSTS, message, args))
+        elif message == 'startGame':
+            start, end, players, costdelta = args
+            data = json.dumps([start, end, players])
+            send(chr(STARTGAME) + _id.pack(len(data)) + data + costdelta)
+        elif message == 'resumeGame':
+            start, end, players, costdelta, tree = args
+            data = json.dumps([start, end, players])
+            send(chr(RESUMEGAME) + _id.pack(len(data)) + data +
+                 _id.pack(len(costdelta)) + costdelta + tree)
+        else:
+            send(_push(PUSH, message, args))
+        # answered once the client is keeping up with what has been sent
+        return self.protocol.whenDrained()
+
+
+class ImageSender(object):
+    """Sends the game's image as IMAGE frames, as fast as the client reads."""
+    def __init__(self, protocol, requestID, filename, offset):
+        self.protocol = protocol
+        self.requestID = requestID
+        self.file = imagecache.openImage(filename, offset)
+        self.send()
+
+    def send(self, result=None):
+        while not self.protocol.paused:
+            chunk = self.file.read(CHUNK)
+            if not chunk:
+                self.stop()
+                self.protocol.sendResult(self.requestID, None)
+                return
+            self.protocol.sendString(chr(IMAGE) + _id.pack(self.requestID) +
+                                     chunk)
+        self.protocol.whenDrained().addCallbacks(self.send, self.stop)
+
+    def stop(self, reason=None):
+        self.file.close()
+
+
+class BinaryServerProtocol(basic.Int32StringReceiver):
+    """One player's connection to the server."""
+    avatar = None
+    logout = None
+    mind = None
+    # whether the transport's write buffer is full
+    paused = False
+
+    def connectionMade(self):
+        self.drained = []
+        self.transport.registerProducer(self, True)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        drained, self.drained = self.drained, []
+        for d in drained:
+            d.callback(None)
+
+    def stopProducing(self):
+        pass
+
+    def whenDrained(self):
+        """returns: Deferred firing once the write buffer is not full"""
+        if not self.paused:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self.drained.append(d)
+        return d
+
+    def stringReceived(self, data):
+        try:
+            if not data:
+                raise pb.Error("empty frame")
+            kind = ord(data[0])
+            if kind == MOVE:
+                self._move(data)
+            elif kind == ACK:
+                if self.mind is not None and self.mind.turns:
+                    self.mind.turns.popleft().callback(None)
+            elif self.avatar is None and kind != LOGIN:
+                raise pb.Error("not logged in")
+            elif kind == LOGIN:
+                self._login(data)
+            elif kind == CALL:
+                self._call(data)
+            elif kind == IMAGE:
+                requestID, offset = _offset.unpack_from(data, 1)
+                logs.info("getImage", self.avatar, offset)
+                ImageSender(self, requestID,
+                            self.avatar.server.gameType.image, offset)
+            else:
+                raise pb.Error("unknown frame {0}".format(kind))
+        except (struct.error, ValueError), e:
+            # short frames and undecodable JSON
+            self._badFrame(data, pb.Error("bad frame: {0}".format(e)))
+        except pb.Error, e:
+            self._badFrame(data, e)
+
+    def _badFrame(self, data, exception):
+        requestID, = _id.unpack_from(data, 1) if len(data) >= 5 else (0,)
+        self.sendError(requestID, exception)
+
+    def _move(self, data):
+        move, x, y, px, py = _move.unpack_from(data, 5)
+        if self.avatar is None:
+            raise pb.Error("not logged in")
+        if move:
+            self.avatar.perspective_expandNode((x, y), (px, py))
+        else:
+            self.avatar.perspective_expandNode((), ())
+        self.sendString(chr(RESULT) + data[1:5] + 'null')
+
+    def _login(self, data):
+        requestID, = _id.unpack_from(data, 1)
+        name = data[5:]
+        log.msg(["Binary login", self, name])
+        self.mind = BinaryMind(self)
+        d = self.factory.portal.login(
+            credentials.UsernamePassword(name, ''), self.mind,
+            pb.IPerspective)
+        d.addCallback(self._loggedIn, requestID)
+        d.addErrback(self._failed, requestID)
+
+    def _loggedIn(self, (interface, avatar, logout), requestID):
+        if not self.connected:
+            logout()
+            return
+        self.avatar = avatar
+        self.logout = logout
+        self.sendResult(requestID, None)
+
+    def _call(self, data):
+        requestID, = _id.unpack_from(data, 1)
+        call = json.loads(data[5:])
+        if not (isinstance(call, list) and len(call) == 2 and
+                isinstance(call[0], basestring) and isinstance(call[1], list)):
+            raise pb.Error("bad call")
+        method, args = call
+        if method not in CALLS:
+            raise pb.Error("no such method {0}".format(method))
+        f = getattr(self.avatar, 'perspective_' + method, None)
+        if f is None:
+            raise pb.Error("no such method {0}".format(method))
+        d = defer.maybeDeferred(f, *_tuples(args))
+        d.addCallback(self._called, requestID)
+        d.addErrback(self._failed, requestID)
+
+    def _called(self, result, requestID):
+        if isinstance(result, str):
+            # e.g. getTile's raw colours
+            self.sendString(chr(RAW) + _id.pack(requestID) + result)
+        else:
+            self.sendResult(requestID, result)
+
+    def _failed(self, reason, requestID):
+        if not reason.check(pb.Error, error.LoginFailed):
+            log.err(reason, "binary call failed")
+        self.sendError(requestID, reason.value)
+
+    def sendResult(self, requestID, result):
+        self.sendString(chr(RESULT) + _id.pack(requestID) +
+                        json.dumps(result))
+
+    def sendError(self, requestID, exception):
+        data = json.dumps([exception.__class__.__name__, str(exception)])
+        self.sendString(chr(ERROR) + _id.pack(requestID) + data)
+
+    def connectionLost(self, reason):
+        drained, self.drained = self.drained, []
+        for d in drained:
+            d.errback(pb.PBConnectionLost())
+        if self.mind is not None:
+            # unanswered turns were never timed; nothing waits on them
+            self.mind.turns.clear()
+        if self.logout is not None:
+            logout, self.logout = self.logout, None
+            logout()
+
+
+class BinaryServerFactory(protocol.ServerFactory):
+    protocol = BinaryServerProtocol
+
+    def __init__(self, portal):
+        """portal: the portal PB players log in through"""
+        self.portal = portal
+
+
+class RemoteError(pb.Error):
+    """An error raised by the server, by the name of its class."""
+
+
+class BinaryPerspective(basic.Int32StringReceiver):
+    """
+    The client's end of a connection, standing in for a PB perspective.
+    Pushes from the server call the client's remote_ methods.
+    """
+    # tiles are larger than the default
+    MAX_LENGTH = 1 << 24
+
+    def __init__(self, client):
+        """client: object with PB style remote_ methods, e.g. BotClient"""
+        self.client = client
+        self.nextID = 0
+        self.waiting = {}
+        self.collectors = {}
+        self.disconnected = []
+
+    def connectionMade(self):
+        self.factory.connected.callback(self)
+
+    def _request(self, kind, payload, collector=None):
+        self.nextID += 1
+        d = self.waiting[self.nextID] = defer.Deferred()
+        if collector is not None:
+            self.collectors[self.nextID] = collector
+        self.sendString(chr(kind) + _id.pack(self.nextID) + payload)
+        return d
+
+    def login(self, name):
+        return self._request(LOGIN, name)
+
+    def callRemote(self, method, *args):
+        if method == 'expandNode':
+            node, parent = args
+            if node == ():
+                return self._request(MOVE, _move.pack(0, 0, 0, 0, 0))
+            return self._request(MOVE, _move.pack(1, node[0], node[1],
+                                                  parent[0], parent[1]))
+        if method == 'getImage':
+            collector, offset = args
+            return self._request(IMAGE, struct.pack('<Q', offset), collector)
+        return self._request(CALL, json.dumps([method, args]))
+
+    def notifyOnDisconnect(self, callback):
+        self.disconnected.append(callback)
+
+    def dontNotifyOnDisconnect(self, callback):
+        self.disconnected.remove(callback)
+
+    def stringReceived(self, data):
+        kind = ord(data[0])
+        if kind == TURN:
+            self.sendString(chr(ACK))
+            deadline, = _deadline.unpack_from(data, 1)
+            self.client.remote_startNextTurn(data[1 + _deadline.size:],
+                                             deadline)
+        elif kind == COSTS:
+            self.client.remote_updateCosts(data[1:])
+        elif kind == PUSH:
+            method, args = json.loads(data[1:])
+            getattr(self.client, 'remote_' + method)(*_tuples(args))
+        elif kind == STARTGAME:
+            length, = _id.unpack_from(data, 1)
+            start, end, players = _tuples(json.loads(data[5:5 + length]))
+            self.client.remote_startGame(start, end, players,
+                                         data[5 + length:])
+        elif kind == RESUMEGAME:
+            length, = _id.unpack_from(data, 1)
+            start, end, players = _tuples(json.loads(data[5:5 + length]))
+            offset = 5 + length
+            size, = _id.unpack_from(data, offset)
+            costdelta = data[offset + 4:offset + 4 + size]
+            self.client.remote_resumeGame(start, end, players, costdelta,
+                                          data[offset + 4 + size:])
+        else:
+            requestID, = _id.unpack_from(data, 1)
+            self._answer(kind, requestID, data[5:])
+
+    def _answer(self, kind, requestID, payload):
+        if kind == IMAGE:
+            self.collectors[requestID].remote_gotPage(payload)
+            return
+        d = self.waiting.pop(requestID)
+        collector = self.collectors.pop(requestID, None)
+        if kind == RESULT:
+            if collector is not None:
+                collector.remote_endedPaging()
+            d.callback(_tuples(json.loads(payload)))
+        elif kind == RAW:
+            d.callback(payload)
+        else:
+            name, message = json.loads(payload)
+            d.errback(RemoteError(name, message))
+
+    def connectionLost(self, reason):
+        waiting, self.waiting = self.waiting, {}
+        for d in waiting.values():
+            d.errback(pb.PBConnectionLost())
+        for callback in list(self.disconnected):
+            callback(self)
+
+
+class BinaryClientFactory(protocol.ClientFactory):
+    """Connects and logs in, like pb.PBClientFactory."""
+    client = None
+
+    def __init__(self):
+        self.perspective = None
+        self.connected = defer.Deferred()
+
+    def buildProtocol(self, addr):
+        self.perspective = BinaryPerspective(self.client)
+        self.perspective.factory = self
+        return self.perspective
+
+    def clientConnectionFailed(self, connector, reason):
+        self.connected.errback(reason)
+
+    def login(self, name, client):
+        """
+        client: object with remote_ methods for the server's pushes
+        returns: Deferred firing with a BinaryPerspective once logged in
+        """
+        self.client = client
+        d = self.connected
+        d.addCallback(lambda p: p.login(name).addCallback(lambda _: p))
+        return d
+
+    def disconnect(self):
+        if self.perspective is not None and self.perspective.transport:
+            self.perspective.transport.loseConnection()
@@ -0,0 +1,108 @@
+# Copyright 2014 Miguel Martinez de Aguirre
+# See LICENSE for details.
+
+"""
+Local cache of what is worked out from each board image, for fast starts.
+
+Decoding an image takes far longer than reading its pixels back, and the
+same few images are played again and again. Under a directory for each
+VERSION the cache keeps:
+
+boards/HASH.npy         the decoded colours, by the image's hash
+topology/WxH-dD.npy     util.Topology neighbour tables
+
+The tables only depend on the board's size and whether diagonals are
+allowed, so images of the same size share them. The planners' distance
+fields are as big as the board and there is one for every goal, so they
+are only kept in memory, for the few goals most recently asked for.
+Everything on disk is memory-mapped when loaded; boards copy on write, so
+a game changes its own pixels and not the cache's. Entries are written
+under a temporary name and renamed into place, so another process never
+reads half of one.
+Bump VERSION whenever what is stored changes.
+"""
+
+from collections import OrderedDict
+import os
+import tempfile
+
+import numpy as np
+from twisted.python import log
+
+from grid import CostGrid
+import imagecache
+import planner
+import tiles
+import util
+
+VERSION = 1
+
+
+class BoardCache(object):
+    """Versioned store of decoded boards and their tables."""
+    # distance fields kept in memory
+    fieldCacheSize = 16
+
+    def __init__(self, directory=None):
+        """directory: where to keep entries, ~/.path-game/boards if None"""
+        if directory is None:
+            directory = os.path.join(os.path.expanduser('~'), '.path-game',
+                                     'boards')
+        log.msg(["BoardCache.__init__", self, directory])
+        self.directory = os.path.join(directory, str(VERSION))
+        # (size, diagonals, goal, turnCost) -> distance field, oldest first
+        self.fields = OrderedDict()
+
+    def grid(self, filename, tiled=False):
+        """
+        tiled: whether filename is a tiled board rather than an image
+        returns: a CostGrid of the board in filename
+        Tiled boards are memory-mapped already, so they are not cached.
+        """
+        if tiled:
+            return tiles.TiledGrid.fromFile(filename)
+        path = self._path('boards', imagecache.fileHash(filename))
+        if not os.path.exists(path):
+            log.msg(["Decoding board", self, filename])
+            self._save(path, CostGrid.fromFile(filename).data)
+        return CostGrid(np.load(path, mmap_mode='c'))
+
+    def topology(self, size, diagonals):
+        """returns: the shared util.Topology, with its neighbour table"""
+        topology = util.getTopology(size, diagonals)
+        if topology.table is None:
+            name = '{0}x{1}-d{2:d}'.format(size[0], size[1], bool(diagonals))
+            path = self._path('topology', name)
+            if not os.path.exists(path):
+                pixels = np.arange(size[0] * size[1], dtype=np.intp)
+                self._save(path, topology.neighbours(pixels).astype('<i4'))
+            topology.table = np.load(path, mmap_mode='r')
+        return topology
+
+    def distances(self, size, diagonals, goal, turnCost):
+        """returns: planner.distanceField of the goal's flat index"""
+        key = (tuple(size), bool(diagonals), goal, turnCost)
+        field = self.fields.pop(key, None)
+        if field is None:
+            field = planner.distanceField(size, diagonals, goal, turnCost)
+            if len(self.fields) >= self.fieldCacheSize:
+                self.fields.popitem(last=False)
+        self.fields[key] = field
+        return field
+
+    def _path(self, kind, name):
+        return os.path.join(self.directory, kind, name + '.npy')
+
+    def _save(self, path, array):
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # made by another process in the meantime
+                if not os.path.isdir(directory):
+                    raise
+        fd, temporary = tempfile.mkstemp('.npy', '', directory)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, array)
+        os.rename(temporary, path)
@@ -0,0 +1,329 @@
+#! /usr/bin/env python
+
+# Copyright 2014 Miguel Martinez de Aguirre
+# See LICENSE for details.
+
+from collections import deque
+import sys
+import time
+
+from twisted.cred import credentials
+from twisted.internet import defer, reactor
+from twisted.python import log
+from twisted.spread import pb
+
+import binary
+import boardcache
+import grid
+import imagecache
+import logs
+import paths
+import planner
+from server import GameType
+
+
+class BotPlayer(object):
+    """
+    Plays one game without a user: keeps its own copy of the board, plans
+    with a planner strategy and picks a move each turn.
+    """
+    # share of the turn spent planning, the rest is left for the move to
+    # reach the server; None plans without a deadline
+    thinkFraction = 0.5
+
+    def __init__(self, gameType, costs, strategy='astar', boards=None):
+        """
+        gameType: the server.GameType being played
+        costs: grid.CostGrid of the board
+        strategy: one of planner.strategies
+        boards: boardcache.BoardCache for the planner's tables, if any
+        """
+        log.msg(["BotPlayer.__init__", self, strategy])
+        self.gameType = gameType
+        self.costs = costs
+        self.planner = planner.makePlanner(strategy, costs,
+                                           gameType.diagonals, boards)
+        self.topology = self.planner.topology
+
+    def startGame(self, start, end):
+        log.msg(["BotPlayer.startGame", self, start, end])
+        self.visited = paths.PathTree(self.costs.size, start)
+        self.head = self.topology.index(start)
+        self.goal = self.topology.index(end)
+        self.plan = []
+        self.step = 0
+
+    def resumeGame(self, start, end, tree):
+        """
+        Carry on a game after reconnecting, from whichever visited node is
+        closest to the end.
+        tree: string encoding the paths.PathTree of nodes visited so far
+        """
+        log.msg(["BotPlayer.resumeGame", self, start, end])
+        self.startGame(start, end)
+        self.visited = paths.PathTree.decode(self.costs.size, start, tree)
+        indices = self.visited.toArrays()[0]
+        distances = self.planner.distances(self.goal)[indices]
+        self.head = int(indices[distances.argmin()])
+
+    def applyCostDelta(self, costdelta):
+        """costdelta: string encoding a grid.CostDelta"""
+        delta = grid.CostDelta.decode(costdelta)
+        self.costs.applyDelta(delta)
+        changed = delta.indices.tolist()
+        self.planner.update(changed)
+        if not self.planner.incremental and \
+                set(changed).intersection(self.plan[self.step:]):
+            # replan next turn
+            self.plan = []
+
+    def turnDeadline(self, budget=None, start=None):
+        """
+        budget: seconds the server gave for the turn, or None for the
+                game's timeout
+        start: time.time() the turn arrived, now if None
+        returns: time.time() to stop planning by, None for no limit
+        """
+        if self.thinkFraction is None:
+            return None
+        if budget is None:
+            budget = self.gameType.timeout / 1000.0
+        if start is None:
+            start = time.time()
+        return start + budget * self.thinkFraction
+
+    def chooseMove(self, deadline=None):
+        """
+        deadline: time.time() to stop planning by, None for no limit
+        returns: (node, parent) to expand this turn, or ((), ()) to pass
+        """
+        if self.head == self.goal:
+            return (), ()
+        if self.planner.incremental or self.step + 1 >= len(self.plan):
+            self.plan = self.planner.plan(self.head, self.goal, deadline,
+                                          self.visited)
+            self.step = 0
+            logs.debug("planned", self, len(self.plan),
+                       self.planner.expanded)
+            if len(self.plan) < 2:
+                # boxed in: carry on from another node of the tree
+                self.plan = self.planner.branch(self.goal, self.visited)
+            if len(self.plan) < 2:
+                log.msg(["No move found", self])
+                return (), ()
+        self.step += 1
+        parent = self.topology.node(self.plan[self.step - 1])
+        self.head = self.plan[self.step]
+        node = self.topology.node(self.head)
+        self.visited[node] = parent
+        # the node cannot be stepped on again
+        self.planner.update([self.head])
+        return node, parent
+
+
+class PlanningQueue(object):
+    """
+    Takes turns planning for the bots of one process. They all plan on the
+    one reactor, so each gets a share of the time left before its turn's
+    deadline rather than planning as if it were alone.
+    """
+    def __init__(self):
+        # (deadline, function) waiting to plan, in order of arrival
+        self.waiting = deque()
+        self.scheduled = False
+
+    def add(self, deadline, f):
+        """
+        deadline: time.time() the turn's planning must end by, or None
+        f: called with the deadline of its share
+        """
+        self.waiting.append((deadline, f))
+        if not self.scheduled:
+            self.scheduled = True
+            reactor.callLater(0, self._next)
+
+    def _next(self):
+        deadline, f = self.waiting.popleft()
+        if self.waiting:
+            reactor.callLater(0, self._next)
+        else:
+            self.scheduled = False
+        if deadline is not None:
+            # split what is left evenly with the bots still waiting
+            now = time.time()
+            deadline = now + max(deadline - now, 0) / (len(self.waiting) + 1)
+        f(deadline)
+
+
+class BotClient(pb.Referenceable):
+    """Headless game client which plays through a BotPlayer."""
+    perspective = None
+
+    def __init__(self, name, strategy='astar', images=None, boards=None,
+                 planning=None):
+        """
+        images: imagecache.ImageCache to fetch the board with
+        boards: boardcache.BoardCache to decode it through
+        planning: PlanningQueue shared with the process's other bots
+        """
+        log.msg(["BotClient.__init__", self, name, strategy])
+        self.name = name
+        self.strategy = strategy
+        self.images = images or imagecache.ImageCache()
+        self.boards = boards or boardcache.BoardCache()
+        self.planning = planning or PlanningQueue()
+        # game messages wait on this until the game type is known
+        self.ready = defer.Deferred()
+        self.done = defer.Deferred()
+
+    def connect(self, address="localhost", port=8181, transport='pb'):
+        """transport: 'pb', or 'binary' for a server's binary.py port"""
+        log.msg(["connect", self, address, port, transport])
+        if transport == 'binary':
+            self.factory = binary.BinaryClientFactory()
+            reactor.connectTCP(address, int(port), self.factory)
+            d = self.factory.login(self.name, self)
+        else:
+            self.factory = pb.PBClientFactory()
+            reactor.connectTCP(address, int(port), self.factory)
+            d = self.factory.login(
+                credentials.UsernamePassword(self.name, ''), client=self)
+        d.addCallback(self._connected)
+        d.addErrback(self._failed)
+        return self.done
+
+    def _connected(self, perspective):
+        log.msg(["Connected with name: " + self.name, self, perspective])
+        self.perspective = perspective
+        d = perspective.callRemote("canPlay")
+        d.addCallback(self._setCanPlay)
+        d.addErrback(self._failed)
+
+    def _setCanPlay(self, canPlay):
+        log.msg(["setCanPlay", self, canPlay])
+        if not canPlay:
+            log.msg("Game already started. Bots do not chat.")
+            self.shutdown()
+            return
+        d = self.perspective.callRemote("getGameType")
+        d.addCallback(self._setGameType)
+        d.addErrback(self._failed)
+
+    def _setGameType(self, gameType):
+        log.msg(["_setGameType", self, repr(gameType)[:100]])
+        self.gameType = GameType(None)
+        self.gameType.fromDictionary(gameType)
+        if not self.gameType.automated:
+            log.msg("Server does not allow automated clients.")
+            self.shutdown()
+            return
+        if self.gameType.tiled:
+            # planners keep arrays the size of the whole board
+            log.msg("Bots do not play tiled boards.")
+            self.shutdown()
+            return
+        d = self.images.get(self.perspective, self.gameType.imageHash,
+                            self.gameType.imageLength)
+        d.addCallback(self._setImage)
+        d.addErrback(self._failed)
+
+    def _setImage(self, filename):
+        costs = self.boards.grid(filename, self.gameType.tiled)
+        self.player = BotPlayer(self.gameType, costs, self.strategy,
+                                self.boards)
+        self.ready.callback(None)
+
+    def _whenReady(self, f, *args):
+        def call(result):
+            f(*args)
+            return result
+        self.ready.addCallback(call)
+        self.ready.addErrback(self._errored)
+
+    def remote_print(self, message, colour):
+        logs.debug("print", self, message, colour)
+
+    def remote_startGame(self, start, end, players, costdelta):
+        # costdelta only marks where players start; it is not on the board
+        log.msg(["startGame", self, start, end, players])
+        self._whenReady(self._startGame, start, end, time.time())
+
+    def remote_resumeGame(self, start, end, players, costdelta, tree):
+        log.msg(["resumeGame", self, start, end, players])
+        self._whenReady(self._resumeGame, start, end, costdelta, tree)
+
+    def remote_startNextTurn(self, costdelta, deadline=None):
+        # answer first, so the server times the round trip, not our planning
+        reactor.callLater(0, self._whenReady, self._startNextTurn, costdelta,
+                          deadline, time.time())
+
+    def remote_updateCosts(self, costdelta):
+        self._whenReady(self._updateCosts, costdelta)
+
+    def _startGame(self, start, end, started):
+        self.player.startGame(start, end)
+        self.planning.add(self.player.turnDeadline(None, started), self._move)
+
+    def _resumeGame(self, start, end, costdelta, tree):
+        self.player.resumeGame(start, end, tree)
+        self.player.applyCostDelta(costdelta)
+
+    def _startNextTurn(self, costdelta, budget, started):
+        self.player.applyCostDelta(costdelta)
+        self.planning.add(self.player.turnDeadline(budget, started),
+                          self._move)
+
+    def _updateCosts(self, costdelta):
+        self.player.applyCostDelta(costdelta)
+
+    def remote_win(self, scores):
+        log.msg(["win", self, scores])
+        self.shutdown(scores)
+
+    def remote_gameOver(self, scores):
+        log.msg(["gameOver", self, scores])
+        self.shutdown(scores)
+
+    def _move(self, deadline):
+        node, parent = self.player.chooseMove(deadline)
+        d = self.perspective.callRemote("expandNode", node, parent)
+        d.addErrback(self._errored)
+
+    def shutdown(self, result=None):
+        log.msg(["shutdown", self])
+        self.factory.disconnect()
+        if not self.done.called:
+            self.done.callback(result)
+
+    def _failed(self, reason):
+        self._errored(reason)
+        self.shutdown()
+
+    def _errored(self, reason):
+        log.err(reason, self)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] == "--help":
+        print "usage: {0} name [address [port]] [strategy=astar|dijkstra|dstar|greedy] [count=1] [transport=pb|binary] [log=debug|info|warning] [sample=category:rate,...]".format(sys.argv[0])
+        exit(0)
+    log.startLogging(sys.stdout, setStdout=False)
+    args = [a for a in sys.argv[2:] if '=' not in a]
+    options = dict([tuple(a.split("=")) for a in sys.argv[2:] if '=' in a])
+    logs.configure(options.get('log', 'info'), options.get('sample', ''))
+    count = int(options.get('count', 1))
+    strategy = options.get('strategy', 'astar')
+    transport = options.get('transport', 'pb')
+    if count == 1:
+        names = [sys.argv[1]]
+    else:
+        names = ['{0}{1}'.format(sys.argv[1], i) for i in xrange(count)]
+    images = imagecache.ImageCache()
+    boards = boardcache.BoardCache()
+    planning = PlanningQueue()
+    clients = [BotClient(name, strategy, images, boards, planning)
+               for name in names]
+    d = defer.DeferredList([c.connect(*args, transport=transport)
+                            for c in clients])
+    d.addCallback(lambda _: reactor.stop())
+    reactor.run()
@@ -0,0 +1,215 @@
+# Copyright 2014 Miguel Martinez de Aguirre
+# See LICENSE for details.
+
+"""
+Fan-out of chat and board changes to everyone in a room.
+
+Every connection has a Subscriber with its own queue, and at most one
+call in flight: the next is only sent once the client has answered the
+last, so a slow connection holds up nobody but itself. Queues are
+bounded. When a connection falls behind, the oldest chat lines are
+dropped and the board changes waiting for it are merged into one delta,
+so it skips frames rather than lagging further.
+
+Spectators watch the board at a frame rate of their choosing: the
+changes of each frame are merged and encoded once for everyone watching
+at that rate. Chat is rate limited per sender.
+"""
+
+from collections import deque
+
+from twisted.internet import defer, task
+from twisted.python import log
+from twisted.spread import pb
+
+from grid import CostDelta
+import logs
+import metrics
+
+
+class RateLimiter(object):
+    """Token bucket per key: burst messages at once, then rate a second."""
+    def __init__(self, rate, burst, clock):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        # key -> (tokens, when they were counted)
+        self.buckets = {}
+
+    def allow(self, key):
+        """returns: whether key may send a message now"""
+        now = self.clock.seconds()
+        tokens, then = self.buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - then) * self.rate)
+        allowed = tokens >= 1
+        self.buckets[key] = (tokens - 1 if allowed else tokens, now)
+        return allowed
+
+    def forget(self, key):
+        self.buckets.pop(key, None)
+
+
+class Subscriber(object):
+    """One connection's queue of broadcasts."""
+    def __init__(self, remote, queueSize):
+        """remote: the client's remote reference"""
+        self.remote = remote
+        self.queueSize = queueSize
+        self.chat = deque()
+        # (CostDelta, its encoding or None) waiting to be sent
+        self.costs = None
+        self.busy = False
+
+    def say(self, message, colour):
+        if len(self.chat) >= self.queueSize:
+            self.chat.popleft()
+            metrics.registry.counter('broadcast_dropped_total',
+                                     'Chat lines dropped for slow clients'
+                                     ).inc()
+        self.chat.append((message, colour))
+        self._send()
+
+    def update(self, delta, encoded):
+        """encoded: delta.encode(), shared by every subscriber"""
+        if self.costs is not None:
+            metrics.registry.counter('broadcast_coalesced_total',
+                                     'Board updates merged for slow clients'
+                                     ).inc()
+            delta, encoded = self.costs[0].then(delta), None
+        self.costs = (delta, encoded)
+        self._send()
+
+    def close(self):
+        self.remote = None
+        self.chat.clear()
+        self.costs = None
+
+    def _send(self):
+        if self.busy or self.remote is None:
+            return
+        if self.chat:
+            message, args = "print", self.chat.popleft()
+        elif self.costs is not None:
+            delta, encoded = self.costs
+            self.costs = None
+            message, args = "updateCosts", (encoded or delta.encode(),)
+        else:
+            return
+        self.busy = True
+        d = defer.maybeDeferred(self.remote.callRemote, message, *args)
+        d.addCallbacks(self._sent, self._failed)
+
+    def _sent(self, result):
+        self.busy = False
+        self._send()
+
+    def _failed(self, reason):
+        if reason.check(pb.PBConnectionLost, pb.DeadReferenceError):
+            self.close()
+            return
+        log.err(reason, "broadcast failed")
+        self._sent(None)
+
+
+class Frames(object):
+    """Board changes for the spectators watching at one frame rate."""
+    def __init__(self, fps, clock):
+        self.subscribers = set()
+        self.pending = CostDelta([], [])
+        self.loop = task.LoopingCall(self.send)
+        self.loop.clock = clock
+        self.loop.start(1.0 / fps, now=False)
+
+    def add(self, delta):
+        self.pending = self.pending.then(delta)
+
+    def send(self):
+        if not len(self.pending):
+            return
+        delta, self.pending = self.pending, CostDelta([], [])
+        encoded = delta.encode()
+        for subscriber in self.subscribers:
+            subscriber.update(delta, encoded)
+
+    def stop(self):
+        self.loop.stop()
+
+
+class Broadcaster(object):
+    """Sends one room's chat and board changes to its connections."""
+    # broadcasts queued for each connection
+    queueSize = 64
+    # fastest frame rate spectators may watch at
+    maxFps = 10
+    # chat lines each sender may send a second, and at once
+    chatRate = 1.0
+    chatBurst = 5
+
+    def __init__(self, clock=None):
+        """clock: IReactorTime for frames and chat, the reactor if None"""
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        # client -> Subscriber
+        self.subscribers = {}
+        # client -> frame rate it watches at
+        self.watching = {}
+        # frame rate -> Frames
+        self.frames = {}
+        self.limiter = RateLimiter(self.chatRate, self.chatBurst, clock)
+
+    def add(self, client):
+        """client: a server.ChatClient which has just attached"""
+        self.subscribers[client] = Subscriber(client.remote, self.queueSize)
+
+    def remove(self, client):
+        self.unwatch(client)
+        self.limiter.forget(client.name)
+        subscriber = self.subscribers.pop(client, None)
+        if subscriber is not None:
+            subscriber.close()
+
+    def allowChat(self, name):
+        """returns: whether name may chat now"""
+        if self.limiter.allow(name):
+            return True
+        metrics.registry.counter('chat_limited_total',
+                                 'Chat lines refused for flooding').inc()
+        return False
+
+    def chat(self, message, colour):
+        logs.debug("chat", self, message, colour)
+        for subscriber in self.subscribers.values():
+            subscriber.say(message, colour)
+
+    def watch(self, client, fps, catchUp):
+        """
+        Send client the board's changes at most fps times a second.
+        catchUp: CostDelta of every pixel changed so far, sent first
+        """
+        logs.info("watch", self, client, fps)
+        self.unwatch(client)
+        fps = min(float(fps), self.maxFps)
+        frames = self.frames.get(fps)
+        if frames is None:
+            frames = self.frames[fps] = Frames(fps, self.clock)
+        subscriber = self.subscribers[client]
+        frames.subscribers.add(subscriber)
+        self.watching[client] = fps
+        if len(catchUp):
+            subscriber.update(catchUp, catchUp.encode())
+
+    def unwatch(self, client):
+        fps = self.watching.pop(client, None)
+        if fps is None:
+            return
+        frames = self.frames[fps]
+        frames.subscribers.discard(self.subscribers[client])
+        if not frames.subscribers:
+            frames.stop()
+            del self.frames[fps]
+
+    def frame(self, delta):
+        """Note a round's CostDelta for the spectators' next frames."""
+        for frames in self.frames.values():
+            frames.add(delta)
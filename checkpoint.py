@@ -0,0 +1,203 @@
+# Copyright 2014 Miguel Martinez de Aguirre
+# See LICENSE for details.
+
+"""
+Checkpoints of games in progress, so that they survive a restart.
+
+Each game is checkpointed to a directory of its own. The board is saved a
+tile at a time, and each checkpoint only writes the tiles changed since
+the one before, along with the players' search trees, round and scores.
+A checkpoint is collected on the reactor thread, which only copies
+arrays, then written by a worker thread while rounds carry on. The
+manifest, checkpoint.json, is replaced last, so a crash part way through
+leaves the previous checkpoint intact.
+"""
+
+import json
+import os
+
+import numpy as np
+from twisted.internet import threads
+from twisted.python import log
+
+from grid import CostDelta
+import paths
+import tiles
+
+MANIFEST = 'checkpoint.json'
+
+
+class Checkpointer(object):
+    """Writes checkpoints of one server.Server's game."""
+    def __init__(self, server, directory, interval=50):
+        """
+        directory: where to keep the game's checkpoint
+        interval: rounds between checkpoints
+        """
+        log.msg(["Checkpointer.__init__", self, directory, interval])
+        self.server = server
+        self.directory = directory
+        self.interval = interval
+        self.dirty = tiles.tileMask(server.imageSize)
+        # (tx, ty) -> filename of the tile's latest saved copy
+        self.tiles = {}
+        self.generation = 0
+        self.writing = None
+
+    def record(self, delta):
+        """Note the tiles a grid.CostDelta changed."""
+        tiles.markTiles(self.dirty, delta.indices, self.server.imageSize[0])
+
+    def roundDone(self, number):
+        """Checkpoint every interval rounds, unless still writing the last."""
+        if number % self.interval == 0 and self.writing is None:
+            self.save()
+
+    def save(self):
+        """returns: Deferred firing once the checkpoint is written"""
+        state, dirty = self._collect()
+        self.writing = threads.deferToThread(self._write, state)
+        self.writing.addErrback(self._failed, dirty)
+        self.writing.addBoth(self._written)
+        return self.writing
+
+    def saveNow(self):
+        """
+        Write a checkpoint on the calling thread, e.g. when stopping.
+        If one is already being written that one is kept instead.
+        """
+        if self.writing is None:
+            self._write(self._collect()[0])
+
+    def remove(self):
+        """Delete the checkpoint, once the game has finished."""
+        log.msg(["Checkpointer.remove", self, self.directory])
+        if self.writing is not None:
+            self.writing.addCallback(lambda _: self.remove())
+            return
+        if not os.path.isdir(self.directory):
+            return
+        # only the files written here, whatever else is in the directory
+        names = set(self.tiles.values())
+        manifest = self._manifest()
+        if manifest is not None:
+            names.update(name for tx, ty, name in manifest['tiles'])
+            names.add(manifest['paths'])
+        names.update([MANIFEST, MANIFEST + '.new'])
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if os.path.exists(path):
+                os.remove(path)
+        if not os.listdir(self.directory):
+            os.rmdir(self.directory)
+
+    def _collect(self):
+        server = self.server
+        self.generation += 1
+        dirty = self.dirty
+        self.dirty = tiles.tileMask(server.imageSize)
+        changed = []
+        for ty, tx in np.argwhere(dirty).tolist():
+            x0, y0, x1, y1 = tiles.tileBounds(server.imageSize, tx, ty)
+            changed.append(((tx, ty), server.costs.data[y0:y1, x0:x1].copy()))
+        players = []
+        trees = {}
+        for p in server.players:
+            players.append({'name': p.name, 'colour': p.colour,
+                            'start': p.start, 'end': p.end,
+                            'finished': p.finished,
+                            'score': getattr(p, 'score', None)})
+            indices, parents = p.visited.toArrays()
+            trees['indices{0}'.format(p.number)] = indices
+            trees['parents{0}'.format(p.number)] = parents
+        if server.journal is not None:
+            # a resumed game's journal carries on from this round
+            server.journal.flush()
+        manifest = {'imageHash': server.gameType.imageHash,
+                    'turns': server.played, 'players': players,
+                    'generation': self.generation,
+                    'journal': server.journalName}
+        return (manifest, changed, trees), dirty
+
+    def _write(self, state):
+        """Runs in a worker thread."""
+        manifest, changed, trees = state
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        generation = manifest['generation']
+        superseded = []
+        for (tx, ty), tile in changed:
+            name = 'tile-{0}-{1}-{2}.npy'.format(tx, ty, generation)
+            np.save(os.path.join(self.directory, name), tile)
+            if (tx, ty) in self.tiles:
+                superseded.append(self.tiles[tx, ty])
+            self.tiles[tx, ty] = name
+        name = 'paths-{0}.npz'.format(generation)
+        np.savez(os.path.join(self.directory, name), **trees)
+        manifest['paths'] = name
+        manifest['tiles'] = [[tx, ty, f] for (tx, ty), f in
+                             sorted(self.tiles.items())]
+        temporary = os.path.join(self.directory, MANIFEST + '.new')
+        with open(temporary, 'w') as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        old = self._manifest()
+        os.rename(temporary, os.path.join(self.directory, MANIFEST))
+        if old is not None:
+            superseded.append(old['paths'])
+        for name in superseded:
+            os.remove(os.path.join(self.directory, name))
+
+    def _manifest(self):
+        try:
+            with open(os.path.join(self.directory, MANIFEST)) as f:
+                return json.load(f)
+        except IOError:
+            return None
+
+    def _failed(self, reason, dirty):
+        log.err(reason, "Checkpoint failed")
+        # save the tiles again next time
+        self.dirty |= dirty
+
+    def _written(self, result):
+        self.writing = None
+
+    def resumed(self, manifest):
+        """Carry on from a checkpoint returned by load."""
+        self.generation = manifest['generation']
+        self.tiles = dict(((tx, ty), f) for tx, ty, f in manifest['tiles'])
+
+
+def exists(directory):
+    return os.path.exists(os.path.join(directory, MANIFEST))
+
+
+def load(directory, size):
+    """
+    Read the checkpoint in directory, of a board of size.
+    returns: the manifest, with the saved tiles as 'board':
+             [((tx, ty), array), ...] and each player given a 'visited'
+             paths.PathTree
+    """
+    with open(os.path.join(directory, MANIFEST)) as f:
+        manifest = json.load(f)
+    manifest['board'] = [((tx, ty), np.load(os.path.join(directory, name)))
+                         for tx, ty, name in manifest['tiles']]
+    trees = np.load(os.path.join(directory, manifest['paths']))
+    for number, p in enumerate(manifest['players']):
+        p['name'] = p['name'].encode('utf-8')
+        p['start'], p['end'] = tuple(p['start']), tuple(p['end'])
+        p['colour'] = tuple(p['colour'])
+        p['visited'] = paths.PathTree.fromArrays(
+            size, p['start'], trees['indices{0}'.format(number)],
+            trees['parents{0}'.format(number)])
+    return manifest
+
+
+def tileDelta(costs, tx, ty, tile):
+    """returns: CostDelta taking the costs grid's tile to the saved tile"""
+    x0, y0, x1, y1 = tiles.tileBounds(costs.size, tx, ty)
+    ys, xs = np.nonzero((costs.data[y0:y1, x0:x1] != tile).any(axis=2))
+    return CostDelta((ys + y0) * costs.size[0] + xs + x0, tile[ys, xs])
@@ -3,28 +3,35 @@
 # Copyright 2014 Miguel Martinez de Aguirre
 # See LICENSE for details
 
-from StringIO import StringIO
 import sys
 
+import numpy as np
 from PIL import Image, ImageTk
 import Tkinter
 from tkSimpleDialog import Dialog
 
 from twisted.cred import credentials
-from twisted.internet import reactor, tksupport
+from twisted.internet import defer, reactor, tksupport
 from twisted.protocols import basic
 from twisted.python import log
 from twisted.spread import pb
 
+import boardcache
 import error
+import grid
+import imagecache
+import logs
+import paths
 from server import GameType
+import tiles
 import util
 
-VERSION = 2
+VERSION = 9
 
 
 class GameClient(pb.Referenceable):
-    visited = set()
+    board = None
+    tiles = None
     repl = {'xander': 'Xandy Pandy',
             'alargeasteroid': 'A Large Asteroid',
             'moon': 'MooN'}
@@ -32,6 +39,10 @@ class GameClient(pb.Referenceable):
     def __init__(self, address="localhost", port=8181):
         log.msg(["GameClient.__init__", self, address, port])
         self.factory = pb.PBClientFactory()
+        self.images = imagecache.ImageCache()
+        self.boards = boardcache.BoardCache()
+        # game messages wait on this until the image has been fetched
+        self.ready = defer.Deferred()
         self.root = Tkinter.Tk()
         self.root.protocol("WM_DELETE_WINDOW", self.shutdown)
         tksupport.install(self.root)
@@ -39,10 +50,16 @@ class GameClient(pb.Referenceable):
 
     def sendMessage(self, message):
         d = self.perspective.callRemote("message", message)
+        d.addErrback(self._chatRefused)
         d.addErrback(self._errored)
 
+    def _chatRefused(self, failure):
+        failure.trap(error.ChatFlood)
+        self.chatui.printMessage("Too many messages; that one was not sent.",
+                                 (0, 0, 0))
+
     def remote_print(self, message, colour):
-        log.msg(["print", self, message, colour])
+        logs.debug("print", self, message, colour)
         self.chatui.printMessage(message, colour)
 
     def remote_win(self, scores):
@@ -55,53 +72,111 @@ class GameClient(pb.Referenceable):
         print scores
         self.gameui.setActive(False)
 
+    def _whenReady(self, f, *args):
+        def call(result):
+            f(*args)
+            return result
+        self.ready.addCallback(call)
+        self.ready.addErrback(self._errored)
+
     def remote_startGame(self, start, end, players, costdelta):
         """
         start: (x, y) start coordinate
         end: (x, y) aim coordinate
         players: [(name, colour), ...]
-        costdelta: [(coordinate, colour), ...]
+        costdelta: string encoding a grid.CostDelta of the start points
         """
-        log.msg(["startGame", start, end, players, costdelta])
+        logs.info("startGame", start, end, players)
+        self._whenReady(self._startGame, start, end, players, costdelta)
+
+    def _startGame(self, start, end, players, costdelta):
         self.start = start
         self.end = end
         self.players = players
-        self.visited.add(start)
+        self.visited = paths.PathTree(self.childMaker.size, start)
         # TODO: notify user of start
-        self.remote_startNextTurn(costdelta)
+        self._startNextTurn(costdelta)
+
+    def remote_resumeGame(self, start, end, players, costdelta, tree):
+        """
+        Carry on a game after reconnecting. startNextTurn follows once the
+        server expects a move.
+        costdelta: string encoding a grid.CostDelta of every pixel changed
+        tree: string encoding the paths.PathTree of nodes visited so far
+        """
+        logs.info("resumeGame", start, end, players)
+        self._whenReady(self._resumeGame, start, end, players, costdelta,
+                        tree)
+
+    def _resumeGame(self, start, end, players, costdelta, tree):
+        self.start = start
+        self.end = end
+        self.players = players
+        self.visited = paths.PathTree.decode(self.childMaker.size, start,
+                                             tree)
+        self._applyCostDelta(costdelta)
 
-    def remote_startNextTurn(self, costdelta):
-        log.msg(["startNextTurn", self, costdelta])
-        t = self.gameType.timeout / 1000.0
+    def remote_startNextTurn(self, costdelta, deadline=None):
+        """deadline: seconds the server allows for choosing a move"""
+        logs.debug("startNextTurn", self, len(costdelta), deadline)
+        self._whenReady(self._startNextTurn, costdelta, deadline)
+
+    def _startNextTurn(self, costdelta, deadline=None):
+        t = self.gameType.timeout / 1000.0 if deadline is None else deadline
         self.later = reactor.callLater(t, self._finishTurn)
-        self.gameui.applyCostDelta(costdelta)
+        self._applyCostDelta(costdelta)
         self.gameui.setActive(True)
 
     def remote_updateCosts(self, costdelta):
-        log.msg(["updateCosts", costdelta])
-        self.gameui.applyCostDelta(costdelta)
+        logs.debug("updateCosts", len(costdelta))
+        self._whenReady(self._applyCostDelta, costdelta)
+
+    def _applyCostDelta(self, costdelta):
+        delta = grid.CostDelta.decode(costdelta)
+        if self.tiles is not None:
+            self.tiles.applyDelta(delta)
+        else:
+            self.board.applyDelta(delta)
+        self.gameui.applyCostDelta(delta)
+
+    def fetchView(self, region):
+        """
+        region: (x0, y0, x1, y1) of the board to show, ends excluded
+        returns: Deferred firing with the colours in region
+        """
+        logs.debug("fetchView", self, region)
+        if self.tiles is None:
+            x0, y0, x1, y1 = region
+            return defer.succeed(self.board.data[y0:y1, x0:x1])
+        # only hear about changes to the part of the board shown
+        d = self.perspective.callRemote("setInterest", region)
+        d.addCallback(lambda _: self.tiles.region(region))
+        return d
 
     def _finishTurn(self):
-        log.msg(["_finishTurn", self])
+        logs.debug("finishTurn", self)
         self.gameui.setActive(False)
         chosen = self.gameui.chosen
-        log.msg({'chosen': chosen, 'visited': self.visited,
-                 'parents': self.childMaker.getChildren(chosen) if chosen != () else None})
-        if chosen == ():
+        logs.debug("chosen", chosen, len(self.visited))
+        parent = self._findParent(chosen) if chosen != () else None
+        if parent is None:
             d = self.perspective.callRemote("expandNode", (), ())
         else:
-            for parent in self.childMaker.getChildren(chosen):
-                if parent in self.visited:
-                    self.visited.add(chosen)
-                    d = self.perspective.callRemote("expandNode", chosen,
-                                                    parent)
-                    break
-            else:
-                d = self.perspective.callRemote("expandNode", (), ())
+            self.visited[chosen] = parent
+            d = self.perspective.callRemote("expandNode", chosen, parent)
         d.addErrback(self._errored)
 
+    def _findParent(self, node):
+        """returns: a visited neighbour of node, or None if there is none"""
+        topology = self.childMaker.topology
+        for index in topology.children(topology.index(node)).tolist():
+            parent = topology.node(index)
+            if parent in self.visited:
+                return parent
+        return None
+
     def finishTurnEarly(self):
-        log.msg(["finishTurnEarly", self])
+        logs.debug("finishTurnEarly", self)
         self.later.cancel()
         self._finishTurn()
 
@@ -145,9 +220,26 @@ class GameClient(pb.Referenceable):
         log.msg(["_setGameType", self, repr(gameType)[:100]])
         self.gameType = GameType(None)
         self.gameType.fromDictionary(gameType)
-        image = Image.open(StringIO(self.gameType.image))
-        self.gameui.setImage(image)
-        self.childMaker = util.ChildMaker(image.size, self.gameType.diagonals)
+        if self.gameType.tiled:
+            self.tiles = tiles.RemoteTiles(self.perspective,
+                                           self.gameType.size,
+                                           self.gameType.tileSize)
+            self._setBoard(None)
+        else:
+            d = self.images.get(self.perspective, self.gameType.imageHash,
+                                self.gameType.imageLength)
+            d.addCallback(self._setBoard)
+            d.addErrback(self._errored)
+
+    def _setBoard(self, filename):
+        """filename: the board's image, None for a tiled board"""
+        log.msg(["_setBoard", self, filename])
+        if filename is not None:
+            self.board = self.boards.grid(filename)
+        self.gameui.start(self.gameType.size)
+        self.childMaker = util.ChildMaker(self.gameType.size,
+                                          self.gameType.diagonals)
+        self.ready.callback(None)
         d = self.perspective.callRemote("getColour")
         d.addCallback(self._setColour)
         d.addErrback(self._errored)
@@ -176,11 +268,27 @@ class GameClient(pb.Referenceable):
 
 
 class GameUI(object):
+    """
+    Shows a view of the board, scaled up by a zoom factor.
+    Changes mark rectangles of the view dirty; the dirty rectangles are
+    scaled in bulk and pasted into the displayed image once per reactor
+    iteration, however many changes arrived in it.
+    """
     active = False
-    edited = []
+    chosen = ()
+    colour = (0, 0, 0)
+    factor = 9
+    factors = (1, 2, 3, 4, 6, 9, 12, 16)
+    # largest canvas in screen pixels
+    maxCanvas = (900, 720)
+    # beyond this many dirty rectangles, redraw their bounding box instead
+    maxRectangles = 32
 
     def __init__(self, conduit, root):
-        """conduit: a GameClient with a connection to a server."""
+        """
+        conduit: a GameClient with a connection to a server; fetchView is
+                 called with the region of the board to show
+        """
         super(GameUI, self).__init__()
         log.msg(["GameUI.__init__", self, conduit, root])
         self.conduit = conduit
@@ -190,75 +298,162 @@ class GameUI(object):
         self.item = self.canvas.create_image(0, 0, anchor=Tkinter.NW)
         self.canvas.pack()
         self.canvas.bind("<Button 1>", self._onClick)
+        self.window.bind("<MouseWheel>", self._onWheel)
+        self.window.bind("<Button 4>", lambda e: self.zoom(1))
+        self.window.bind("<Button 5>", lambda e: self.zoom(-1))
+        self.window.bind("<plus>", lambda e: self.zoom(1))
+        self.window.bind("<minus>", lambda e: self.zoom(-1))
+        for key, step in (("Left", (-1, 0)), ("Right", (1, 0)),
+                          ("Up", (0, -1)), ("Down", (0, 1))):
+            self.window.bind("<{0}>".format(key),
+                             lambda e, step=step: self.pan(*step))
+        self.dirty = []
+        self.flushing = None
+        self.view = None
+
+    def start(self, boardSize):
+        """boardSize: (width, height) of the board"""
+        log.msg(["GameUI.start", self, boardSize])
+        self.boardSize = boardSize
+        self._moveView((0, 0))
+
+    def zoom(self, steps):
+        """Change the zoom factor by steps, keeping the view's centre."""
+        i = self.factors.index(self.factor) + steps
+        factor = self.factors[max(0, min(i, len(self.factors) - 1))]
+        if factor == self.factor or self.view is None:
+            return
+        x0, y0, x1, y1 = self.region
+        centre = ((x0 + x1) / 2, (y0 + y1) / 2)
+        self.factor = factor
+        w, h = self._viewSize()
+        self._moveView((centre[0] - w / 2, centre[1] - h / 2))
+
+    def pan(self, dx, dy):
+        """Move the view by a quarter of its size in each direction given."""
+        if self.view is None:
+            return
+        w, h = self._viewSize()
+        self._moveView((self.region[0] + dx * max(w / 4, 1),
+                        self.region[1] + dy * max(h / 4, 1)))
+
+    def setView(self, region, view):
+        """
+        region: (x0, y0, x1, y1) of the board shown, ends excluded
+        view: uint8 array of the colours in region
+        """
+        logs.debug("setView", self, region)
+        self.region = region
+        self.view = np.array(view, np.uint8)
+        size = ((region[2] - region[0]) * self.factor,
+                (region[3] - region[1]) * self.factor)
+        self.photo = Tkinter.PhotoImage(master=self.canvas, width=size[0],
+                                        height=size[1])
+        self.canvas.itemconfig(self.item, image=self.photo)
+        self.canvas.config(width=size[0], height=size[1])
+        self.dirty = []
+        self._invalidate((0, 0, self.view.shape[1], self.view.shape[0]))
+
+    def _viewSize(self):
+        return (min(self.boardSize[0], self.maxCanvas[0] / self.factor),
+                min(self.boardSize[1], self.maxCanvas[1] / self.factor))
+
+    def _moveView(self, origin):
+        w, h = self._viewSize()
+        x = max(0, min(origin[0], self.boardSize[0] - w))
+        y = max(0, min(origin[1], self.boardSize[1] - h))
+        region = (x, y, x + w, y + h)
+        d = self.conduit.fetchView(region)
+        d.addCallback(lambda view: self.setView(region, view))
+        d.addErrback(log.err)
+
+    def _onWheel(self, event):
+        self.zoom(1 if event.delta > 0 else -1)
 
     def _onClick(self, event):
-        log.msg(["_onClick", self, event, self.active])
-        if not self.active:
+        logs.debug("onClick", self, event.x, event.y, self.active)
+        if not self.active or self.view is None:
+            return
+        x = self.region[0] + event.x / self.factor
+        y = self.region[1] + event.y / self.factor
+        if not (self.region[0] <= x < self.region[2] and
+                self.region[1] <= y < self.region[3]):
             return
         self._unedit()
-        # floor x,y to multiples of self.factor
-        x, y = map(lambda a, f=self.factor: a/f*f, (event.x, event.y))
-        self.chosen = (x/self.factor, y/self.factor)
-        self.edited.append((x, y, self.pa[x, y]))
-        for xx in (x, x+self.factor-1):
-            for yy in (y, y+self.factor-1):
-                self.pa[xx, yy] = self.colour
-        self._updateImage()
+        self.chosen = (x, y)
+        self._invalidateNode(self.chosen)
         self.conduit.finishTurnEarly()
 
-    def setImage(self, image):
-        """image: a PIL.Image"""
-        log.msg(["setImage", self, image])
-        self.image = self._resize(image.convert("RGB"), 9)
-        self.pa = self.image.load()
-        self._updateImage()
-
-    def _updateImage(self):
-        log.msg(["_updateImage", self])
-        imagetk = ImageTk.PhotoImage(self.image)
-        self.canvas.itemconfig(self.item, image=imagetk)
-        self.canvas.config(width=imagetk.width(), height=imagetk.height())
-        # keep reference so that old imagetk isn't
-        # GCed until new one is in place
-        self.imagetk = imagetk
-
-    def _resize(self, image, factor):
-        log.msg(["_resize", image, factor])
-        self.factor = factor
-        opa = image.load()
-        size = (image.size[0]*factor, image.size[1]*factor)
-        im = Image.new("RGB", size, None)
-        npa = im.load()
-        for x in xrange(size[0]):
-            for y in xrange(size[1]):
-                npa[x, y] = opa[x/factor, y/factor]
-        return im
-
     def setActive(self, active):
-        log.msg(["setActive", self, active])
+        logs.debug("setActive", self, active)
         self.active = active
         if active:
             self._unedit()
-            self.chosen = ()
         # TODO: visually show whether active or inactive
 
     def _unedit(self):
-        log.msg(["_unedit", self, self.edited])
-        for e in self.edited:
-            for x in xrange(e[0], e[0]+self.factor):
-                for y in xrange(e[1], e[1]+self.factor):
-                    self.pa[x, y] = e[2]
-        self.edited = []
-        self._updateImage()
-
-    def applyCostDelta(self, costdelta):
-        log.msg(["applyCostDelta", self, costdelta])
+        if self.chosen != ():
+            self._invalidateNode(self.chosen)
+        self.chosen = ()
+
+    def applyCostDelta(self, delta):
+        """delta: a grid.CostDelta"""
+        logs.debug("applyCostDelta", self, delta)
         self._unedit()
-        for pixel, colour in costdelta:
-            for x in xrange(pixel[0]*self.factor, (pixel[0]+1)*self.factor):
-                for y in xrange(pixel[1]*self.factor, (pixel[1]+1)*self.factor):
-                    self.pa[x, y] = tuple(colour)
-        self._updateImage()
+        if self.view is None or not len(delta):
+            return
+        x0, y0, x1, y1 = self.region
+        xs = delta.indices % self.boardSize[0]
+        ys = delta.indices // self.boardSize[0]
+        inside = (xs >= x0) & (xs < x1) & (ys >= y0) & (ys < y1)
+        if not inside.any():
+            return
+        xs, ys = xs[inside] - x0, ys[inside] - y0
+        self.view[ys, xs] = delta.colours[inside]
+        if len(xs) > self.maxRectangles:
+            self._invalidate((xs.min(), ys.min(), xs.max() + 1,
+                              ys.max() + 1))
+        else:
+            for x, y in zip(xs.tolist(), ys.tolist()):
+                self._invalidate((x, y, x + 1, y + 1))
+
+    def _invalidateNode(self, node):
+        x, y = node[0] - self.region[0], node[1] - self.region[1]
+        self._invalidate((x, y, x + 1, y + 1))
+
+    def _invalidate(self, rectangle):
+        """rectangle: (x0, y0, x1, y1) of the view to redraw"""
+        self.dirty.append(rectangle)
+        if self.flushing is None:
+            self.flushing = reactor.callLater(0, self.flush)
+
+    def flush(self):
+        """Redraw the dirty rectangles."""
+        if self.flushing is not None and self.flushing.active():
+            self.flushing.cancel()
+        self.flushing = None
+        dirty, self.dirty = self.dirty, []
+        if not dirty or self.view is None:
+            return
+        if len(dirty) > self.maxRectangles:
+            x0s, y0s, x1s, y1s = zip(*dirty)
+            dirty = [(min(x0s), min(y0s), max(x1s), max(y1s))]
+        f = self.factor
+        for x0, y0, x1, y1 in dirty:
+            patch = self.view[y0:y1, x0:x1].copy()
+            if self.chosen != ():
+                cx = self.chosen[0] - self.region[0]
+                cy = self.chosen[1] - self.region[1]
+                if x0 <= cx < x1 and y0 <= cy < y1:
+                    patch[cy - y0, cx - x0] = self.colour
+            image = Image.fromarray(patch).resize(((x1 - x0) * f,
+                                                   (y1 - y0) * f),
+                                                  Image.NEAREST)
+            # blit the patch into place; ImageTk can only replace the
+            # whole of a photo image
+            patch = ImageTk.PhotoImage(image, master=self.canvas)
+            self.photo.tk.call(self.photo.name, "copy", str(patch), "-to",
+                               x0 * f, y0 * f)
 
 
 class ChatUI(object):
@@ -277,7 +472,7 @@ class ChatUI(object):
 
     def printMessage(self, message, colour):
         # TODO: use colour
-        log.msg(["printMessage", self, message, colour])
+        logs.debug("printMessage", self, message, colour)
         tag = self.getTag(colour)
         self.chatlog['state'] = 'normal'
         self.chatlog.insert('end', message, (tag, ))
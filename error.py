@@ -21,3 +21,23 @@ class VersionMismatch(error.LoginFailed):
 class IllegalNodeExpansion(pb.Error):
     """Attempted node expansion not allowed."""
     pass
+
+
+class OutOfTurn(pb.Error):
+    """Move sent when the server was not expecting one from the player."""
+    pass
+
+
+class MoveBudgetSpent(pb.Error):
+    """Move sent after the player had used all its moves for the tick."""
+    pass
+
+
+class ChatFlood(pb.Error):
+    """Chat sent faster than the server allows."""
+    pass
+
+
+class CorruptImage(pb.Error):
+    """Downloaded image does not match the hash the server gave for it."""
+    pass
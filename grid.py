@@ -0,0 +1,191 @@
+# Copyright 2014 Miguel Martinez de Aguirre
+# See LICENSE for details.
+
+from StringIO import StringIO
+import struct
+
+import numpy as np
+from PIL import Image
+
+
+class CostDelta(object):
+    """
+    Pixels whose colours changed, as sent to clients after each round.
+    On the wire a delta is a string: the number of pixels as a uint32, the
+    pixels' flat indices as uint32s, then the red, green and blue planes as
+    uint8s, all little endian. A round's delta is encoded once and the
+    same string is sent to every player.
+    """
+    def __init__(self, indices, colours):
+        """
+        indices: flat indices of the pixels, each at most once
+        colours: uint8 array of shape (len(indices), 3)
+        """
+        self.indices = np.asarray(indices, np.intp)
+        self.colours = np.asarray(colours, np.uint8).reshape(-1, 3)
+
+    @classmethod
+    def fromPairs(cls, pairs, width):
+        """
+        pairs: [(node, colour), ...]; where a node appears more than once
+               the last colour given for it wins
+        width: width of the board
+        """
+        if not pairs:
+            return cls([], [])
+        indices = np.array([n[0] + n[1] * width for n, c in pairs], np.intp)
+        colours = np.array([c for n, c in pairs], np.uint8)
+        # np.unique keeps the first occurrence, so search backwards
+        pixels, last = np.unique(indices[::-1], return_index=True)
+        return cls(pixels, colours[::-1][last])
+
+    @classmethod
+    def decode(cls, data):
+        """data: string made by encode"""
+        count, = struct.unpack_from('<I', data)
+        indices = np.frombuffer(data, '<u4', count, 4)
+        planes = np.frombuffer(data, np.uint8, 3 * count, 4 + 4 * count)
+        return cls(indices, planes.reshape(3, count).T)
+
+    def encode(self):
+        return struct.pack('<I', len(self.indices)) + \
+            self.indices.astype('<u4').tostring() + \
+            np.ascontiguousarray(self.colours.T).tostring()
+
+    def then(self, later):
+        """returns: one CostDelta of this delta's changes, then later's"""
+        if not len(self):
+            return later
+        if not len(later):
+            return self
+        indices = np.concatenate([later.indices, self.indices])
+        colours = np.concatenate([later.colours, self.colours])
+        # np.unique keeps the first occurrence, which is later's
+        pixels, first = np.unique(indices, return_index=True)
+        return CostDelta(pixels, colours[first])
+
+    def pairs(self, width):
+        """returns: [(node, (r, g, b)), ...] for a board of width"""
+        return [((i % width, i // width), tuple(c)) for i, c in
+                zip(self.indices.tolist(), self.colours.tolist())]
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __repr__(self):
+        return "<{0}.{1} of {2} pixels>".format(
+            self.__module__, self.__class__.__name__, len(self))
+
+
+class CostGrid(object):
+    """
+    The game board: a dense uint8[height, width, 3] array of colours.
+    Nodes are (x, y) coordinates, as everywhere else in the game.
+    """
+    def __init__(self, data):
+        """data: uint8 array of shape (height, width, 3)"""
+        self.data = np.ascontiguousarray(data, dtype=np.uint8)
+        self.size = (self.data.shape[1], self.data.shape[0])
+        self.flat = self.data.reshape(-1, 3)
+
+    @classmethod
+    def fromImage(cls, image):
+        """image: a PIL.Image"""
+        return cls(np.array(image.convert("RGB"), dtype=np.uint8))
+
+    @classmethod
+    def fromFile(cls, filename):
+        """filename: an image file"""
+        return cls.fromImage(Image.open(filename))
+
+    @classmethod
+    def fromString(cls, data):
+        """data: contents of an image file"""
+        return cls.fromImage(Image.open(StringIO(data)))
+
+    def __getitem__(self, node):
+        return tuple(self.data[node[1], node[0]].tolist())
+
+    def __setitem__(self, node, colour):
+        self.data[node[1], node[0]] = colour
+
+    def index(self, node):
+        """Flat index of the (x, y) node."""
+        return node[0] + node[1] * self.size[0]
+
+    def node(self, index):
+        """(x, y) node of the flat index."""
+        return (index % self.size[0], index // self.size[0])
+
+    def applyMoves(self, moves):
+        """
+        Blend a whole turn of moves into the board at once.
+        moves: [(node, colour), ...]
+        returns: CostDelta of the pixels changed
+
+        Each pixel becomes the mean of its old colour and the colour of the
+        player who moved there. If several players move to the same pixel in
+        one turn, their colours are averaged first so the result does not
+        depend on the order in which the moves arrived.
+        """
+        if not moves:
+            return CostDelta([], [])
+        width = self.size[0]
+        indices = np.array([n[0] + n[1] * width for n, c in moves], np.intp)
+        colours = np.array([c for n, c in moves], np.uint32)
+        pixels, inverse = np.unique(indices, return_inverse=True)
+        sums = np.zeros((len(pixels), 3), np.uint32)
+        np.add.at(sums, inverse, colours)
+        means = sums // np.bincount(inverse)[:, None]
+        blended = (self.flat[pixels].astype(np.uint32) + means) // 2
+        self.flat[pixels] = blended
+        return CostDelta(pixels, blended)
+
+    def applyMovesInOrder(self, moves):
+        """
+        Blend moves into the board one after another, as they arrived.
+        moves: [(node, colour), ...] in arrival order
+        returns: CostDelta of the pixels changed
+
+        Unlike applyMoves, a pixel moved to more than once is blended with
+        each colour in turn, so later moves weigh more. Moves are applied in
+        layers: every pixel's first move, then every pixel's second, and so
+        on, each layer at once.
+        """
+        if not moves:
+            return CostDelta([], [])
+        width = self.size[0]
+        indices = np.array([n[0] + n[1] * width for n, c in moves], np.intp)
+        colours = np.array([c for n, c in moves], np.uint32)
+        # how many earlier moves went to the same pixel
+        order = np.argsort(indices, kind='mergesort')
+        ordered = indices[order]
+        firsts = np.r_[True, ordered[1:] != ordered[:-1]]
+        positions = np.arange(len(indices))
+        rank = np.empty(len(indices), np.intp)
+        rank[order] = positions - np.maximum.accumulate(
+            np.where(firsts, positions, 0))
+        for layer in xrange(rank.max() + 1):
+            chosen = rank == layer
+            pixels = indices[chosen]
+            self.flat[pixels] = (self.flat[pixels].astype(np.uint32) +
+                                 colours[chosen]) // 2
+        pixels = np.unique(indices)
+        return CostDelta(pixels, self.flat[pixels])
+
+    def applyDelta(self, delta):
+        """Overwrite pixels with the colours in a CostDelta."""
+        self.flat[delta.indices] = delta.colours
+
+    def pathCost(self, nodes):
+        """
+        nodes: sequence of (x, y) nodes along a path
+        returns: sum of util.cost over each consecutive pair of nodes
+        """
+        xy = np.asarray(nodes, np.intp).reshape(-1, 2)
+        if len(xy) < 2:
+            return 0
+        colours = self.data[xy[:, 1], xy[:, 0]].astype(np.int16)
+        manhattan = np.abs(np.diff(xy, axis=0)).sum()
+        colourDiff = np.abs(np.diff(colours, axis=0)).sum()
+        return int(manhattan + colourDiff)
@@ -0,0 +1,190 @@
+# Copyright 2014 Miguel Martinez de Aguirre
+# See LICENSE for details.
+
+"""
+Content-addressed distribution of game images.
+
+Servers identify an image by the hash of its file and page it out in
+chunks on request. Clients keep the images they have downloaded in a
+local cache named by hash, so an image is only transferred once. Partial
+downloads are kept as '.part' files and resumed from where they stopped.
+"""
+
+import hashlib
+import os
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from twisted.internet import defer
+from twisted.python import failure, log
+from twisted.spread import pb, util
+
+import error
+
+_hashes = {}
+
+
+def fileHash(filename):
+    """
+    returns: hex digest of the file's contents
+    Digests are remembered until the file is modified.
+    """
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+    try:
+        return _hashes[key]
+    except KeyError:
+        pass
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), ''):
+            digest.update(chunk)
+    _hashes[key] = digest.hexdigest()
+    return _hashes[key]
+
+
+def openImage(filename, offset=0):
+    """
+    returns: the file opened for reading from offset
+    Raises pb.Error if offset is not within the file.
+    """
+    if not 0 <= offset <= os.path.getsize(filename):
+        raise pb.Error("offset {0} is outside the image".format(offset))
+    f = open(filename, 'rb')
+    f.seek(offset)
+    return f
+
+
+def sendImage(collector, filename, offset=0):
+    """
+    Page the file out to collector from offset, without reading it all
+    into memory.
+    """
+    log.msg(["sendImage", collector, filename, offset])
+    f = openImage(filename, offset)
+    util.FilePager(collector, f, f.close)
+
+
+class ImageCollector(pb.Referenceable):
+    """Appends the pages of an image to a partial file."""
+    # whether the connection dropped during the download
+    disconnected = False
+
+    def __init__(self, f):
+        """f: file object opened for appending"""
+        self.file = f
+        self.done = defer.Deferred()
+
+    def remote_gotPage(self, page):
+        self.file.write(page)
+
+    def remote_endedPaging(self):
+        self.file.close()
+        self.done.callback(None)
+
+    def lost(self, reference):
+        """Called if the connection drops; what arrived so far is kept."""
+        self.disconnected = True
+        if not self.done.called:
+            self.file.close()
+            self.done.errback(pb.PBConnectionLost())
+
+
+class ImageCache(object):
+    """Local store of images, named by the hash of their contents."""
+    def __init__(self, directory=None):
+        """directory: where to keep images, ~/.path-game/images if None"""
+        if directory is None:
+            directory = os.path.join(os.path.expanduser('~'), '.path-game',
+                                     'images')
+        log.msg(["ImageCache.__init__", self, directory])
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        # downloads in progress: hash -> [Deferred, ...]
+        self.waiting = {}
+
+    def path(self, imageHash):
+        return os.path.join(self.directory, imageHash)
+
+    def get(self, perspective, imageHash, length):
+        """
+        Fetch an image from the server unless it is already cached.
+        perspective: server perspective with a getImage method
+        imageHash, length: hash and size in bytes of the image
+        returns: Deferred firing with the image's filename
+        """
+        log.msg(["ImageCache.get", self, imageHash, length])
+        path = self.path(imageHash)
+        if os.path.exists(path):
+            return defer.succeed(path)
+        d = defer.Deferred()
+        if imageHash in self.waiting:
+            self.waiting[imageHash].append(d)
+            return d
+        self.waiting[imageHash] = [d]
+        part, f = self._openPart(path)
+        offset = f.tell()
+        if offset >= length:
+            f.close()
+            fetched = defer.succeed(None)
+        else:
+            collector = ImageCollector(f)
+            perspective.notifyOnDisconnect(collector.lost)
+            fetched = perspective.callRemote("getImage", collector, offset)
+            fetched.addCallback(lambda _: collector.done)
+            fetched.addBoth(self._collected, perspective, collector)
+        fetched.addCallback(self._fetched, imageHash, part)
+        fetched.addBoth(self._notify, imageHash)
+        return d
+
+    def _openPart(self, path):
+        """
+        returns: (filename, file) of the partial download of path, opened
+                 for appending
+        If another process is already downloading the image, a fresh
+        partial file of our own is used instead.
+        """
+        part = path + '.part'
+        f = open(part, 'ab')
+        f.seek(0, os.SEEK_END)
+        if fcntl is None:
+            return part, f
+        try:
+            # released when the file is closed or the process exits
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return part, f
+        except IOError:
+            f.close()
+        fd, part = tempfile.mkstemp('.part', os.path.basename(path),
+                                    self.directory)
+        return part, os.fdopen(fd, 'ab')
+
+    def _collected(self, result, perspective, collector):
+        """Stop watching for the connection to drop once collector is done."""
+        if not collector.disconnected:
+            perspective.dontNotifyOnDisconnect(collector.lost)
+        # the request itself may have failed before any page arrived
+        if not collector.file.closed:
+            collector.file.close()
+        return result
+
+    def _fetched(self, result, imageHash, part):
+        path = self.path(imageHash)
+        if fileHash(part) != imageHash:
+            # start again from scratch next time
+            os.remove(part)
+            raise error.CorruptImage(imageHash)
+        os.rename(part, path)
+        return path
+
+    def _notify(self, result, imageHash):
+        for d in self.waiting.pop(imageHash):
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
@@ -0,0 +1,145 @@
+# Copyright 2014 Miguel Martinez de Aguirre
+# See LICENSE for details.
+
+"""
+Interest management: players may ask to hear only about the part of the
+board they are looking at.
+
+The board is divided into square buckets. Each region of interest is
+registered with the buckets it overlaps, so a round's changes are matched
+against the players watching the buckets they fall in rather than against
+every player. The pixels changed in each bucket are remembered, so a
+player whose region moves can be sent what changed in the area it had not
+been watching.
+"""
+
+import numpy as np
+
+from grid import CostDelta
+import logs
+
+
+class InterestGrid(object):
+    """Spatial index of players' regions of interest over a CostGrid."""
+    bucketSize = 64
+
+    def __init__(self, costs):
+        """costs: the grid.CostGrid players are watching"""
+        self.costs = costs
+        self.width, self.height = costs.size
+        self.bucketsWide = -(-self.width // self.bucketSize)
+        # player -> (x0, y0, x1, y1); players not in here watch everything
+        self.regions = {}
+        # bucket -> set of players whose region overlaps it
+        self.buckets = {}
+        # bucket -> set of flat indices changed since the game started
+        self.changed = {}
+
+    def setRegion(self, player, region):
+        """
+        region: (x0, y0, x1, y1), ends excluded, or None for the whole board
+        returns: CostDelta of the changed pixels the player has now started
+                 watching, to catch it up
+        """
+        logs.debug("setRegion", self, player, region)
+        old = self.remove(player)
+        if region is not None:
+            x0, y0, x1, y1 = [int(a) for a in region]
+            region = (max(x0, 0), max(y0, 0), min(x1, self.width),
+                      min(y1, self.height))
+            self.regions[player] = region
+            for bucket in self._bucketsIn(region):
+                self.buckets.setdefault(bucket, set()).add(player)
+        return self.snapshot(region, old)
+
+    def remove(self, player):
+        """Stop tracking player. returns: its old region"""
+        region = self.regions.pop(player, None)
+        if region is not None:
+            for bucket in self._bucketsIn(region):
+                watchers = self.buckets[bucket]
+                watchers.discard(player)
+                if not watchers:
+                    del self.buckets[bucket]
+        return region
+
+    def record(self, delta):
+        """Remember the pixels a round changed, for later snapshots."""
+        for bucket, positions in self._byBucket(delta.indices):
+            self.changed.setdefault(bucket, set()).update(
+                delta.indices[positions].tolist())
+
+    def deltas(self, delta):
+        """
+        Split a round's changes between the players with a region.
+        returns: {player: encoded CostDelta} for every player with a region
+        """
+        positions = dict((p, []) for p in self.regions)
+        for bucket, inBucket in self._byBucket(delta.indices):
+            for player in self.buckets.get(bucket, ()):
+                positions[player].append(inBucket)
+        result = {}
+        empty = CostDelta([], []).encode()
+        for player, chosen in positions.items():
+            if not chosen:
+                result[player] = empty
+                continue
+            chosen = np.concatenate(chosen)
+            chosen = chosen[self._inside(self.regions[player],
+                                         delta.indices[chosen])]
+            result[player] = CostDelta(delta.indices[chosen],
+                                       delta.colours[chosen]).encode()
+        return result
+
+    def snapshot(self, region, old=None):
+        """
+        returns: CostDelta with the current colour of every changed pixel
+                 inside region but not inside old
+        """
+        if region is None:
+            buckets = self.changed.keys()
+        else:
+            buckets = [b for b in self._bucketsIn(region)
+                       if b in self.changed]
+        if not buckets:
+            return CostDelta([], [])
+        indices = np.fromiter((i for b in buckets for i in self.changed[b]),
+                              np.intp)
+        keep = self._inside(region, indices)
+        if old is not None:
+            keep &= ~self._inside(old, indices)
+        indices = np.sort(indices[keep])
+        return CostDelta(indices, self.costs.flat[indices])
+
+    def _inside(self, region, indices):
+        """returns: mask of the flat indices which fall inside region"""
+        if region is None:
+            return np.ones(len(indices), bool)
+        x0, y0, x1, y1 = region
+        xs = indices % self.width
+        ys = indices // self.width
+        return (xs >= x0) & (xs < x1) & (ys >= y0) & (ys < y1)
+
+    def _bucketsIn(self, region):
+        size = self.bucketSize
+        x0, y0, x1, y1 = region
+        if x1 <= x0 or y1 <= y0:
+            return []
+        return [by * self.bucketsWide + bx
+                for by in xrange(y0 // size, (y1 - 1) // size + 1)
+                for bx in xrange(x0 // size, (x1 - 1) // size + 1)]
+
+    def _byBucket(self, indices):
+        """
+        Yield (bucket, positions) for each bucket the flat indices fall in,
+        where positions index into indices.
+        """
+        if not len(indices):
+            return
+        size = self.bucketSize
+        buckets = (indices // self.width // size) * self.bucketsWide + \
+            indices % self.width // size
+        order = np.argsort(buckets, kind='mergesort')
+        edges = np.flatnonzero(np.diff(buckets[order])) + 1
+        for group in np.split(order, edges):
+            yield int(buckets[group[0]]), group
@@ -0,0 +1,253 @@
+#! /usr/bin/env python
+
+# Copyright 2014 Miguel Martinez de Aguirre
+# See LICENSE for details.
+
+"""
+Append-only journals of games, for audits and offline analysis.
+
+A journal starts with a header: the magic string, the header's length as
+a uint32 and a JSON object with the game type, image hash and players'
+start and end points. Records follow, each a little endian (kind, round,
+length) of uint8, uint32, uint32 then length bytes of payload:
+
+ROUND     a uint32 count of moves, the moving players' numbers as uint32s,
+          the flat indices they moved to as uint32s, then the round's
+          grid.CostDelta exactly as it was sent to players
+KEYFRAME  a grid.CostDelta of every pixel changed since the game started,
+          with its colour after the round
+SCORES    a JSON list of [score, player number]
+INDEX     the (round, offset) of every keyframe as pairs of uint32 and
+          uint64, written when the journal is closed
+
+A closed journal ends with the INDEX record's offset as a uint64 and the
+end marker. Journals of games which never finished have no index and are
+scanned instead.
+
+Replay memory-maps a journal, and rebuilds the board at any round from
+the nearest keyframe before it.
+
+Summarise a journal with: journal.py game.journal [round]
+"""
+
+import json
+import mmap
+import struct
+import sys
+
+import numpy as np
+
+from grid import CostDelta, CostGrid
+
+MAGIC = 'PGJ1'
+END = 'PGJE'
+ROUND, KEYFRAME, SCORES, INDEX = 1, 2, 3, 4
+
+_record = struct.Struct('<BII')
+_footer = struct.Struct('<Q4s')
+_keyframe = np.dtype([('round', '<u4'), ('offset', '<u8')])
+
+
+class Journal(object):
+    """Writes a journal of one game."""
+    def __init__(self, filename, header, keyframeInterval=100):
+        """
+        header: JSON-serialisable dictionary describing the game
+        keyframeInterval: rounds between keyframes
+        """
+        self.file = open(filename, 'wb')
+        self.keyframeInterval = keyframeInterval
+        self.keyframes = []
+        header = dict(header, keyframeInterval=keyframeInterval)
+        data = json.dumps(header)
+        self.file.write(MAGIC + struct.pack('<I', len(data)) + data)
+
+    @classmethod
+    def reopen(cls, filename, number):
+        """
+        Carry on writing a journal after round number, e.g. for a game
+        resumed from a checkpoint. Later rounds, scores and the index are
+        cut off; the index is written again on close.
+        """
+        replay = Replay(filename)
+        end = replay.end
+        for kind, n, offset, length in replay.records():
+            if kind not in (ROUND, KEYFRAME) or n > number:
+                end = offset - _record.size
+                break
+        journal = cls.__new__(cls)
+        journal.keyframeInterval = replay.header['keyframeInterval']
+        journal.keyframes = [(n, offset) for n, offset in replay.keyframes
+                             if offset < end]
+        replay.map.close()
+        journal.file = open(filename, 'r+b')
+        journal.file.truncate(end)
+        journal.file.seek(end)
+        return journal
+
+    def round(self, number, moves, costdelta, snapshot):
+        """
+        number: the round's number, counting from 1
+        moves: [(player number, flat index), ...]
+        costdelta: the round's encoded CostDelta
+        snapshot: callable returning a CostDelta of every pixel changed so
+                  far; only called for keyframes
+        """
+        moves = np.array(moves, '<u4').reshape(-1, 2)
+        self._write(ROUND, number,
+                    struct.pack('<I', len(moves)),
+                    np.ascontiguousarray(moves.T).tostring(), costdelta)
+        if number % self.keyframeInterval == 0:
+            self.keyframes.append((number, self.file.tell()))
+            self._write(KEYFRAME, number, snapshot().encode())
+            # a crashed server still leaves everything up to here readable
+            self.file.flush()
+
+    def scores(self, number, scores):
+        """scores: [(score, player number), ...]"""
+        self._write(SCORES, number, json.dumps(scores))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        """Write the keyframe index and end marker."""
+        if self.file.closed:
+            return
+        offset = self.file.tell()
+        self._write(INDEX, len(self.keyframes),
+                    np.array(self.keyframes, _keyframe).tostring())
+        self.file.write(_footer.pack(offset, END))
+        self.file.close()
+
+    def _write(self, kind, number, *parts):
+        self.file.write(_record.pack(kind, number, sum(map(len, parts))))
+        for part in parts:
+            self.file.write(part)
+
+
+class Replay(object):
+    """Reads a journal through a memory map."""
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:4] != MAGIC:
+            raise ValueError("{0} is not a game journal".format(filename))
+        length, = struct.unpack_from('<I', self.map, 4)
+        self.header = json.loads(self.map[8:8 + length])
+        self.start = 8 + length
+        # offsets of each round's record, by round number
+        self.rounds = {}
+        self.finalScores = None
+        if not self._readIndex():
+            self._scan()
+
+    def _readIndex(self):
+        if len(self.map) < self.start + _footer.size:
+            return False
+        offset, marker = _footer.unpack_from(self.map,
+                                             len(self.map) - _footer.size)
+        if marker != END:
+            return False
+        kind, count, length = _record.unpack_from(self.map, offset)
+        index = np.frombuffer(self.map, _keyframe, count,
+                              offset + _record.size)
+        self.keyframes = [(int(r), int(o)) for r, o in index]
+        self.end = offset
+        return True
+
+    def _scan(self):
+        """Find the keyframes by walking the records' headers."""
+        self.keyframes = []
+        self.end = offset = self.start
+        while offset + _record.size <= len(self.map):
+            kind, number, length = _record.unpack_from(self.map, offset)
+            if offset + _record.size + length > len(self.map):
+                break  # cut short by a crash
+            if kind == KEYFRAME:
+                self.keyframes.append((number, offset))
+            elif kind == INDEX:
+                break
+            offset += _record.size + length
+            self.end = offset
+
+    def records(self, offset=None):
+        """Yield (kind, round, payload offset, length) from offset on."""
+        if offset is None:
+            offset = self.start
+        while offset < self.end:
+            kind, number, length = _record.unpack_from(self.map, offset)
+            yield kind, number, offset + _record.size, length
+            offset += _record.size + length
+
+    def _findRound(self, number):
+        self._loadRounds()
+        return self.rounds[number]
+
+    def _loadRounds(self):
+        if self.rounds:
+            return
+        for kind, number, offset, length in self.records():
+            if kind == ROUND:
+                self.rounds[number] = offset
+            elif kind == SCORES:
+                self.finalScores = json.loads(self.map[offset:offset + length])
+
+    def __len__(self):
+        """returns: the number of rounds journalled"""
+        self._loadRounds()
+        return len(self.rounds)
+
+    def moves(self, number):
+        """returns: [(player number, flat index), ...] of a round"""
+        offset = self._findRound(number)
+        count, = struct.unpack_from('<I', self.map, offset)
+        moves = np.frombuffer(self.map, '<u4', 2 * count,
+                              offset + 4).astype(np.intp)
+        return zip(moves[:count].tolist(), moves[count:].tolist())
+
+    def delta(self, number):
+        """returns: the CostDelta sent to players after a round"""
+        offset = self._findRound(number)
+        length, = struct.unpack_from('<I', self.map, offset - 4)
+        count, = struct.unpack_from('<I', self.map, offset)
+        start = offset + 4 + 8 * count
+        return CostDelta.decode(self.map[start:offset + length])
+
+    def scores(self):
+        """returns: [(score, player number), ...], or None if unfinished"""
+        self._loadRounds()
+        return self.finalScores
+
+    def board(self, number, base):
+        """
+        returns: the board as it was after a round
+        base: CostGrid of the game's image, which is left unchanged
+        """
+        grid = CostGrid(base.data.copy())
+        first = 1
+        for keyframe, offset in reversed(self.keyframes):
+            if keyframe <= number:
+                length, = struct.unpack_from('<I', self.map, offset + 5)
+                start = offset + _record.size
+                grid.applyDelta(CostDelta.decode(
+                    self.map[start:start + length]))
+                first = keyframe + 1
+                break
+        for n in xrange(first, number + 1):
+            grid.applyDelta(self.delta(n))
+        return grid
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3) or sys.argv[1] == "--help":
+        print "usage: {0} game.journal [round]".format(sys.argv[0])
+        exit(0)
+    replay = Replay(sys.argv[1])
+    print json.dumps(replay.header, indent=1, sort_keys=True)
+    print len(replay), "rounds,", len(replay.keyframes), "keyframes"
+    print "scores:", replay.scores()
+    if len(sys.argv) == 3:
+        number = int(sys.argv[2])
+        print "moves:", replay.moves(number)
+        print "delta:", replay.delta(number)
@@ -0,0 +1,120 @@
+# Copyright 2014 Miguel Martinez de Aguirre
+# See LICENSE for details.
+
+"""
+Leveled, sampled logging for code which runs every move or round.
+
+Messages below the current level cost one comparison. Messages which
+pass are formatted at once, so they show the state at the time, and
+queued for a writer thread which hands them to twisted.python.log; the
+queue is bounded, and messages which do not fit are counted and dropped
+rather than holding up the reactor. Categories can be sampled so that
+only a fraction of their messages is kept.
+
+Fields may be callables, which are only called if the message is kept.
+"""
+
+import atexit
+import Queue
+import threading
+
+from twisted.python import log
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+levels = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+
+level = INFO
+# category -> fraction of its messages kept
+rates = {}
+_counts = {}
+maxQueued = 10000
+dropped = 0
+_queue = Queue.Queue(maxQueued)
+_writer = None
+
+
+def configure(level='info', sample=''):
+    """
+    level: one of levels' names
+    sample: 'category:rate,...', e.g. 'expandNode:0.01'
+    """
+    setLevel(levels[level.lower()])
+    for item in filter(None, sample.split(',')):
+        category, rate = item.split(':')
+        setRate(category, float(rate))
+
+
+def setLevel(newLevel):
+    global level
+    level = newLevel
+
+
+def setRate(category, rate):
+    """Keep about rate (0 to 1) of category's messages."""
+    rates[category] = rate
+    _counts[category] = 0
+
+
+def debug(category, *fields):
+    if level <= DEBUG:
+        _emit(DEBUG, category, fields)
+
+
+def info(category, *fields):
+    if level <= INFO:
+        _emit(INFO, category, fields)
+
+
+def warning(category, *fields):
+    if level <= WARNING:
+        _emit(WARNING, category, fields)
+
+
+def _emit(messageLevel, category, fields):
+    global dropped
+    rate = rates.get(category)
+    if rate is not None:
+        count = _counts[category] = _counts[category] + 1
+        # keep every (1 / rate)th message
+        if rate <= 0 or int(count * rate) == int((count - 1) * rate):
+            return
+    fields = [f() if callable(f) else f for f in fields]
+    try:
+        _queue.put_nowait((messageLevel, category, repr([category] + fields)))
+    except Queue.Full:
+        dropped += 1
+        return
+    if _writer is None:
+        _startWriter()
+
+
+def _startWriter():
+    global _writer
+    _writer = threading.Thread(target=_write, name="logs writer")
+    _writer.daemon = True
+    _writer.start()
+
+
+def _write():
+    while True:
+        _log(*_queue.get())
+
+
+def _log(messageLevel, category, text):
+    log.msg(text, system=category, logLevel=messageLevel)
+
+
+def flush():
+    """Write out anything still queued, on the calling thread."""
+    global dropped
+    while True:
+        try:
+            _log(*_queue.get_nowait())
+        except Queue.Empty:
+            break
+    if dropped:
+        log.msg("{0} log messages dropped".format(dropped))
+        dropped = 0
+
+
+atexit.register(flush)
@@ -0,0 +1,192 @@
+# Copyright 2014 Miguel Martinez de Aguirre
+# See LICENSE for details.
+
+"""
+Counters, histograms and trace spans for the server.
+
+Metrics are kept in memory in a Registry and served read-only over HTTP
+on the loopback interface: Prometheus text at /metrics and JSON at
+/metrics.json. Spans time the steps of each round and, if a trace file
+is set, are written to it as JSON lines.
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+import json
+import time
+
+from twisted.python import log
+from twisted.web import resource, server
+
+# upper bounds of histogram buckets, in seconds
+TIMES = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+         1.0, 2.5, 5.0, 10.0)
+# and in bytes
+SIZES = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def sample(self):
+        return self.value
+
+
+class Histogram(object):
+    kind = 'histogram'
+
+    def __init__(self, buckets=TIMES):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.counts[bisect_left(self.buckets, value)] += 1
+
+    @contextmanager
+    def time(self):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started)
+
+    def sample(self):
+        return {'count': self.count, 'sum': self.sum,
+                'buckets': zip(self.buckets + ('+Inf',), self.counts)}
+
+
+class Registry(object):
+    """All the metrics of a process, by name and labels."""
+    def __init__(self):
+        # name -> (kind, help, {labels: metric})
+        self.metrics = {}
+
+    def counter(self, name, help, **labels):
+        return self._get(name, help, labels, Counter)
+
+    def histogram(self, name, help, buckets=TIMES, **labels):
+        return self._get(name, help, labels, lambda: Histogram(buckets))
+
+    def _get(self, name, help, labels, factory):
+        kind, text, family = self.metrics.setdefault(name, [None, help, {}])
+        key = tuple(sorted(labels.items()))
+        try:
+            return family[key]
+        except KeyError:
+            metric = family[key] = factory()
+            self.metrics[name][0] = metric.kind
+            return metric
+
+    def toDictionary(self):
+        return dict((name, {'type': kind, 'help': text,
+                            'values': [{'labels': dict(key),
+                                        'value': m.sample()}
+                                       for key, m in family.items()]})
+                    for name, (kind, text, family) in self.metrics.items())
+
+    def toPrometheus(self):
+        lines = []
+        for name, (kind, text, family) in sorted(self.metrics.items()):
+            lines.append('# HELP {0} {1}'.format(name, text))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            for key, metric in sorted(family.items()):
+                if kind == 'counter':
+                    lines.append('{0}{1} {2}'.format(name, _labels(key),
+                                                     metric.value))
+                    continue
+                total = 0
+                for bound, count in zip(metric.buckets + ('+Inf',),
+                                        metric.counts):
+                    total += count
+                    lines.append('{0}_bucket{1} {2}'.format(
+                        name, _labels(key + (('le', bound),)), total))
+                lines.append('{0}_sum{1} {2}'.format(name, _labels(key),
+                                                     metric.sum))
+                lines.append('{0}_count{1} {2}'.format(name, _labels(key),
+                                                       metric.count))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(key):
+    if not key:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(k, str(v).replace('"', '\\"'))
+                          for k, v in key) + '}'
+
+
+registry = Registry()
+
+
+class Tracer(object):
+    """Writes spans as JSON lines to a file, if one is set."""
+    # spans written between flushes, so a crash loses few of them
+    flushEvery = 100
+
+    def __init__(self):
+        self.file = None
+        self.unflushed = 0
+
+    def open(self, filename):
+        self.file = open(filename, 'a')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    @contextmanager
+    def span(self, name, **fields):
+        """Time the body of a with statement as a span called name."""
+        if self.file is None:
+            yield
+            return
+        started = time.time()
+        try:
+            yield
+        finally:
+            fields['name'] = name
+            fields['start'] = started
+            fields['duration'] = time.time() - started
+            self.file.write(json.dumps(fields) + '\n')
+            self.unflushed += 1
+            if self.unflushed >= self.flushEvery:
+                self.file.flush()
+                self.unflushed = 0
+
+
+tracer = Tracer()
+
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, registry):
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        if request.path == '/metrics.json':
+            request.setHeader('content-type', 'application/json')
+            return json.dumps(self.registry.toDictionary())
+        if request.path == '/metrics':
+            request.setHeader('content-type', 'text/plain; version=0.0.4')
+            return self.registry.toPrometheus()
+        request.setResponseCode(404)
+        return ''
+
+
+def listen(reactor, port, registry=registry):
+    """Serve registry on the loopback interface."""
+    log.msg(["Serving metrics", port])
+    return reactor.listenTCP(int(port), server.Site(MetricsResource(registry)),
+                             interface='127.0.0.1')
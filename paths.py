@@ -0,0 +1,177 @@
+# Copyright 2014 Miguel Martinez de Aguirre
+# See LICENSE for details.
+
+import struct
+
+import numpy as np
+
+
+class PathTree(object):
+    """
+    A player's search tree: every visited node and the parent it was
+    reached from. Supports the lookups of the {node: parent} dict it
+    replaces, with () as the parent of the start node.
+
+    Nodes are stored by flat pixel index. Parents are kept in uint32 pages
+    of 4096 pixels, with unvisited pixels marked, and a page is only
+    allocated once a node on it is visited. A tree costs 16KB for each
+    page it touches, however large the map, rather than a dict entry and
+    two tuples per node.
+    """
+    pageBits = 12
+    # parent of pixels which are not in the tree
+    unvisited = 0xffffffff
+
+    def __init__(self, size, start):
+        """
+        size: (width, height) of the image
+        start: (x, y) root of the tree
+        """
+        self.size = size
+        self.width = size[0]
+        # page number -> parents of its pixels
+        self.pages = {}
+        self.count = 0
+        self.start = start
+        root = self.index(start)
+        self._add(root, root)
+
+    def __repr__(self):
+        return "<{0}.{1} {2} nodes from {3}>".format(
+            self.__module__, self.__class__.__name__, self.count, self.start)
+
+    @classmethod
+    def fromArrays(cls, size, start, indices, parents):
+        """Rebuild a tree from the arrays returned by toArrays."""
+        tree = cls(size, start)
+        indices = np.asarray(indices, np.intp)
+        parents = np.asarray(parents, np.uint32)
+        mask = (1 << cls.pageBits) - 1
+        numbers = indices >> cls.pageBits
+        for number in np.unique(numbers).tolist():
+            chosen = numbers == number
+            tree._page(number)[indices[chosen] & mask] = parents[chosen]
+        tree.count = sum(int((page != cls.unvisited).sum())
+                         for page in tree.pages.values())
+        return tree
+
+    @classmethod
+    def decode(cls, size, start, data):
+        """data: string made by encode"""
+        count, = struct.unpack_from('<I', data)
+        indices = np.frombuffer(data, '<u4', count, 4)
+        parents = np.frombuffer(data, '<u4', count, 4 + 4 * count)
+        return cls.fromArrays(size, start, indices, parents)
+
+    def encode(self):
+        """
+        returns: the tree as a string: the number of nodes as a uint32, then
+                 their flat indices and their parents' as uint32s, all
+                 little endian
+        """
+        indices, parents = self.toArrays()
+        return struct.pack('<I', len(indices)) + \
+            indices.astype('<u4').tostring() + parents.astype('<u4').tostring()
+
+    def toArrays(self):
+        """returns: (indices, parents) int arrays of every visited node"""
+        indices = []
+        parents = []
+        for number in sorted(self.pages):
+            page = self.pages[number]
+            offsets = np.flatnonzero(page != self.unvisited)
+            indices.append((number << self.pageBits) + offsets)
+            parents.append(page[offsets])
+        return np.concatenate(indices), np.concatenate(parents)
+
+    def index(self, node):
+        return node[0] + node[1] * self.width
+
+    def node(self, index):
+        return (index % self.width, index // self.width)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, node):
+        if not (0 <= node[0] < self.size[0] and 0 <= node[1] < self.size[1]):
+            return False
+        return self._visited(self.index(node))
+
+    def __getitem__(self, node):
+        """returns: parent of node, or () for the start node"""
+        if node not in self:
+            raise KeyError(node)
+        index = self.index(node)
+        parent = self._parent(index)
+        if parent == index:
+            return ()
+        return self.node(parent)
+
+    def __setitem__(self, node, parent):
+        """Add node to the tree, reached from the visited node parent."""
+        if parent not in self:
+            raise KeyError(parent)
+        self._add(self.index(node), self.index(parent))
+
+    def add(self, node, parent):
+        self[node] = parent
+
+    def containsIndices(self, indices):
+        """returns: bool array of which flat indices are in the tree"""
+        indices = np.asarray(indices, np.intp)
+        numbers = indices >> self.pageBits
+        offsets = indices & ((1 << self.pageBits) - 1)
+        result = np.zeros(indices.shape, bool)
+        for number in set(numbers.ravel().tolist()):
+            page = self.pages.get(number)
+            if page is not None:
+                chosen = numbers == number
+                result[chosen] = page[offsets[chosen]] != self.unvisited
+        return result
+
+    def path(self, node):
+        """
+        returns: int array of flat indices from the start node to node
+        """
+        if node not in self:
+            raise KeyError(node)
+        index = self.index(node)
+        indices = [index]
+        parent = self._parent(index)
+        while parent != index:
+            index = parent
+            indices.append(index)
+            parent = self._parent(index)
+        indices.reverse()
+        return np.array(indices, np.intp)
+
+    def pathNodes(self, node):
+        """returns: (n, 2) array of (x, y) nodes from the start to node"""
+        indices = self.path(node)
+        return np.column_stack((indices % self.width, indices // self.width))
+
+    def _visited(self, index):
+        page = self.pages.get(index >> self.pageBits)
+        return page is not None and \
+            page[index & ((1 << self.pageBits) - 1)] != self.unvisited
+
+    def _parent(self, index):
+        page = self.pages[index >> self.pageBits]
+        return int(page[index & ((1 << self.pageBits) - 1)])
+
+    def _page(self, number):
+        """returns: the page of parents numbered number, made if need be"""
+        page = self.pages.get(number)
+        if page is None:
+            page = np.empty(1 << self.pageBits, np.uint32)
+            page.fill(self.unvisited)
+            self.pages[number] = page
+        return page
+
+    def _add(self, index, parent):
+        page = self._page(index >> self.pageBits)
+        offset = index & ((1 << self.pageBits) - 1)
+        if page[offset] == self.unvisited:
+            self.count += 1
+        page[offset] = parent
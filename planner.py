@@ -0,0 +1,416 @@
+# Copyright 2014 Miguel Martinez de Aguirre
+# See LICENSE for details.
+
+"""
+Path planning strategies for automated players.
+
+Every strategy plans over the same cost model the server scores with
+(util.cost), plus one for each turn a step takes, and works on flat pixel
+indices with a shared util.Topology.
+"""
+
+import functools
+from heapq import heappush, heappop
+import time
+
+import numpy as np
+
+import util
+
+
+class Planner(object):
+    """
+    Base class for strategies.
+    plan() returns the flat indices of a path from a node to the goal.
+    """
+    turnCost = 1
+    # whether plan() is cheap enough to call again every turn
+    incremental = False
+    # nodes expanded by the latest plan
+    expanded = 0
+
+    def __init__(self, grid, topology, fields=None):
+        """
+        grid: grid.CostGrid the planner reads colours from
+        topology: util.Topology of the grid
+        fields: callable (goal, turnCost) returning distanceField's array
+                for the grid, e.g. a boardcache.BoardCache's; if None they
+                are worked out here
+        """
+        self.grid = grid
+        self.topology = topology
+        self.width = topology.size[0]
+        self.manhattans = np.abs(topology.vectors).sum(1)
+        self.fields = fields
+        # (goal, its distance field)
+        self.field = (None, None)
+
+    def edgeCosts(self, index, children, mask):
+        """
+        returns: cost of stepping from index to each of its neighbours
+                 selected by mask, given as flat indices in children
+        """
+        colours = self.grid.flat
+        diff = np.abs(colours[children].astype(np.int16) -
+                      colours[index].astype(np.int16)).sum(1)
+        return diff + self.manhattans[mask] + self.turnCost
+
+    def heuristic(self, index, goal):
+        """Lower bound on the cost of reaching goal from index."""
+        return 0
+
+    def distances(self, goal):
+        """returns: array of _distance from every flat index to goal"""
+        if self.field[0] != goal:
+            if self.fields is not None:
+                field = self.fields(goal, self.turnCost)
+            else:
+                field = distanceField(self.topology.size,
+                                      self.topology.diagonals, goal,
+                                      self.turnCost)
+            self.field = (goal, field)
+        return self.field[1]
+
+    def expand(self, index):
+        """returns: (children, costs) of the flat index"""
+        children, mask = self.topology.neighbourhood(index)
+        return children, self.edgeCosts(index, children, mask)
+
+    def plan(self, start, goal, deadline=None, avoid=None):
+        """
+        start, goal: flat indices
+        deadline: time.time() by which to give up and return a partial path
+        avoid: paths.PathTree of nodes the path must not step on
+        returns: list of flat indices from start to goal, or towards it if
+                 the deadline passed first
+        """
+        raise NotImplementedError()
+
+    def branch(self, goal, avoid):
+        """
+        Find a move from anywhere in the tree, for when no path leads on
+        from the head: the unvisited node closest to goal which borders a
+        visited one.
+        avoid: paths.PathTree of the player's visited nodes
+        returns: [parent, node] flat indices, or [] if the tree is boxed in
+        """
+        indices = avoid.toArrays()[0]
+        children = self.topology.neighbours(indices)
+        free = children >= 0
+        free[free] = ~avoid.containsIndices(children[free])
+        if not free.any():
+            return []
+        scores = np.where(free, self.distances(goal)[children], np.inf)
+        row, column = divmod(int(scores.argmin()), children.shape[1])
+        return [int(indices[row]), int(children[row, column])]
+
+    def update(self, indices):
+        """
+        Tell the planner the cost of stepping on or off the flat indices
+        has changed, e.g. after a costdelta or a move.
+        """
+        pass
+
+    def _allowed(self, children, costs, avoid):
+        if avoid is None:
+            return children, costs
+        keep = ~avoid.containsIndices(children)
+        return children[keep], costs[keep]
+
+
+class Greedy(Planner):
+    """Steps to whichever neighbour looks cheapest, without searching."""
+    def heuristic(self, index, goal):
+        return _distance(index, goal, self.width, self.topology.diagonals,
+                         self.turnCost)
+
+    def plan(self, start, goal, deadline=None, avoid=None):
+        children, costs = self.expand(start)
+        children, costs = self._allowed(children, costs, avoid)
+        if not len(children):
+            return [start]
+        scores = costs + self.distances(goal)[children]
+        return [start, int(children[scores.argmin()])]
+
+
+class Dijkstra(Planner):
+    """
+    Uniform cost search with a binary heap frontier.
+    Search state lives in arrays reused between plans; a generation stamp
+    marks which entries belong to the current search, so nothing is
+    cleared or allocated per plan.
+    """
+    checkEvery = 256
+
+    def __init__(self, grid, topology, fields=None):
+        Planner.__init__(self, grid, topology, fields)
+        pixels = topology.size[0] * topology.size[1]
+        self.g = np.zeros(pixels, np.int64)
+        self.parent = np.zeros(pixels, np.int32)
+        self.stamp = np.zeros(pixels, np.int32)
+        self.closed = np.zeros(pixels, np.int32)
+        self.generation = 0
+
+    def plan(self, start, goal, deadline=None, avoid=None):
+        self.generation += 1
+        generation = self.generation
+        g, parent, stamp, closed = self.g, self.parent, self.stamp, \
+            self.closed
+        g[start] = 0
+        parent[start] = start
+        stamp[start] = generation
+        width, diagonals = self.width, self.topology.diagonals
+        # closest node to the goal so far, in case the deadline passes
+        best = start
+        bestDistance = _distance(start, goal, width, diagonals, 1)
+        frontier = [(self.heuristic(start, goal), start)]
+        guide = self.guide(goal)
+        self.expanded = 0
+        while frontier:
+            f, index = heappop(frontier)
+            if closed[index] == generation:
+                continue
+            closed[index] = generation
+            if index == goal:
+                best = goal
+                break
+            distance = _distance(index, goal, width, diagonals, 1)
+            if distance < bestDistance:
+                best, bestDistance = index, distance
+            self.expanded += 1
+            if deadline is not None and not self.expanded % self.checkEvery \
+                    and time.time() > deadline:
+                break
+            children, costs = self.expand(index)
+            children, costs = self._allowed(children, costs, avoid)
+            newG = costs + g[index]
+            fresh = stamp[children] != generation
+            better = fresh | (newG < g[children])
+            better &= closed[children] != generation
+            children, newG = children[better], newG[better]
+            g[children] = newG
+            parent[children] = index
+            stamp[children] = generation
+            if guide is not None:
+                newG = newG + guide[children]
+            for priority, child in zip(newG.tolist(), children.tolist()):
+                heappush(frontier, (priority, child))
+        return self.path(start, best)
+
+    def guide(self, goal):
+        """returns: heuristic of every flat index, or None for none"""
+        return None
+
+    def path(self, start, end):
+        result = [end]
+        while end != start:
+            end = int(self.parent[end])
+            result.append(end)
+        result.reverse()
+        return result
+
+
+class AStar(Dijkstra):
+    """Dijkstra guided towards the goal by an admissible heuristic."""
+    def heuristic(self, index, goal):
+        return _distance(index, goal, self.width, self.topology.diagonals,
+                         self.turnCost)
+
+    def guide(self, goal):
+        return self.distances(goal)
+
+
+class DStarLite(Planner):
+    """
+    Incremental planner after Koenig and Likhachev's D* Lite.
+    The search runs backwards from the goal, so as the player moves and
+    costs change only the part of the previous search which the changes
+    affect is repaired. expanded counts the nodes re-expanded by the
+    latest plan. A search cut short by a deadline picks up where it left
+    off on the next plan.
+    """
+    incremental = True
+
+    def __init__(self, grid, topology, fields=None):
+        Planner.__init__(self, grid, topology, fields)
+        pixels = topology.size[0] * topology.size[1]
+        self.g = np.empty(pixels, np.float64)
+        self.rhs = np.empty(pixels, np.float64)
+        self.keys = np.empty((pixels, 2), np.float64)
+        self.queued = np.zeros(pixels, bool)
+        self.goal = None
+
+    def heuristic(self, index, goal):
+        return _distance(index, goal, self.width, self.topology.diagonals,
+                         self.turnCost)
+
+    def reset(self, start, goal, avoid):
+        self.g.fill(np.inf)
+        self.rhs.fill(np.inf)
+        self.queued.fill(False)
+        self.frontier = []
+        self.km = 0
+        self.start = self.last = start
+        self.goal = goal
+        self.avoid = avoid
+        self.rhs[goal] = 0
+        self._push(goal)
+
+    def update(self, indices):
+        if self.goal is None:
+            return
+        for index in indices:
+            self._updateVertices(np.append(self.expand(index)[0], index))
+
+    def plan(self, start, goal, deadline=None, avoid=None):
+        if goal != self.goal or avoid is not self.avoid:
+            self.reset(start, goal, avoid)
+        if start != self.start:
+            self.km += self.heuristic(self.last, start)
+            self.start = self.last = start
+        self.expanded = 0
+        self._computeShortestPath(deadline)
+        return self.path(start, goal)
+
+    def path(self, start, goal):
+        """Follow the cheapest successors from start to goal."""
+        result = [start]
+        index = start
+        seen = set(result)
+        while index != goal:
+            children, costs = self._successors(index)
+            if not len(children):
+                break
+            total = costs + self.g[children]
+            best = total.argmin()
+            if np.isinf(total[best]) or children[best] in seen:
+                if len(result) == 1:
+                    # goal not reached yet: step towards it for now
+                    total = costs + [self.heuristic(c, goal)
+                                     for c in children.tolist()]
+                    result.append(int(children[total.argmin()]))
+                break
+            index = int(children[best])
+            seen.add(index)
+            result.append(index)
+        return result
+
+    def _successors(self, index):
+        children, costs = self.expand(index)
+        return self._allowed(children, costs.astype(np.float64), self.avoid)
+
+    def _key(self, index):
+        m = min(self.g[index], self.rhs[index])
+        return (m + self.heuristic(self.start, index) + self.km, m)
+
+    def _push(self, index):
+        key = self._key(index)
+        self.keys[index] = key
+        self.queued[index] = True
+        heappush(self.frontier, (key[0], key[1], index))
+
+    def _top(self):
+        """returns: (key, index) of the lowest queued node, or (None, None)"""
+        frontier, keys, queued = self.frontier, self.keys, self.queued
+        while frontier:
+            k1, k2, index = frontier[0]
+            if queued[index] and keys[index, 0] == k1 and \
+                    keys[index, 1] == k2:
+                return (k1, k2), index
+            heappop(frontier)
+        return None, None
+
+    def _updateVertices(self, indices):
+        """Recompute rhs of the flat indices from their successors at once."""
+        indices = np.asarray(indices, np.intp)
+        others = indices[indices != self.goal]
+        children = self.topology.neighbours(others)
+        missing = children < 0
+        children[missing] = 0
+        colours = self.grid.flat
+        diff = np.abs(colours[children].astype(np.int16) -
+                      colours[others][:, None].astype(np.int16)).sum(2)
+        costs = (diff + self.manhattans + self.turnCost) + self.g[children]
+        if self.avoid is not None:
+            missing |= self.avoid.containsIndices(children)
+        costs[missing] = np.inf
+        self.rhs[others] = costs.min(1)
+        g, rhs, queued = self.g, self.rhs, self.queued
+        for index in indices.tolist():
+            if g[index] != rhs[index]:
+                self._push(index)
+            else:
+                queued[index] = False
+
+    def _computeShortestPath(self, deadline):
+        g, rhs, start = self.g, self.rhs, self.start
+        while True:
+            key, index = self._top()
+            if key is None or (key >= self._key(start) and
+                               rhs[start] == g[start]):
+                return
+            if deadline is not None and \
+                    not self.expanded % Dijkstra.checkEvery and \
+                    self.expanded and time.time() > deadline:
+                return
+            newKey = self._key(index)
+            if key < newKey:
+                self._push(index)
+                continue
+            heappop(self.frontier)
+            self.queued[index] = False
+            self.expanded += 1
+            predecessors = self.expand(index)[0]
+            if g[index] > rhs[index]:
+                g[index] = rhs[index]
+            else:
+                g[index] = np.inf
+                predecessors = np.append(predecessors, index)
+            self._updateVertices(predecessors)
+
+
+def _distance(a, b, width, diagonals, turnCost):
+    """
+    Lower bound on the cost between flat indices a and b: each step costs
+    at least its manhattan length plus a turn, and covers at most one row
+    and column (or one of them, without diagonals).
+    """
+    dx = abs(a % width - b % width)
+    dy = abs(a // width - b // width)
+    if diagonals:
+        return dx + dy + max(dx, dy) * turnCost
+    return (dx + dy) * (1 + turnCost)
+
+
+def distanceField(size, diagonals, goal, turnCost):
+    """returns: int32 array of _distance from every flat index to goal"""
+    width, height = size
+    dx = np.abs(np.arange(width, dtype=np.int32) - goal % width)[None, :]
+    dy = np.abs(np.arange(height, dtype=np.int32) - goal // width)[:, None]
+    if diagonals:
+        field = dx + dy + np.maximum(dx, dy) * turnCost
+    else:
+        field = (dx + dy) * (1 + turnCost)
+    return field.ravel()
+
+
+strategies = {
+    'greedy': Greedy,
+    'dijkstra': Dijkstra,
+    'astar': AStar,
+    'dstar': DStarLite,
+    }
+
+
+def makePlanner(strategy, grid, diagonals, boards=None):
+    """
+    Build the named strategy's planner for grid.
+    boards: boardcache.BoardCache to take neighbour tables and heuristic
+            fields from, if any
+    """
+    if boards is None:
+        return strategies[strategy](grid, util.getTopology(grid.size,
+                                                           diagonals))
+    fields = functools.partial(boards.distances, grid.size, diagonals)
+    return strategies[strategy](grid, boards.topology(grid.size, diagonals),
+                                fields)
@@ -3,13 +3,14 @@
 # Copyright 2014 Miguel Martinez de Aguirre
 # See LICENSE for details.
 
+import argparse
+from collections import deque
+import hashlib
 from itertools import product
-from Queue import Queue, Empty
-from random import randint
-from StringIO import StringIO
-
-from PIL import Image
-import Tkinter
+import os
+from random import Random
+import re
+import time
 
 from twisted.cred import checkers, portal, credentials
 from twisted.python import log
@@ -18,42 +19,85 @@ from twisted.spread import pb
 
 from zope.interface import implements
 
+import broadcast
+import checkpoint
 import error
+import grid
+import imagecache
+import interest
+import journal
+import logs
+import metrics
+import paths
+import tiles
 import util
 
-VERSION = 2
-CLIENT_VERSIONS = (2,)
+VERSION = 9
+CLIENT_VERSIONS = (9,)
 
 
 class Server(object):
-    clients = {}
     started = False
     finished = False
-    moves = Queue()
+    # rounds wait while no player still in the game is connected
+    paused = False
+    # rounds are held open for the players' timeout plus this many times the
+    # slowest connected player's 95th percentile round trip
+    slackFactor = 1.5
+    countdownCall = None
 
-    def __init__(self, image, maxPlayers=float('inf'), **kwargs):
+    def __init__(self, image, maxPlayers=float('inf'), seed=None, clock=None,
+                 journal=None, checkpoints=None, countdown=None, boards=None,
+                 **kwargs):
         """
         Game clients will be capped at maxPlayers, if provided.
+        The game starts once maxPlayers have joined, countdown seconds after
+        the first player joins if countdown is given, or when start is
+        called, whichever comes first.
+        seed: seeds start points and colours, for reproducible games
+        clock: IReactorTime for round deadlines, the reactor if None
+        journal: filename to write a journal.Journal of the game to, if any
+        checkpoints: directory to keep a checkpoint.Checkpointer's
+                     checkpoints of the game in, if any
+        boards: boardcache.BoardCache to load the board through, if any
         **kwargs are passed to a new GameType.
         See GameType documentation for more details.
         """
         log.msg(["Server.__init__", self, image, maxPlayers, kwargs])
         self.gameType = GameType(image, **kwargs)
-        self.maxPlayers = maxPlayers
-        im = Image.open(StringIO(self.gameType.image)).convert("RGB")
-        self.costs = im.load()
-        self.imageSize = im.size
+        self.maxPlayers = float(maxPlayers)
+        self.random = Random(seed)
+        self.clock = clock
+        self.countdown = None if countdown is None else float(countdown)
+        self.journalName = journal
+        self.journal = None
+        self.clients = {}
+        if boards is None:
+            self.costs = tiles.openGrid(self.gameType.image)
+        else:
+            self.costs = boards.grid(self.gameType.image, self.gameType.tiled)
+        self.imageSize = self.costs.size
+        self.interest = interest.InterestGrid(self.costs)
+        self.broadcaster = broadcast.Broadcaster(clock)
         self.colours = self._generateColours()
+        self.checkpointer = None
+        if checkpoints is not None:
+            self.checkpointer = checkpoint.Checkpointer(self, checkpoints)
 
     def start(self):
         """Make new connections chat-only and initialise players."""
         log.msg(["start", self])
-        if self.started:
+        if self.started or self.finished:
             return
         self.started = True
+        if self.countdownCall is not None and self.countdownCall.active():
+            self.countdownCall.cancel()
         self.turns = 0
+        # rounds whose moves have been applied; turns may be one ahead
+        self.played = 0
         self.players = self.clients.values()
         players = [(c, self.clients[c].colour) for c in self.clients]
+        self.roster = players
         size = self.imageSize
         if len(players) <= 4:
             # If possible, use corners
@@ -67,81 +111,240 @@ class Server(object):
             startPoints = []
             endPoints = []
             for p in players:
-                startPoints.append((randint(0, size[0]-1),
-                                    randint(0, size[1]-1)))
+                startPoints.append((self.random.randint(0, size[0]-1),
+                                    self.random.randint(0, size[1]-1)))
                 endPoints.append(((startPoints[-1][0] + size[0]/2) % size[0],
                                   (startPoints[-1][1] + size[1]/2) % size[1]))
         gameStartInfo = []
         costdelta = []
-        for p in self.players:
+        for number, p in enumerate(self.players):
+            p.number = number
             gameStartInfo.append((p, startPoints.pop(), endPoints.pop()))
             costdelta.append((gameStartInfo[-1][1], p.colour))
+        costdelta = grid.CostDelta.fromPairs(costdelta, size[0]).encode()
+        self.scheduler = self._makeScheduler()
+        if not len(self.players):
+            log.msg("No players. Immediate finish.")
+            self.finished = True
+            return
+        if self.journalName is not None:
+            self._openJournal(gameStartInfo)
+        self.nextRound()
         for info in gameStartInfo:
             info[0].gameStarted(info[1], info[2], players, costdelta)
-        reactor.callInThread(self.doMoves)
 
-    def doMoves(self):
-        log.msg(["doMoves", self])
-        if not len(self.players):
-            log.msg("No players. Immediate finish.")
+    def _makeScheduler(self):
+        gameType = self.gameType
+        if gameType.game == 'realtime':
+            return TickScheduler(gameType.timeout / 1000.0, gameType.budget,
+                                 self.clock)
+        return TurnScheduler(gameType.timeout / 1000.0 * 1.5, self.clock)
+
+    def _openJournal(self, gameStartInfo):
+        players = []
+        for p, start, end in gameStartInfo:
+            players.append({'name': p.name, 'colour': p.colour,
+                            'start': start, 'end': end})
+        header = {'gameType': self.gameType.toDictionary(),
+                  'players': players, 'started': time.time()}
+        self.journal = journal.Journal(self.journalName, header)
+
+    def resume(self, state):
+        """
+        Carry on a game from a checkpoint, with every player detached.
+        state: as returned by checkpoint.load
+        Rounds start again once a player reattaches.
+        """
+        log.msg(["resume", self, state['turns']])
+        if state['imageHash'] != self.gameType.imageHash:
+            raise ValueError("checkpoint is of a different image")
+        self.started = True
+        self.paused = True
+        self.turns = self.played = state['turns']
+        for (tx, ty), tile in state['board']:
+            delta = checkpoint.tileDelta(self.costs, tx, ty, tile)
+            self.costs.applyDelta(delta)
+            self.interest.record(delta)
+        self.players = []
+        for number, saved in enumerate(state['players']):
+            player = GameClient(self, saved['name'])
+            player.number = number
+            player.colour = saved['colour']
+            player.finished = saved['finished']
+            if saved['score'] is not None:
+                player.score = saved['score']
+            player.resume(saved['start'], saved['end'], saved['visited'])
+            self.players.append(player)
+        self.roster = [(p.name, p.colour) for p in self.players]
+        self.scheduler = self._makeScheduler()
+        if self.checkpointer is not None:
+            self.checkpointer.resumed(state)
+        if state.get('journal') is not None:
+            self.journalName = state['journal']
+            if os.path.exists(self.journalName):
+                self.journal = journal.Journal.reopen(self.journalName,
+                                                      self.turns)
+            else:
+                log.msg(["Journal missing, not journalling", self,
+                         self.journalName])
+
+    def reattach(self, name):
+        """returns: the disconnected player called name, if there is one"""
+        if not self.started:
+            return None
+        for p in self.players:
+            if p.name == name and p.remote is None:
+                return p
+        return None
+
+    def nextRound(self):
+        """Begin collecting moves for the next round."""
+        self.turns += 1
+        logs.debug("nextRound", self, self.turns)
+        # players who have disconnected are not waited for
+        live = [p for p in self.players
+                if not p.finished and p.remote is not None]
+        if self.gameType.game == 'realtime':
+            # ticks keep their own time, however slow the players
+            d = self.scheduler.startRound(live)
+            d.addCallback(self.doMoves)
+            d.addErrback(log.err)
+            return
+        roundTrip = max([p.latency.percentile(95) for p in live] or [0])
+        window = self.gameType.timeout / 1000.0 + \
+            roundTrip * self.slackFactor
+        metrics.registry.histogram(
+            'round_window_seconds', 'Time rounds are held open for'
+            ).observe(window)
+        d = self.scheduler.startRound(live, window)
+        d.addCallback(self.doMoves)
+        d.addErrback(log.err)
+
+    def doMoves(self, turn):
+        """
+        Apply a round of moves and start the next round.
+        turn: [(client, node), ...] with () for players who did not move;
+              in realtime games, every move of the tick in arrival order
+        """
+        logs.debug("doMoves", self, turn)
+        if self.finished:
+            return
+        with metrics.tracer.span('doMoves', round=self.turns):
+            self._doMoves(turn)
+
+    def _doMoves(self, turn):
+        registry = metrics.registry
+        number = self.turns
+        moves = []
+        applied = []
+        for t in turn:
+            # no-ops, and moves made in a tick after reaching the end
+            if t == () or t[0].finished:
+                continue
+            if t[1] == t[0].end:
+                t[0].calculateScore(self.turns)
+                t[0].finished = True
+            moves.append((t[1], t[0].colour))
+            applied.append(t)
+        with metrics.tracer.span('applyMoves', round=number):
+            if self.gameType.game == 'realtime':
+                delta = self.costs.applyMovesInOrder(moves)
+            else:
+                delta = self.costs.applyMoves(moves)
+            self.interest.record(delta)
+            if self.checkpointer is not None:
+                self.checkpointer.record(delta)
+            for player, node in applied:
+                player.moved(node)
+        with metrics.tracer.span('encode', round=number), \
+                registry.histogram('serialize_seconds',
+                                   'Time spent encoding cost deltas').time():
+            # encoded once, the same string goes to every player watching
+            # the whole board
+            costdelta = delta.encode()
+            regional = self.interest.deltas(delta)
+        registry.histogram('costdelta_bytes', 'Size of encoded round deltas',
+                           metrics.SIZES).observe(len(costdelta))
+        if self.journal is not None:
+            with metrics.tracer.span('journal', round=number):
+                width = self.imageSize[0]
+                self.journal.round(
+                    number, [(player.number, node[0] + node[1] * width)
+                             for player, node in applied],
+                    costdelta, lambda: self.interest.snapshot(None))
+        self.played = number
+        # finish when all players are done
+        if all([p.finished for p in self.players]):
             self.finished = True
-        while not self.finished:
-            self.turns += 1
-            log.msg("Starting next round.")
-            turn = []
-            for i in xrange(len([p for p in self.players if not p.finished])):
-                try:
-                    t = self.gameType.timeout / 1000.0 * 1.5
-                    turn.append(self.moves.get(True, t))  # (client, node)
-                except Empty, e:
-                    log.msg("Client timed out.")
-                    log.err(e, "{0}/{1} clients did not send a move. Clients who did: \n\t{2}"
-                            .format(
-                                len(self.players) - i,
-                                len(self.players),
-                                turn)
-                            )
-            assert self.moves.empty()
-            costdelta = []
-            for t in turn:
-                if t == ():  # no-op
-                    continue
-                if t[1] == t[0].end:
-                    t[0].calculateScore(self.turns)
-                    t[0].finished = True
-                cost = self.costs[t[1]]
-                colour = t[0].colour
-                newcost = map(lambda a, b: (a+b)/2, cost, colour)
-                costdelta.append((t[1], newcost))
-                self.costs[t[1][0], t[1][1]] = tuple(newcost)
+        elif not [p for p in self.players
+                  if p.remote is not None and not p.finished]:
+            log.msg(["Pausing until a player reattaches", self])
+            self.paused = True
+        else:
+            # register the next round before telling players it has started
+            self.nextRound()
+        if self.checkpointer is not None and not self.finished:
+            self.checkpointer.roundDone(number)
+        with metrics.tracer.span('broadcast', round=number), \
+                registry.histogram('broadcast_seconds',
+                                   'Time spent sending a round to players'
+                                   ).time():
             for p in self.players:
-                p.startNextTurn(costdelta)
-            # finish when all players are done
-            if all([p.finished for p in self.players]):
-                self.finished = True
+                p.startNextTurn(regional.get(p, costdelta))
+            self.broadcaster.frame(delta)
+        if self.finished:
+            self.endGame()
+
+    def endGame(self):
         log.msg("Game finished.")
         scores = [(p.score, p) for p in self.players]
         scores.sort()
         log.msg(["Scores:", scores])
+        if self.journal is not None:
+            self.journal.scores(self.turns, [(s, p.number) for s, p in scores])
+            self.journal.close()
+        if self.checkpointer is not None:
+            self.checkpointer.remove()
         scores[0][1].win(scores)
         for s, p in scores[1:]:
             p.gameOver(scores)
 
     def sendMessage(self, client, message):
-        log.msg(["sendMessage", self, client, message])
+        logs.debug("sendMessage", self, client, message)
+        if not self.broadcaster.allowChat(client.name):
+            raise error.ChatFlood()
         message = '<{0}> {1}'.format(client.name, message)
-        for c in self.clients.values():
-            c.sendChat(message, client.colour)
+        self.broadcaster.chat(message, client.colour)
 
     def addClient(self, client):
         log.msg(["addClient", self, client, len(self.clients), self.maxPlayers])
         self.clients[client.name] = client
-        if len(self.clients) >= self.maxPlayers:
+        self.broadcaster.add(client)
+        if self.started and client in self.players:
+            if self.paused and not self.finished:
+                log.msg(["Unpausing", self])
+                self.paused = False
+                self.nextRound()
+            client.rejoined()
+        elif len(self.clients) >= self.maxPlayers:
             self.start()
+        elif self.countdown is not None and self.countdownCall is None:
+            self._startCountdown()
+
+    def _startCountdown(self):
+        log.msg(["Starting in", self, self.countdown])
+        clock = self.clock
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.countdownCall = clock.callLater(self.countdown, self.start)
+        message = "The game starts in {0:g} seconds.".format(self.countdown)
+        self.broadcaster.chat(message, ChatClient.colour)
 
     def removeClient(self, client):
         log.msg(["removeClient", self, client])
         del self.clients[client.name]
+        self.interest.remove(client)
+        self.broadcaster.remove(client)
 
     def isNameAvailable(self, name):
         log.msg(["isNameAvailable", self, name])
@@ -151,14 +354,187 @@ class Server(object):
         for c in product((0, 255), (0, 255), (0, 255)):
             if c[0] == c[1] == c[2]:
                 continue
-            log.msg(["colours.next", c])
+            logs.debug("colours", c)
             yield c
         while 1:
-            c = (randint(0, 255), randint(0, 255), randint(0, 255))
-            log.msg(["colours.next", c])
+            c = (self.random.randint(0, 255), self.random.randint(0, 255),
+                 self.random.randint(0, 255))
+            logs.debug("colours", c)
             yield c
 
 
+class TurnScheduler(object):
+    """
+    Collects the moves for each round on the reactor thread.
+    A round closes as soon as every expected player has moved, or when its
+    deadline passes, whichever comes first.
+    """
+    def __init__(self, timeout, clock=None):
+        """
+        timeout: seconds players have to move once a round starts
+        clock: IReactorTime to schedule deadlines with, the reactor if None
+        """
+        log.msg(["TurnScheduler.__init__", self, timeout])
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.timeout = timeout
+        self.clock = clock
+        self.pending = {}
+        self.deadline = None
+
+    def startRound(self, players, timeout=None):
+        """
+        players: players expected to move this round
+        timeout: seconds until the round closes, self.timeout if None
+        returns: Deferred firing with [(client, node), ...] once the round
+                 closes, with () in place of missing moves
+        """
+        logs.debug("startRound", self, players, timeout)
+        self.started = time.time()
+        self.window = self.timeout if timeout is None else timeout
+        self.pending = dict((p, defer.Deferred()) for p in players)
+        self.deadline = self.clock.callLater(self.window, self._expire)
+        d = defer.DeferredList(self.pending.values())
+        d.addCallback(self._closed)
+        result = defer.Deferred()
+        # Fire on a later reactor iteration so that a round never closes
+        # inside the call which delivered its last move.
+        d.addCallback(lambda turn: self.clock.callLater(0, result.callback,
+                                                        turn))
+        return result
+
+    def isExpecting(self, player):
+        return player in self.pending
+
+    def remaining(self):
+        """returns: seconds until the current round closes"""
+        return max(self.window - (time.time() - self.started), 0)
+
+    def submit(self, player, node):
+        """Record player's move for the current round. node: () for no-op."""
+        logs.debug("submit", self, player, node)
+        d = self.pending.pop(player)
+        metrics.registry.histogram(
+            'move_latency_seconds', 'Time from the start of a round to a move'
+            ).observe(time.time() - self.started)
+        if node == ():
+            d.callback(())
+        else:
+            d.callback((player, node))
+
+    def _expire(self):
+        self.deadline = None
+        late = self.pending.keys()
+        logs.info("timeout", self, late)
+        for player in late:
+            metrics.registry.counter(
+                'move_timeouts_total', 'Rounds a player did not move in'
+                ).inc()
+            self.submit(player, ())
+
+    def _closed(self, results):
+        metrics.registry.histogram(
+            'round_seconds', 'Time taken to collect a round of moves'
+            ).observe(time.time() - self.started)
+        if self.deadline is not None:
+            self.deadline.cancel()
+            self.deadline = None
+        return [move for success, move in results]
+
+
+class TickScheduler(object):
+    """
+    Collects the moves of realtime games, a tick at a time.
+    Ticks close on a fixed cadence however many players have moved, so a
+    slow player never holds up the others. Each player may move up to
+    budget times a tick, and moves are kept in the order they arrive.
+    """
+    def __init__(self, interval, budget=1, clock=None):
+        """
+        interval: seconds between ticks
+        budget: moves each player may make a tick
+        clock: IReactorTime to schedule ticks with, the reactor if None
+        """
+        log.msg(["TickScheduler.__init__", self, interval, budget])
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.interval = interval
+        self.budget = budget
+        self.clock = clock
+        self.players = {}
+        self.moves = []
+        # when the current tick is due to close
+        self.due = None
+
+    def startRound(self, players, timeout=None):
+        """
+        players: players who may move this tick
+        timeout: ignored; ticks close every interval
+        returns: Deferred firing with [(client, node), ...] in arrival order
+                 once the tick closes
+        """
+        logs.debug("startRound", self, players)
+        self.started = time.time()
+        now = self.clock.seconds()
+        # keep to the cadence, unless ticks have fallen behind it
+        if self.due is None or self.due < now:
+            self.due = now
+        self.due += self.interval
+        self.window = self.due - now
+        self.players = dict((p, 0) for p in players)
+        self.moves = []
+        self.result = defer.Deferred()
+        self.clock.callLater(self.window, self._closed)
+        return self.result
+
+    def isExpecting(self, player):
+        return player in self.players
+
+    def remaining(self):
+        """returns: seconds until the current tick closes"""
+        return max(self.window - (time.time() - self.started), 0)
+
+    def submit(self, player, node):
+        """Record player's move for the current tick. node: () for no-op."""
+        logs.debug("submit", self, player, node)
+        if self.players[player] >= self.budget:
+            raise error.MoveBudgetSpent()
+        self.players[player] += 1
+        metrics.registry.histogram(
+            'move_latency_seconds', 'Time from the start of a round to a move'
+            ).observe(time.time() - self.started)
+        if node != ():
+            self.moves.append((player, node))
+
+    def _closed(self):
+        metrics.registry.histogram(
+            'round_seconds', 'Time taken to collect a round of moves'
+            ).observe(time.time() - self.started)
+        self.players = {}
+        moves, self.moves = self.moves, []
+        self.result.callback(moves)
+
+
+class Latency(object):
+    """Round trip times recently measured to one client."""
+    samples = 32
+
+    def __init__(self, default):
+        """default: seconds to assume until a round trip is measured"""
+        self.default = default
+        self.times = deque(maxlen=self.samples)
+
+    def add(self, seconds):
+        self.times.append(seconds)
+
+    def percentile(self, p):
+        """returns: the pth percentile of the recent round trips"""
+        if not self.times:
+            return self.default
+        ordered = sorted(self.times)
+        return ordered[min(int(len(ordered) * p / 100.0), len(ordered) - 1)]
+
+
 class ChatClient(pb.Avatar):
     """Avatar for client with the ability to get a name and chat."""
     colour = (0, 0, 0)  # default colour for chat-only clients
@@ -178,6 +554,17 @@ class ChatClient(pb.Avatar):
             return "<{0}.{1} instance>".format(self.__module__,
                                                self.__class__.__name__)
 
+    def perspectiveMessageReceived(self, broker, message, args, kw):
+        # clients name the method, so only label the ones which exist
+        method = message
+        if not hasattr(self, 'perspective_' + method):
+            method = 'unknown'
+        with metrics.registry.histogram('rpc_seconds',
+                                        'Time spent handling remote calls',
+                                        method=method).time():
+            return pb.Avatar.perspectiveMessageReceived(self, broker, message,
+                                                        args, kw)
+
     def perspective_message(self, message):
         self.server.sendMessage(self, message)
 
@@ -185,10 +572,35 @@ class ChatClient(pb.Avatar):
         log.msg(["canPlay returning False", self])
         return False
 
-    def sendChat(self, message, colour):
-        log.msg(["sendChat", self, message, colour])
-        d = self.remote.callRemote("print", message, colour)
-        d.addErrback(self._errored)
+    def perspective_getGameType(self):
+        log.msg(["getGameType", self])
+        return self.server.gameType.toDictionary()
+
+    def perspective_getImage(self, collector, offset=0):
+        """
+        Page the game's image out to collector, starting offset bytes in.
+        collector: remote reference with gotPage and endedPaging methods
+        """
+        logs.info("getImage", self, offset)
+        imagecache.sendImage(collector, self.server.gameType.image,
+                             int(offset))
+
+    def perspective_getTile(self, tx, ty):
+        """returns: the current colours of a tile of the board, see tiles"""
+        logs.debug("getTile", self, tx, ty)
+        return tiles.encodeTile(self.server.costs, int(tx), int(ty))
+
+    def perspective_watch(self, fps=None):
+        """
+        Follow the board as a spectator: every pixel changed so far, then
+        the changes since, as updateCosts calls at most fps times a second.
+        fps: None to stop watching
+        """
+        broadcaster = self.server.broadcaster
+        if fps is None:
+            broadcaster.unwatch(self)
+        elif fps > 0:
+            broadcaster.watch(self, fps, self.server.interest.snapshot(None))
 
     def attached(self, mind):
         log.msg(["attached", self, mind])
@@ -200,6 +612,17 @@ class ChatClient(pb.Avatar):
         self.remote = None
         self.server.removeClient(self)
 
+    def _callRemote(self, message, *args):
+        """
+        Call a method of the client, unless it has disconnected.
+        returns: Deferred firing with the result, or None if disconnected
+        """
+        if self.remote is None:
+            return None
+        d = self.remote.callRemote(message, *args)
+        d.addErrback(self._errored)
+        return d
+
     def _errored(self, reason):
         log.err(reason, self)
 
@@ -208,15 +631,15 @@ class GameClient(ChatClient):
     """Client expected to play the game as well as being able to chat."""
     ready = False
     finished = False
+    # follow the player's path within this many pixels, if not None
+    radius = None
 
     def __init__(self, server, name):
         ChatClient.__init__(self, server, name)
         log.msg(["GameClient.__init__", self, server, name])
         self.colour = self.server.colours.next()
-
-    def perspective_getGameType(self):
-        log.msg(["getGameType", self])
-        return self.server.gameType.toDictionary()
+        # until measured, allow a third of the timeout for each round trip
+        self.latency = Latency(self.server.gameType.timeout / 3000.0)
 
     def perspective_getColour(self):
         log.msg(["getColour", self])
@@ -226,53 +649,139 @@ class GameClient(ChatClient):
         log.msg(["canPlay returning True", self])
         return True
 
+    def perspective_setInterest(self, region):
+        """
+        Choose which changes to the board the player is sent.
+        region: (x0, y0, x1, y1) for changes inside the rectangle, ends
+                excluded; an int r for changes within r pixels of the
+                rectangle around the player's path; or None for the whole
+                board
+        Changes the player missed inside its new region are sent at once.
+        """
+        logs.debug("setInterest", self, region)
+        if isinstance(region, (int, long)):
+            self.radius = region
+            if not hasattr(self, 'bounds'):
+                # applied when the game starts
+                return
+            region = self._around()
+        else:
+            self.radius = None
+        self._setRegion(region)
+
+    def moved(self, node):
+        """Note that the player's path now reaches node."""
+        x0, y0, x1, y1 = self.bounds
+        x, y = node
+        self.bounds = (min(x0, x), min(y0, y), max(x1, x + 1),
+                       max(y1, y + 1))
+        if self.radius is not None and self.bounds != (x0, y0, x1, y1):
+            self._setRegion(self._around())
+
+    def _around(self):
+        r = self.radius
+        x0, y0, x1, y1 = self.bounds
+        return (x0 - r, y0 - r, x1 + r, y1 + r)
+
+    def _setRegion(self, region):
+        catchUp = self.server.interest.setRegion(self, region)
+        if len(catchUp):
+            self._callRemote("updateCosts", catchUp.encode())
+
     def gameStarted(self, start, end, players, costdelta):
-        log.msg(["gameStarted", start, end, players, costdelta])
-        self.visited = {start: ()}
+        logs.info("gameStarted", self, start, end)
+        self.resume(start, end, paths.PathTree(self.server.imageSize, start))
+        self._callRemote("startGame", start, end, players, costdelta)
+        if self.radius is not None:
+            self._setRegion(self._around())
+
+    def resume(self, start, end, visited):
+        """Set up the player's game, e.g. from a checkpoint."""
+        self.visited = visited
         self.childMaker = util.ChildMaker(self.server.imageSize,
                                           self.server.gameType.diagonals)
         self.start = start
         self.end = end
-        d = self.remote.callRemote("startGame", start, end, players, costdelta)
-        d.addErrback(self._errored)
+        self.bounds = (start[0], start[1], start[0] + 1, start[1] + 1)
+        if len(visited) > 1:
+            indices = visited.toArrays()[0]
+            xs, ys = indices % self.server.imageSize[0], \
+                indices // self.server.imageSize[0]
+            self.bounds = (int(xs.min()), int(ys.min()), int(xs.max()) + 1,
+                           int(ys.max()) + 1)
+
+    def rejoined(self):
+        """
+        Catch a player who reconnected mid-game up with the whole board and
+        its search tree, from any node of which its path carries on. It is
+        only asked to move once a round is expecting it.
+        """
+        logs.info("rejoined", self)
+        catchUp = self.server.interest.snapshot(None)
+        self._callRemote("resumeGame", self.start, self.end,
+                         self.server.roster, catchUp.encode(),
+                         self.visited.encode())
+        if self.server.scheduler.isExpecting(self):
+            self.startNextTurn(grid.CostDelta([], []).encode())
 
     def startNextTurn(self, costdelta):
-        log.msg(["startNextTurn", costdelta])
+        """
+        costdelta: string encoding the round's grid.CostDelta
+        The player is told how many seconds it has to choose a move: what is
+        left of the round less the time its moves usually take to arrive.
+        The reply to the call measures the player's round trip time.
+        """
+        logs.debug("startNextTurn", self, len(costdelta))
         if self.finished:
-            d = self.remote.callRemote("updateCosts", costdelta)
-        else:
-            d = self.remote.callRemote("startNextTurn", costdelta)
-        d.addErrback(self._errored)
+            self._callRemote("updateCosts", costdelta)
+            return
+        deadline = self.server.scheduler.remaining() - \
+            self.latency.percentile(95) * self.server.slackFactor
+        d = self._callRemote("startNextTurn", costdelta, max(deadline, 0))
+        if d is not None:
+            d.addCallback(self._answered, time.time())
+
+    def _answered(self, result, sent):
+        roundTrip = time.time() - sent
+        self.latency.add(roundTrip)
+        metrics.registry.histogram('round_trip_seconds',
+                                   'Time clients take to answer a call'
+                                   ).observe(roundTrip)
+
+    def detached(self, mind):
+        ChatClient.detached(self, mind)
+        server = self.server
+        # a player who has gone cannot move, so stop waiting for it; ticks
+        # wait for nobody, and a pass could overspend the tick's budget
+        if server.started and server.gameType.game != 'realtime' and \
+                server.scheduler.isExpecting(self):
+            server.scheduler.submit(self, ())
 
     def perspective_expandNode(self, node, parent):
-        log.msg(["expandNode", self, node, parent])
+        logs.debug("expandNode", self, node, parent)
+        if not self.server.scheduler.isExpecting(self):
+            raise error.OutOfTurn()
         if node == ():  # no-op
-            self.server.moves.put(())
+            self.server.scheduler.submit(self, ())
             return
-        log.msg({"parent": parent, "visited": self.visited, "node": node,
-                 "children": self.childMaker.getChildren(parent)})
         if parent not in self.visited \
-                or node not in self.childMaker.getChildren(parent):
+                or not self.childMaker.isChild(node, parent):
             raise error.IllegalNodeExpansion()
+        # may refuse the move, so before it is added to the tree
+        self.server.scheduler.submit(self, node)
         self.visited[node] = parent
-        self.server.moves.put((self, node))
 
     def calculateScore(self, turns):
-        score = 0
-        node = self.end
-        parent = self.visited[node]
-        while parent != ():
-            score += util.cost(node, parent, self.server.costs)
-            node, parent = parent, self.visited[parent]
-        self.score = score + turns
+        path = self.visited.pathNodes(self.end)
+        self.score = self.server.costs.pathCost(path) + turns
 
     def win(self, scores):
         scores = [(s, p.name) for s, p in scores]
-        self.remote.callRemote("win", scores)
+        self._callRemote("win", scores)
 
     def gameOver(self, scores):
         scores = [(s, p.name) for s, p in scores]
-        self.remote.callRemote("gameOver", scores)
+        self._callRemote("gameOver", scores)
 
 
 class GameType(object):
@@ -283,22 +792,35 @@ class GameType(object):
     goals for each player and interactions between them possible.
     """
     def __init__(self, image, game='race', timeout=1000, automated=False,
-                 diagonals=True):
+                 diagonals=True, budget=1):
         """
-        image: filename of image to use for the game
-        game: one of 'race' or 'battle'
+        image: filename of image to use for the game, or of a board made
+               by tiles.py
+        game: one of 'race', 'battle' or 'realtime'; realtime games run on
+              a fixed tick of timeout ms rather than in lockstep rounds
         timeout: the time in ms a client waits for user input before sending a
                  no-op.
         automated: boolean giving whether scripting is allowed in the client.
+        budget: moves each player may make a tick in a realtime game
+
+        Clients are given the hash and length of the image rather than its
+        contents, and fetch it with getImage if they do not have it cached.
+        Tiled boards are too large for that, so clients fetch the tiles they
+        need with getTile instead.
         """
         log.msg(["GameType.__init__", self, image, game,
-                timeout, automated, diagonals])
+                timeout, automated, diagonals, budget])
         self.game = game
+        self.budget = int(budget)
         self.timeout = int(timeout)
         self.automated = bool(int(automated))
+        self.image = image
         if image is not None:
-            self.image = file(image, 'rb').read()
-        self.diagonals = diagonals
+            self.imageHash = imagecache.fileHash(image)
+            self.imageLength = os.path.getsize(image)
+            self.size = tiles.boardSize(image)
+            self.tiled = tiles.isTiled(image)
+        self.diagonals = bool(int(diagonals))
 
     def toDictionary(self):
         """Save game type information to a dictionary."""
@@ -307,8 +829,13 @@ class GameType(object):
             'game': self.game,
             'timeout': self.timeout,
             'automated': self.automated,
-            'image': self.image,
+            'imageHash': self.imageHash,
+            'imageLength': self.imageLength,
+            'size': self.size,
+            'tiled': self.tiled,
+            'tileSize': tiles.TILE_SIZE,
             'diagonals': self.diagonals,
+            'budget': self.budget,
             }
 
     def fromDictionary(self, d):
@@ -317,21 +844,147 @@ class GameType(object):
         self.game = d['game']
         self.timeout = int(d['timeout'])
         self.automated = bool(d['automated'])
-        self.image = d['image']
+        self.imageHash = d['imageHash']
+        self.imageLength = int(d['imageLength'])
+        self.size = tuple(d['size'])
+        self.tiled = bool(d['tiled'])
+        self.tileSize = int(d['tileSize'])
         self.diagonals = d['diagonals']
+        self.budget = int(d['budget'])
+
+
+class Lobby(object):
+    """
+    Hosts any number of independent games, or rooms, in one process.
+    Each room is a Server with its own board, players and rounds.
+    Players choose a room by logging in as 'name@room'; a plain name joins
+    the default room.
+    """
+    separator = '@'
+
+    def __init__(self, image, maxPlayers=float('inf'), defaultRoom='default',
+                 journals=None, checkpoints=None, **kwargs):
+        """
+        image, maxPlayers and **kwargs are used to create each room's Server.
+        See Server documentation for more details.
+        journals: directory to write a journal of each room's game to
+        checkpoints: directory to checkpoint each room's game in; a room
+                     with a checkpoint there carries on from it when opened
+        """
+        log.msg(["Lobby.__init__", self, image, maxPlayers, defaultRoom,
+                 journals, checkpoints, kwargs])
+        self.image = image
+        self.maxPlayers = maxPlayers
+        self.options = kwargs
+        self.defaultRoom = defaultRoom
+        self.journals = journals
+        self.checkpoints = checkpoints
+        self.rooms = {}
+
+    def splitName(self, avatarID):
+        """returns: (name, room) for a login name"""
+        name, sep, room = avatarID.partition(self.separator)
+        return name, room or self.defaultRoom
+
+    def fileName(self, room):
+        """
+        returns: a name for room's files which stays inside their directory
+        Other names than letters, digits, _ and - are hashed; the hash has a
+        '.' in it, so no plain name is the same as a hashed one.
+        """
+        if re.match(r'[A-Za-z0-9_-]+$', room):
+            return room
+        return 'room.' + hashlib.sha1(room).hexdigest()
+
+    def getRoom(self, room):
+        """Return the Server for room, creating it if necessary."""
+        try:
+            return self.rooms[room]
+        except KeyError:
+            log.msg(["Opening room", self, room])
+            options = dict(self.options)
+            safeName = self.fileName(room)
+            if self.journals is not None:
+                name = '{0}-{1}.journal'.format(safeName,
+                                                int(time.time() * 1000))
+                options['journal'] = os.path.join(self.journals, name)
+            if self.checkpoints is not None:
+                options['checkpoints'] = os.path.join(self.checkpoints,
+                                                      safeName)
+            server = Server(self.image, self.maxPlayers, **options)
+            if self.checkpoints is not None and \
+                    checkpoint.exists(options['checkpoints']):
+                server.resume(checkpoint.load(options['checkpoints'],
+                                              server.imageSize))
+            self.rooms[room] = server
+            return server
+
+    def isNameAvailable(self, avatarID):
+        name, room = self.splitName(avatarID)
+        if room not in self.rooms:
+            return True
+        return self.rooms[room].isNameAvailable(name)
+
+    def start(self, room=None):
+        """Start room, or every room which has not yet started if None."""
+        log.msg(["Lobby.start", self, room])
+        if room is not None:
+            self.rooms[room].start()
+            return
+        for server in self.rooms.values():
+            server.start()
+
+    def describe(self):
+        """returns: {room: {'players': [name, ...], 'started': bool, ...}}"""
+        return dict((room, {'players': sorted(server.clients),
+                            'started': server.started,
+                            'finished': server.finished,
+                            'round': getattr(server, 'turns', 0)})
+                    for room, server in self.rooms.items())
+
+    def stop(self):
+        for server in self.rooms.values():
+            if server.checkpointer is not None and server.started \
+                    and not server.finished:
+                server.checkpointer.saveNow()
+            server.finished = True
+            if server.journal is not None:
+                server.journal.close()
+
+    def closeIfEmpty(self, room):
+        server = self.rooms.get(room)
+        if server is not None and server.checkpointer is not None and \
+                server.started and not server.finished:
+            # kept for its players to reattach to
+            return
+        if server is not None and not server.clients:
+            log.msg(["Closing room", self, room])
+            server.finished = True
+            del self.rooms[room]
 
 
 class Realm(object):
     implements(portal.IRealm)
 
+    def __init__(self, lobby):
+        self.lobby = lobby
+
     def requestAvatar(self, avatarID, mind, *interfaces):
         assert pb.IPerspective in interfaces
-        if self.server.started:
-            avatar = ChatClient(self.server, avatarID)
-        else:
-            avatar = GameClient(self.server, avatarID)
+        name, room = self.lobby.splitName(avatarID)
+        server = self.lobby.getRoom(room)
+        # players who lost their connection take their place again
+        avatar = server.reattach(name)
+        if avatar is None and server.started:
+            avatar = ChatClient(server, name)
+        elif avatar is None:
+            avatar = GameClient(server, name)
         avatar.attached(mind)
-        return pb.IPerspective, avatar, lambda: avatar.detached(mind)
+
+        def logout():
+            avatar.detached(mind)
+            self.lobby.closeIfEmpty(room)
+        return pb.IPerspective, avatar, logout
 
 
 class UsernameOnlyChecker(object):
@@ -339,12 +992,12 @@ class UsernameOnlyChecker(object):
     credentialInterfaces = credentials.IUsernamePassword, \
         credentials.IUsernameHashedPassword
 
-    def __init__(self, server):
-        self.server = server
+    def __init__(self, lobby):
+        self.lobby = lobby
 
     def requestAvatarId(self, credentials):
         log.msg(["requestAvatarId", credentials])
-        if not self.server.isNameAvailable(credentials.username):
+        if not self.lobby.isNameAvailable(credentials.username):
             log.msg("Request failed. Name taken.")
             return defer.fail(error.NameTaken())
         else:
@@ -352,40 +1005,137 @@ class UsernameOnlyChecker(object):
             return defer.succeed(credentials.username)
 
 
-if __name__ == '__main__':
-    from sys import argv, stdout
-    from twisted.internet import reactor, tksupport
-    log.startLogging(stdout, setStdout=False)
-    if len(argv) == 1 or argv[1] == "--help":
-        print "usage: {0} image [maxplayers [game=race|battle] [timeout=ms] [automated=0|1]]".format(argv[0])
-        exit(1)
-    elif len(argv) == 2:
-        server = Server(argv[1])
-    elif len(argv) == 3:
-        server = Server(argv[1], argv[2])
-    else:
-        server = Server(argv[1], argv[2],
-                        **dict([tuple(a.split("=")) for a in argv[3:]]))
-    log.msg("Starting server with protocol version", VERSION)
-    log.msg("Accepted client versions are", CLIENT_VERSIONS)
-    realm = Realm()
-    realm.server = server
-    checker = UsernameOnlyChecker(realm.server)
-    p = portal.Portal(realm, [checker])
-    reactor.listenTCP(8181, pb.PBServerFactory(p))
+class Admin(pb.Root):
+    """
+    Remote control of a running server, for hosts without a display.
+    Serve it on the loopback interface only: it needs no login.
+    """
+    def __init__(self, start, describe):
+        """
+        start: callable starting a room, or every waiting room given None
+        describe: callable returning a dictionary of rooms, e.g.
+                  Lobby.describe
+        """
+        self.start = start
+        self.describe = describe
+
+    def remote_rooms(self):
+        return self.describe()
+
+    def remote_start(self, room=None):
+        """Start room, or every room waiting to start if None."""
+        log.msg(["Admin start", room])
+        self.start(room)
+
+
+def makeParser(parser=None):
+    """
+    parser: argparse.ArgumentParser to add the server's options to, e.g.
+            shard.py's; a new one if None
+    """
+    if parser is None:
+        parser = argparse.ArgumentParser(description="Host path-game rooms.")
+    parser.add_argument('image', help="image, or board made by tiles.py, "
+                        "to play on")
+    parser.add_argument('maxplayers', nargs='?', type=float,
+                        default=float('inf'),
+                        help="start each room once this many have joined")
+    parser.add_argument('--game', choices=('race', 'battle', 'realtime'),
+                        default='race')
+    parser.add_argument('--timeout', type=int, default=1000, metavar='MS',
+                        help="time players have to move each round, or "
+                        "between ticks of a realtime game")
+    parser.add_argument('--budget', type=int, default=1,
+                        help="moves each player may make a realtime tick")
+    parser.add_argument('--automated', action='store_true',
+                        help="allow scripted players")
+    parser.add_argument('--no-diagonals', dest='diagonals',
+                        action='store_false')
+    parser.add_argument('--port', type=int, default=8181)
+    parser.add_argument('--binary', type=int, metavar='PORT',
+                        help="also serve players over binary.py's protocol")
+    parser.add_argument('--headless', action='store_true',
+                        help="run without the Start window")
+    parser.add_argument('--countdown', type=float, metavar='SECONDS',
+                        help="start each room this long after its first "
+                        "player joins")
+    parser.add_argument('--admin', type=int, metavar='PORT',
+                        help="serve Admin on this loopback port")
+    parser.add_argument('--log', choices=sorted(logs.levels), default='info')
+    parser.add_argument('--sample', default='', metavar='CATEGORY:RATE,...',
+                        help="log only a fraction of these categories")
+    parser.add_argument('--metrics', type=int, metavar='PORT',
+                        help="serve metrics on this loopback port")
+    parser.add_argument('--trace', metavar='FILE',
+                        help="append trace spans of each round to FILE")
+    parser.add_argument('--journals', metavar='DIRECTORY',
+                        help="journal each room's game in DIRECTORY")
+    parser.add_argument('--checkpoints', metavar='DIRECTORY',
+                        help="checkpoint games in progress in DIRECTORY")
+    parser.add_argument('--boards', metavar='DIRECTORY',
+                        help="keep decoded boards in DIRECTORY, see "
+                        "boardcache.py")
+    return parser
+
+
+def makeLobby(args):
+    """returns: a Lobby of the options parsed by makeParser"""
+    boards = None
+    if args.boards is not None:
+        import boardcache
+        boards = boardcache.BoardCache(args.boards)
+    return Lobby(args.image, args.maxplayers, game=args.game,
+                 timeout=args.timeout, automated=args.automated,
+                 diagonals=args.diagonals, budget=args.budget,
+                 countdown=args.countdown, journals=args.journals,
+                 checkpoints=args.checkpoints, boards=boards)
 
-    def startServer():
-        b.config(state=Tkinter.DISABLED, text="Started")
-        server.start()
 
-    def stopServer():
-        server.finished = True
-        reactor.stop()
+def runGUI(lobby, reactor):
+    """Show a window with a button to start waiting rooms."""
+    import Tkinter
+    from twisted.internet import tksupport
+
+    def startServer():
+        # rooms keep opening, so the button stays enabled
+        lobby.start()
 
     root = Tkinter.Tk()
-    root.protocol("WM_DELETE_WINDOW", stopServer)
+    root.protocol("WM_DELETE_WINDOW", reactor.stop)
     b = Tkinter.Button(root, text=" Start ", command=startServer)
     b.pack()
     tksupport.install(root)
 
-    reactor.run()
\ No newline at end of file
+
+if __name__ == '__main__':
+    from sys import stdout
+    from twisted.internet import reactor
+    args = makeParser().parse_args()
+    log.startLogging(stdout, setStdout=False)
+    logs.configure(args.log, args.sample)
+    if args.metrics is not None:
+        metrics.listen(reactor, args.metrics)
+    if args.trace is not None:
+        metrics.tracer.open(args.trace)
+        reactor.addSystemEventTrigger('after', 'shutdown',
+                                      metrics.tracer.close)
+    lobby = makeLobby(args)
+    log.msg("Starting server with protocol version", VERSION)
+    log.msg("Accepted client versions are", CLIENT_VERSIONS)
+    realm = Realm(lobby)
+    checker = UsernameOnlyChecker(lobby)
+    p = portal.Portal(realm, [checker])
+    reactor.listenTCP(args.port, pb.PBServerFactory(p))
+    if args.binary is not None:
+        import binary
+        reactor.listenTCP(args.binary, binary.BinaryServerFactory(p))
+    if args.admin is not None:
+        admin = Admin(lobby.start, lobby.describe)
+        reactor.listenTCP(args.admin, pb.PBServerFactory(admin),
+                          interface='127.0.0.1')
+    # write checkpoints and journals however the server is stopped
+    reactor.addSystemEventTrigger('before', 'shutdown', lobby.stop)
+    if not args.headless:
+        runGUI(lobby, reactor)
+
+    reactor.run()
@@ -0,0 +1,350 @@
+#! /usr/bin/env python
+
+# Copyright 2014 Miguel Martinez de Aguirre
+# See LICENSE for details.
+
+"""
+Spreads rooms across a pool of worker processes.
+
+The supervisor listens for players on a single port. Each login is routed
+to the worker owning its room and every message is forwarded in both
+directions, so clients cannot tell they are talking to a proxy.
+"""
+
+import argparse
+import os
+import sys
+
+from twisted.cred import credentials, error, portal
+from twisted.internet import defer, protocol, reactor, stdio
+from twisted.protocols import basic
+from twisted.python import log
+from twisted.spread import pb
+
+from zope.interface import implements
+
+import logs
+import server
+
+
+def _wrap(value):
+    """Wrap remote references so they can be passed on to another broker."""
+    if isinstance(value, pb.RemoteReference):
+        return ReferenceProxy(value)
+    return value
+
+
+class ReferenceProxy(pb.Referenceable):
+    """Forwards every remote call it receives to another remote reference."""
+    def __init__(self, remote):
+        self.remote = remote
+
+    def remoteMessageReceived(self, broker, message, args, kw):
+        args = [_wrap(a) for a in broker.unserialize(args)]
+        kw = dict((k, _wrap(v)) for k, v in broker.unserialize(kw).items())
+        d = self.remote.callRemote(message, *args, **kw)
+        return broker.serialize(d)
+
+
+class ProxyAvatar(pb.Avatar):
+    """Front end perspective forwarding calls to a worker's perspective."""
+    def __init__(self, name, room, worker, remote, mind):
+        self.name = name
+        self.room = room
+        self.worker = worker
+        self.remote = remote
+        self.mind = mind
+
+    def perspectiveMessageReceived(self, broker, message, args, kw):
+        args = [_wrap(a) for a in broker.unserialize(args, self)]
+        kw = dict((k, _wrap(v))
+                  for k, v in broker.unserialize(kw, self).items())
+        d = self.remote.callRemote(message, *args, **kw)
+        return broker.serialize(d, self)
+
+    def disconnect(self):
+        """Drop the player's connection, e.g. because its worker died."""
+        log.msg(["ProxyAvatar.disconnect", self.name])
+        self.mind.broker.transport.loseConnection()
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    """
+    One worker process hosting a server.Lobby on a local port.
+    The worker writes 'PORT <n>' to stdout once it is listening and accepts
+    'start' and 'stop' commands on stdin.
+    """
+    port = None
+    # whether the process has exited
+    ended = False
+
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.players = 0
+        self.avatars = set()
+        self.waiting = []
+        self.buffer = ''
+
+    def __repr__(self):
+        return "<WorkerProcess {0} port={1} players={2}>".format(
+            self.index, self.port, self.players)
+
+    def outReceived(self, data):
+        self.buffer += data
+        while '\n' in self.buffer:
+            line, self.buffer = self.buffer.split('\n', 1)
+            if line.startswith('PORT ') and self.port is None:
+                self.port = int(line.split()[1])
+                log.msg(["Worker ready", self])
+                waiting, self.waiting = self.waiting, []
+                for d in waiting:
+                    d.callback(self)
+
+    def whenReady(self):
+        """returns: Deferred firing with this worker once it is listening"""
+        if self.port is not None:
+            return defer.succeed(self)
+        d = defer.Deferred()
+        self.waiting.append(d)
+        return d
+
+    def sendCommand(self, command):
+        self.transport.write(command + '\n')
+
+    def processEnded(self, reason):
+        log.msg(["Worker ended", self, reason.getErrorMessage()])
+        self.ended = True
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.errback(reason)
+        self.supervisor.workerEnded(self)
+
+
+class Supervisor(object):
+    """Starts, monitors and assigns rooms to worker processes."""
+    restartDelay = 1.0
+
+    def __init__(self, args):
+        """
+        args: shard.py's command line, see makeParser; each worker is
+              started with it and builds its Lobby from it
+        """
+        log.msg(["Supervisor.__init__", self, args])
+        self.args = list(args)
+        options = makeParser().parse_args(self.args)
+        self.lobby = server.makeLobby(options)
+        self.workers = [None] * options.workers
+        self.rooms = {}  # room name -> WorkerProcess
+        self.names = set()  # (name, room) of logged in players
+        self.stopping = False
+
+    def start(self):
+        for i in xrange(len(self.workers)):
+            self.spawn(i)
+
+    def spawn(self, index):
+        log.msg(["spawn", self, index])
+        worker = WorkerProcess(self, index)
+        self.workers[index] = worker
+        args = [sys.executable, os.path.abspath(__file__), '--worker']
+        reactor.spawnProcess(worker, sys.executable, args + self.args,
+                             env=os.environ, path=os.getcwd(),
+                             childFDs={0: 'w', 1: 'r', 2: 2})
+
+    def workerEnded(self, worker):
+        if self.workers[worker.index] is worker:
+            self.workers[worker.index] = None
+        for room, w in self.rooms.items():
+            if w is worker:
+                del self.rooms[room]
+        for avatar in list(worker.avatars):
+            avatar.disconnect()
+        if not self.stopping:
+            log.msg(["Restarting crashed worker", worker])
+            reactor.callLater(self.restartDelay, self.spawn, worker.index)
+
+    def workerFor(self, room):
+        """
+        returns: the worker owning room, None if no worker is running.
+        New rooms go to the worker with the fewest players.
+        """
+        worker = self.rooms.get(room)
+        if worker is None or worker.ended:
+            live = [w for w in self.workers if w is not None and not w.ended]
+            if not live:
+                return None
+            worker = min(live, key=lambda w: w.players)
+            log.msg(["Assigning room", room, worker])
+            self.rooms[room] = worker
+        return worker
+
+    def isNameAvailable(self, avatarID):
+        return self.lobby.splitName(avatarID) not in self.names
+
+    def login(self, avatarID, mind):
+        """
+        Log in to the worker owning avatarID's room.
+        returns: Deferred firing with a ProxyAvatar
+        """
+        name, room = self.lobby.splitName(avatarID)
+        self.names.add((name, room))
+
+        def connect(worker):
+            factory = pb.PBClientFactory()
+            reactor.connectTCP('127.0.0.1', worker.port, factory)
+            d = factory.login(credentials.UsernamePassword(avatarID, ''),
+                              client=ReferenceProxy(mind))
+            d.addCallback(loggedIn, worker, factory)
+            return d
+
+        def loggedIn(remote, worker, factory):
+            avatar = ProxyAvatar(name, room, worker, remote, mind)
+            avatar.factory = factory
+            worker.avatars.add(avatar)
+            return avatar
+
+        def failed(reason):
+            self.names.discard((name, room))
+            worker.players -= 1
+            # let the room go to a live worker next time
+            if worker.ended and self.rooms.get(room) is worker:
+                del self.rooms[room]
+            return reason
+
+        worker = self.workerFor(room)
+        if worker is None:
+            self.names.discard((name, room))
+            return defer.fail(error.LoginFailed("No workers are running."))
+        # count the player straight away so concurrent logins spread out
+        worker.players += 1
+        d = worker.whenReady()
+        d.addCallback(connect)
+        d.addErrback(failed)
+        return d
+
+    def logout(self, avatar):
+        log.msg(["logout", self, avatar.name, avatar.room])
+        avatar.factory.disconnect()
+        self.names.discard((avatar.name, avatar.room))
+        worker = avatar.worker
+        if avatar in worker.avatars:
+            worker.avatars.discard(avatar)
+            worker.players -= 1
+        if self.rooms.get(avatar.room) is worker and \
+                not [a for a in worker.avatars if a.room == avatar.room]:
+            del self.rooms[avatar.room]
+
+    def startRooms(self, room=None):
+        """Start room, or every room waiting to start if None."""
+        if room is not None:
+            worker = self.rooms.get(room)
+            if worker is not None and not worker.ended and \
+                    worker.port is not None:
+                worker.sendCommand('start ' + room)
+            return
+        for w in self.workers:
+            if w is not None and not w.ended and w.port is not None:
+                w.sendCommand('start')
+
+    def describe(self):
+        """returns: {room: {'worker': index, 'players': count}}"""
+        return dict((room, {'worker': w.index,
+                            'players': len([a for a in w.avatars
+                                            if a.room == room])})
+                    for room, w in self.rooms.items())
+
+    def stop(self):
+        self.stopping = True
+        for w in self.workers:
+            if w is not None and not w.ended:
+                w.sendCommand('stop')
+
+
+class ShardRealm(object):
+    implements(portal.IRealm)
+
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+
+    def requestAvatar(self, avatarID, mind, *interfaces):
+        assert pb.IPerspective in interfaces
+        d = self.supervisor.login(avatarID, mind)
+        d.addCallback(lambda avatar: (pb.IPerspective, avatar,
+                                      lambda: self.supervisor.logout(avatar)))
+        return d
+
+
+class WorkerCommands(basic.LineReceiver):
+    """Reads supervisor commands from a worker's stdin."""
+    delimiter = '\n'
+
+    def __init__(self, lobby):
+        self.lobby = lobby
+
+    def lineReceived(self, line):
+        log.msg(["Worker command", line])
+        if line == 'start':
+            self.lobby.start()
+        elif line.startswith('start '):
+            room = line[len('start '):]
+            if room in self.lobby.rooms:
+                self.lobby.start(room)
+        elif line == 'stop':
+            self.lobby.stop()
+            reactor.stop()
+
+    def connectionLost(self, reason):
+        # the supervisor has gone away
+        if reactor.running:
+            reactor.stop()
+
+
+def makeParser():
+    """returns: parser of server.py's options, after the number of workers"""
+    parser = argparse.ArgumentParser(
+        description="Host path-game rooms across worker processes.")
+    parser.add_argument('workers', type=int, help="worker processes to run")
+    return server.makeParser(parser)
+
+
+def runWorker(args):
+    """args: the supervisor's command line"""
+    log.startLogging(sys.stderr, setStdout=False)
+    options = makeParser().parse_args(args)
+    logs.configure(options.log, options.sample)
+    lobby = server.makeLobby(options)
+    realm = server.Realm(lobby)
+    p = portal.Portal(realm, [server.UsernameOnlyChecker(lobby)])
+    port = reactor.listenTCP(0, pb.PBServerFactory(p), interface='127.0.0.1')
+    stdio.StandardIO(WorkerCommands(lobby))
+    sys.stdout.write('PORT {0}\n'.format(port.getHost().port))
+    sys.stdout.flush()
+    reactor.run()
+
+
+if __name__ == '__main__':
+    from sys import argv, stdout
+    if len(argv) > 1 and argv[1] == '--worker':
+        runWorker(argv[2:])
+        exit(0)
+    parser = makeParser()
+    args = parser.parse_args()
+    # workers are only reached through the supervisor's PB port, and would
+    # all want the same metrics port and trace file
+    for option in ('binary', 'metrics', 'trace'):
+        if getattr(args, option) is not None:
+            parser.error("--{0} is not supported with workers".format(option))
+    log.startLogging(stdout, setStdout=False)
+    logs.configure(args.log, args.sample)
+    supervisor = Supervisor(argv[1:])
+    supervisor.start()
+    p = portal.Portal(ShardRealm(supervisor),
+                      [server.UsernameOnlyChecker(supervisor)])
+    reactor.listenTCP(args.port, pb.PBServerFactory(p))
+    if args.admin is not None:
+        admin = server.Admin(supervisor.startRooms, supervisor.describe)
+        reactor.listenTCP(args.admin, pb.PBServerFactory(admin),
+                          interface='127.0.0.1')
+    reactor.addSystemEventTrigger('before', 'shutdown', supervisor.stop)
+    reactor.run()
@@ -0,0 +1,211 @@
+#! /usr/bin/env python
+
+# Copyright 2014 Miguel Martinez de Aguirre
+# See LICENSE for details.
+
+"""
+Plays games without a network or display, for self-play and tuning.
+
+Games run the server's own rules (Server, GameClient and TurnScheduler)
+against policies standing in for players' connections, with round
+deadlines on a simulated clock. A game is fully determined by its seed.
+"""
+
+from multiprocessing import Pool
+from random import Random
+import sys
+
+import numpy as np
+from twisted.internet import defer, task
+from twisted.python import log
+
+import bot
+import grid
+import paths
+import server
+import util
+
+results = np.dtype([
+    ('seed', np.uint32),
+    ('player', np.uint8),
+    ('policy', np.uint8),
+    ('score', np.int64),
+    ('turns', np.uint32),
+    ('finished', np.bool_),
+    ])
+
+
+class RandomPlayer(object):
+    """Steps to a random unvisited neighbour of its path's head each turn."""
+    def __init__(self, gameType, costs, random):
+        self.topology = util.getTopology(costs.size, gameType.diagonals)
+        self.costs = costs
+        self.random = random
+
+    def startGame(self, start, end):
+        self.visited = paths.PathTree(self.costs.size, start)
+        self.head = start
+        self.end = end
+
+    def applyCostDelta(self, costdelta):
+        pass
+
+    def chooseMove(self, deadline=None):
+        if self.head == self.end:
+            return (), ()
+        topology = self.topology
+        children = [topology.node(i) for i in
+                    topology.children(topology.index(self.head)).tolist()]
+        children = [c for c in children if c not in self.visited]
+        if not children:
+            return (), ()
+        parent, self.head = self.head, self.random.choice(children)
+        self.visited[self.head] = parent
+        return self.head, parent
+
+
+policies = ['random', 'greedy', 'astar', 'dijkstra', 'dstar']
+
+
+def makePlayer(policy, gameType, costs, random):
+    if policy == 'random':
+        return RandomPlayer(gameType, costs, random)
+    player = bot.BotPlayer(gameType, costs, policy)
+    # plan to completion so that games do not depend on machine speed
+    player.thinkFraction = None
+    return player
+
+
+class SimMind(object):
+    """
+    Stands in for a player's PB connection: calls the server makes on its
+    GameClient are answered directly by a policy.
+    """
+    def __init__(self, avatar, policy, random, maxTurns):
+        self.avatar = avatar
+        self.policy = policy
+        self.random = random
+        self.maxTurns = maxTurns
+        self.scores = None
+
+    def callRemote(self, message, *args):
+        method = getattr(self, 'remote_' + message, None)
+        if method is not None:
+            method(*args)
+        return defer.succeed(None)
+
+    def remote_startGame(self, start, end, players, costdelta):
+        costs = grid.CostGrid(self.avatar.server.costs.data.copy())
+        self.player = makePlayer(self.policy, self.avatar.server.gameType,
+                                 costs, self.random)
+        self.player.startGame(start, end)
+        self._move()
+
+    def remote_startNextTurn(self, costdelta, deadline=None):
+        self.player.applyCostDelta(costdelta)
+        self._move()
+
+    def remote_updateCosts(self, costdelta):
+        self.player.applyCostDelta(costdelta)
+
+    def remote_win(self, scores):
+        self.scores = scores
+
+    def remote_gameOver(self, scores):
+        self.scores = scores
+
+    def _move(self):
+        if self.avatar.server.turns > self.maxTurns:
+            # Rounds close as soon as everyone has moved, so a whole game
+            # runs within one advance of the clock. Stop moving so that
+            # the round waits for its deadline and playGame can step in.
+            return
+        node, parent = self.player.chooseMove()
+        self.avatar.perspective_expandNode(node, parent)
+
+
+def playGame(image, seed, players, maxTurns=10000, **kwargs):
+    """
+    Play one game.
+    image: filename of image to use for the game
+    seed: seed for start points, colours and random policies
+    players: list of policy names, one per player
+    maxTurns: rounds after which an unfinished game is abandoned
+    **kwargs are passed to a new GameType.
+    returns: a results array with one record per player
+    """
+    clock = task.Clock()
+    game = server.Server(image, len(players), seed=seed, clock=clock,
+                         **kwargs)
+    random = Random(seed)
+    avatars = []
+    for i, policy in enumerate(players):
+        avatar = server.GameClient(game, 'p{0}'.format(i))
+        avatars.append(avatar)
+        # the last player to attach starts the game
+        avatar.attached(SimMind(avatar, policy, random, maxTurns))
+    while not game.finished and clock.getDelayedCalls():
+        if game.turns > maxTurns:
+            log.msg(["Abandoning game", seed, game.turns])
+            game.finished = True
+            break
+        when = min(c.getTime() for c in clock.getDelayedCalls())
+        clock.advance(when - clock.seconds())
+    records = np.zeros(len(players), results)
+    for i, (policy, avatar) in enumerate(zip(players, avatars)):
+        records[i] = (seed, i, policies.index(policy),
+                      getattr(avatar, 'score', -1), game.turns,
+                      avatar.finished)
+    return records
+
+
+def _playGame(args):
+    image, seed, players, kwargs = args
+    return playGame(image, seed, players, **kwargs)
+
+
+def playGames(image, seeds, players, processes=None, **kwargs):
+    """
+    Play a game for each seed across a pool of processes.
+    returns: a results array with one record per player per game
+    """
+    pool = Pool(processes)
+    try:
+        jobs = ((image, seed, players, kwargs) for seed in seeds)
+        records = list(pool.imap_unordered(_playGame, jobs, chunksize=16))
+    finally:
+        pool.close()
+        pool.join()
+    if not records:
+        return np.zeros(0, results)
+    records = np.concatenate(records)
+    records.sort(order=['seed', 'player'])
+    return records
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] == "--help":
+        print "usage: {0} image games [players=astar,greedy] [seed=0] [processes=n] [out=results.npy] [maxTurns=10000] [game=race|battle] [diagonals=0|1]".format(sys.argv[0])
+        exit(0)
+    options = dict([tuple(a.split("=")) for a in sys.argv[3:]])
+    players = options.pop('players', 'astar,greedy').split(',')
+    for policy in players:
+        if policy not in policies:
+            print "unknown policy '{0}', expected one of {1}".format(
+                policy, ', '.join(policies))
+            exit(1)
+    first = int(options.pop('seed', 0))
+    processes = options.pop('processes', None)
+    out = options.pop('out', 'results.npy')
+    if 'maxTurns' in options:
+        options['maxTurns'] = int(options['maxTurns'])
+    seeds = xrange(first, first + int(sys.argv[2]))
+    records = playGames(sys.argv[1], seeds, players,
+                        processes and int(processes), **options)
+    np.save(out, records)
+    for i, policy in enumerate(players):
+        mine = records[records['player'] == i]
+        finished = mine[mine['finished']]
+        print "{0} {1}: finished {2}/{3}, mean score {4:.1f}".format(
+            i, policy, len(finished), len(mine),
+            finished['score'].mean() if len(finished) else float('nan'))
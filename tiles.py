@@ -0,0 +1,192 @@
+#! /usr/bin/env python
+
+# Copyright 2014 Miguel Martinez de Aguirre
+# See LICENSE for details.
+
+"""
+Boards too large to decode into memory.
+
+A tiled board is stored as a .npy file of uint8[height, width, 3], which
+the server memory-maps copy-on-write: pages are read from disk when first
+touched and only the pages moves write to are held in memory. The board
+is divided into square tiles, which clients fetch on demand with getTile
+instead of downloading the whole board.
+
+Convert an image with: tiles.py image out.npy
+"""
+
+import os
+import sys
+
+import numpy as np
+from PIL import Image
+from twisted.internet import defer
+from twisted.python import log
+
+from grid import CostGrid
+
+TILE_SIZE = 256
+
+
+def isTiled(filename):
+    return os.path.splitext(filename)[1].lower() == '.npy'
+
+
+def openGrid(filename):
+    """returns: a TiledGrid for a .npy board, otherwise a CostGrid"""
+    if isTiled(filename):
+        return TiledGrid.fromFile(filename)
+    return CostGrid.fromFile(filename)
+
+
+def boardSize(filename):
+    """returns: (width, height) of the board, without reading it all"""
+    if isTiled(filename):
+        shape = np.load(filename, mmap_mode='r').shape
+        return (shape[1], shape[0])
+    return Image.open(filename).size
+
+
+def convert(image, filename, band=TILE_SIZE):
+    """
+    Write a PIL.Image as a tiled board, a band of rows at a time.
+    Most image formats still have to be decoded whole by PIL once.
+    """
+    width, height = image.size
+    out = np.lib.format.open_memmap(filename, 'w+', np.uint8,
+                                    (height, width, 3))
+    for y in xrange(0, height, band):
+        bottom = min(y + band, height)
+        rows = image.crop((0, y, width, bottom)).convert("RGB")
+        out[y:bottom] = np.asarray(rows, np.uint8)
+    out.flush()
+    del out
+
+
+def tileBounds(size, tx, ty, tileSize=TILE_SIZE):
+    """returns: (x0, y0, x1, y1) of the tile, ends excluded"""
+    x0, y0 = tx * tileSize, ty * tileSize
+    return x0, y0, min(x0 + tileSize, size[0]), min(y0 + tileSize, size[1])
+
+
+def encodeTile(costs, tx, ty, tileSize=TILE_SIZE):
+    """returns: the tile's current colours as a string of rows of RGB"""
+    x0, y0, x1, y1 = tileBounds(costs.size, tx, ty, tileSize)
+    if x0 >= x1 or y0 >= y1:
+        raise IndexError("no tile {0}".format((tx, ty)))
+    return costs.data[y0:y1, x0:x1].tostring()
+
+
+def tileMask(size, tileSize=TILE_SIZE):
+    """returns: bool array with an element for each tile, by (ty, tx)"""
+    return np.zeros((-(-size[1] // tileSize), -(-size[0] // tileSize)), bool)
+
+
+def markTiles(mask, indices, width, tileSize=TILE_SIZE):
+    """Set the elements of a tileMask for the tiles of the flat indices."""
+    mask[indices // width // tileSize, indices % width // tileSize] = True
+
+
+class TiledGrid(CostGrid):
+    """CostGrid over a memory-mapped board."""
+    def __init__(self, data, tileSize=TILE_SIZE):
+        """data: uint8 array of shape (height, width, 3), e.g. a memmap"""
+        if data.dtype != np.uint8 or data.ndim != 3 or data.shape[2] != 3:
+            raise ValueError("board must be uint8[height, width, 3]")
+        # no copy: CostGrid would make the array contiguous in memory
+        self.data = data
+        self.size = (data.shape[1], data.shape[0])
+        self.flat = data.reshape(-1, 3)
+        self.tileSize = tileSize
+
+    @classmethod
+    def fromFile(cls, filename):
+        """Map a .npy board; changes are never written back to the file."""
+        return cls(np.load(filename, mmap_mode='c'))
+
+
+class RemoteTiles(object):
+    """Client side copy of the parts of a tiled board fetched so far."""
+    def __init__(self, perspective, size, tileSize=TILE_SIZE):
+        """
+        perspective: server perspective with a getTile method
+        size: (width, height) of the board
+        """
+        self.perspective = perspective
+        self.size = size
+        self.tileSize = tileSize
+        self.tiles = {}
+        self.waiting = {}
+
+    def fetch(self, tx, ty):
+        """returns: Deferred firing with the tile as a uint8 array"""
+        if (tx, ty) in self.tiles:
+            return defer.succeed(self.tiles[tx, ty])
+        d = defer.Deferred()
+        if (tx, ty) in self.waiting:
+            self.waiting[tx, ty].append(d)
+            return d
+        self.waiting[tx, ty] = [d]
+        fetched = self.perspective.callRemote("getTile", tx, ty)
+        fetched.addCallback(self._gotTile, tx, ty)
+        fetched.addBoth(self._notify, tx, ty)
+        return d
+
+    def region(self, region):
+        """
+        region: (x0, y0, x1, y1), ends excluded
+        returns: Deferred firing with the region as a uint8 array
+        """
+        x0, y0, x1, y1 = region
+        size = self.tileSize
+        wanted = [(tx, ty) for ty in xrange(y0 // size, (y1 - 1) // size + 1)
+                  for tx in xrange(x0 // size, (x1 - 1) // size + 1)]
+        d = defer.gatherResults([self.fetch(tx, ty) for tx, ty in wanted])
+        d.addCallback(lambda _: self._assemble(region))
+        return d
+
+    def _gotTile(self, data, tx, ty):
+        x0, y0, x1, y1 = tileBounds(self.size, tx, ty, self.tileSize)
+        tile = np.frombuffer(data, np.uint8).reshape(y1 - y0, x1 - x0, 3)
+        self.tiles[tx, ty] = tile.copy()
+        return self.tiles[tx, ty]
+
+    def _notify(self, result, tx, ty):
+        for d in self.waiting.pop((tx, ty)):
+            if isinstance(result, np.ndarray):
+                d.callback(result)
+            else:
+                d.errback(result)
+
+    def _assemble(self, region):
+        x0, y0, x1, y1 = region
+        size = self.tileSize
+        out = np.empty((y1 - y0, x1 - x0, 3), np.uint8)
+        for (tx, ty), tile in self.tiles.items():
+            tx0, ty0 = tx * size, ty * size
+            ax0, ay0 = max(x0, tx0), max(y0, ty0)
+            ax1 = min(x1, tx0 + tile.shape[1])
+            ay1 = min(y1, ty0 + tile.shape[0])
+            if ax0 < ax1 and ay0 < ay1:
+                out[ay0 - y0:ay1 - y0, ax0 - x0:ax1 - x0] = \
+                    tile[ay0 - ty0:ay1 - ty0, ax0 - tx0:ax1 - tx0]
+        return out
+
+    def applyDelta(self, delta):
+        """Keep fetched tiles up to date with a grid.CostDelta."""
+        width, size = self.size[0], self.tileSize
+        for index, colour in zip(delta.indices.tolist(),
+                                 delta.colours.tolist()):
+            x, y = index % width, index // width
+            tile = self.tiles.get((x // size, y // size))
+            if tile is not None:
+                tile[y % size, x % size] = colour
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] == "--help":
+        print "usage: {0} image out.npy".format(sys.argv[0])
+        exit(0)
+    log.startLogging(sys.stdout, setStdout=False)
+    log.msg(["Converting", sys.argv[1], sys.argv[2]])
+    convert(Image.open(sys.argv[1]), sys.argv[2])
@@ -1,10 +1,121 @@
 # Copyright 2014 Miguel Martinez de Aguirre
-# See LICENSE for more details.
+# See LICENSE for details.
 
 from itertools import product
 
+import numpy as np
 from twisted.python import log
 
+import logs
+
+
+class Topology(object):
+    """
+    Neighbourhood of every pixel in an image, over flat pixel indices.
+    Build one with getTopology so that every user of an image size and
+    diagonals setting shares the same tables.
+    """
+    # int array (pixels, neighbours) as returned by neighbours for every
+    # pixel, e.g. from a boardcache.BoardCache; worked out per call if None
+    table = None
+
+    def __init__(self, size, diagonals):
+        """
+        size: (width, height) of the image
+        diagonals: boolean indicating whether diagonals are allowed
+        """
+        log.msg(["Topology.__init__", self, size, diagonals])
+        self.size = tuple(size)
+        self.diagonals = diagonals
+        if not diagonals:
+            vectors = [(-1, 0), (1, 0), (0, 1), (0, -1)]
+        else:
+            vectors = [x for x in product((-1, 0, 1), (-1, 0, 1))
+                       if x != (0, 0)]
+        self.vectors = np.array(vectors, np.intp)
+        self.offsets = self.vectors[:, 0] + self.vectors[:, 1] * size[0]
+        # Whether a pixel is on the left/right or top/bottom border decides
+        # which of its neighbours exist. Borders are coded in two bits per
+        # axis, bit 0 for the low edge and bit 1 for the high one.
+        self.borderMasks = np.empty((16, len(vectors)), bool)
+        for code in xrange(16):
+            x, y = code & 3, code >> 2
+            dx, dy = self.vectors[:, 0], self.vectors[:, 1]
+            self.borderMasks[code] = ~(((x & 1) & (dx < 0)) |
+                                       ((x >> 1) & (dx > 0)) |
+                                       ((y & 1) & (dy < 0)) |
+                                       ((y >> 1) & (dy > 0))).astype(bool)
+
+    def index(self, node):
+        return node[0] + node[1] * self.size[0]
+
+    def node(self, index):
+        return (index % self.size[0], index // self.size[0])
+
+    def isAdjacent(self, a, b):
+        """Whether (x, y) nodes a and b are both in the image and adjacent."""
+        width, height = self.size
+        if not (0 <= a[0] < width and 0 <= a[1] < height and
+                0 <= b[0] < width and 0 <= b[1] < height):
+            return False
+        dx, dy = abs(a[0] - b[0]), abs(a[1] - b[1])
+        if self.diagonals:
+            return max(dx, dy) == 1
+        return dx + dy == 1
+
+    def masks(self, indices):
+        """
+        indices: int array of flat pixel indices
+        returns: bool array (len(indices), neighbours) of which exist
+        """
+        width, height = self.size
+        x, y = indices % width, indices // width
+        codes = (x == 0) | ((x == width - 1) << 1) | \
+            ((y == 0) << 2) | ((y == height - 1) << 3)
+        return self.borderMasks[codes]
+
+    def neighbours(self, indices):
+        """
+        indices: int array of flat pixel indices
+        returns: int array (len(indices), neighbours) of flat indices of
+                 their neighbours, -1 where a neighbour is off the image
+        """
+        indices = np.asarray(indices, np.intp)
+        if self.table is not None:
+            return self.table[indices].astype(np.intp)
+        result = indices[:, None] + self.offsets
+        result[~self.masks(indices)] = -1
+        return result
+
+    def neighbourhood(self, index):
+        """
+        returns: (children, mask) where children are the flat indices of
+                 index's neighbours and mask says which of vectors they are
+        """
+        if self.table is not None:
+            row = self.table[index].astype(np.intp)
+            mask = row >= 0
+            return row[mask], mask
+        mask = self.masks(np.array([index], np.intp))[0]
+        return (index + self.offsets)[mask], mask
+
+    def children(self, index):
+        """returns: int array of the flat indices of index's neighbours"""
+        return self.neighbourhood(index)[0]
+
+
+_topologies = {}
+
+
+def getTopology(size, diagonals):
+    """Return the shared Topology for an image size and diagonals setting."""
+    key = (tuple(size), bool(diagonals))
+    try:
+        return _topologies[key]
+    except KeyError:
+        topology = _topologies[key] = Topology(*key)
+        return topology
+
 
 class ChildMaker(object):
     def __init__(self, size, diagonals):
@@ -14,30 +125,28 @@ class ChildMaker(object):
         """
         self.size = size
         self.diagonals = diagonals
+        self.topology = getTopology(size, diagonals)
 
     def getChildren(self, node):
         """
         node: (x, y) coordinates of parent for children
         returns: set of viable children
         """
-        log.msg(["getChildren", self, node])
-        children = set()
-        if not self.diagonals:
-            vectors = [(-1, 0), (1, 0), (0, 1), (0, -1)]
-        else:
-            vectors = [x for x in product((-1, 0, 1), (-1, 0, 1)) if x != (0, 0)]
-        for v in vectors:
-            child = (node[0] + v[0], node[1] + v[1])
-            if (0 <= child[0] < self.size[0]) and (0 <= child[1] < self.size[1]):
-                children.add(child)
-        return children
+        logs.debug("getChildren", self, node)
+        width = self.size[0]
+        return set((i % width, i // width) for i in
+                   self.topology.children(self.topology.index(node)).tolist())
+
+    def isChild(self, node, parent):
+        """Whether node is a viable child of parent."""
+        return self.topology.isAdjacent(parent, node)
 
 
 def cost(node, parent, costs):
     """
     node: (x, y) coordinates of node
     parent: (x, y) coordinates of node's parent
-    costs: matrix of colours as from PIL.Image.load
+    costs: matrix of colours as from PIL.Image.load or a grid.CostGrid
     """
     manhattan = abs(node[0] - parent[0]) + abs(node[1] - parent[1])
     colourDiff = sum(map(lambda a, b: abs(a - b), costs[node], costs[parent]))